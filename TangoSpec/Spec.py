@@ -11,43 +11,64 @@
 
 """A TANGO_ device server for SPEC_ based on SpecClient."""
 
+import os
 import re
 import json
+import time
 import logging
 import numbers
+import tempfile
 import weakref
+import threading
+import collections
 from functools import partial
 
-import numpy
-
 import gevent
-from gevent.backdoor import BackdoorServer
 
 from PyTango import requires_pytango
 
 requires_pytango("8.1.9", software_name="TangoSpec")
 
 from PyTango import GreenMode
-from PyTango import DevState, Util, Attr, Except, DevFailed
+from PyTango import DevState, Util, Attr, Except
 from PyTango import CmdArgType, AttrWriteType, DispLevel, DebugIt
-from PyTango import AttrDataFormat
+from PyTango import AttrDataFormat, AttrQuality
 from PyTango.server import Device, DeviceMeta, attribute, command
 from PyTango.server import device_property
 from PyTango.server import get_worker
 from PyTango.utils import is_non_str_seq
 
-from SpecClient_gevent import Spec as _Spec
-from SpecClient_gevent import SpecCommand
-from SpecClient_gevent import SpecVariable
 from SpecClient_gevent import SpecEventsDispatcher
 from SpecClient_gevent.SpecClientError import SpecClientError
 
-from TangoSpec.SpecCommon import execute, switch_state
+from TangoSpec.SpecCommon import switch_state, registry, TangoWorker
+from TangoSpec.SpecCommon import get_workers
+from TangoSpec.SpecCommon import (create_element_devices,
+                                  delete_element_devices)
+from TangoSpec.SpecCommon import (set_status_batch_interval,
+                                  get_suppressed_events)
+from TangoSpec.SpecSession import get_session, get_sessions, SPEC_BACKEND
+from TangoSpec.SpecConversion import ConversionPool
+from TangoSpec.SpecProfiler import Profiler
+from TangoSpec.SpecMonitor import get_loop_monitor
+from TangoSpec.SpecMetrics import (push_event, forget_device, timed,
+                                   command_seconds, start_metrics_server,
+                                   set_event_window, get_hot_attributes)
+from TangoSpec.SpecStartup import (get_startup_timer, startup_phase,
+                                   report_startup)
+from TangoSpec.SpecDataFile import get_data_file
+from TangoSpec.SpecDataFile import execute as execute_data_file
+from TangoSpec.SpecSnapshot import (get_snapshot, ELEMENTS, VARIABLES,
+                                    MOTORS, COUNTERS)
 
 #: read-only spectrum string attribute helper
 str_1D_attr = partial(attribute, dtype=[str], access=AttrWriteType.READ,
                       max_dim_x=512)
 
+#: True in the coordinator process of a sharded server (``--shards``). The
+#: shard module is only imported then
+_SHARDED = False
+
 _SpecCmdLineRE = re.compile("\\n*(?P<line>\d+)\.(?P<session>\w+)\>\s*")
 
 
@@ -65,6 +86,69 @@ def get_tango_type_format(dtype):
     return dtype, str, str
 
 
+def _empty_scan_data():
+    # numpy is only needed once scan data is used
+    import numpy
+    return numpy.empty((0, 0))
+
+
+class _ElementsTask(object):
+    """Tango worker task which deletes and creates TANGO_ devices of one
+    element type of a Spec device and fires a single element list event at
+    the end.
+
+    A task pending in the worker queue absorbs the following tasks for the
+    same Spec device and element type (see :meth:`merge`): creation and
+    deletion of the same device cancel each other and all creations are
+    done in one batch."""
+
+    def __init__(self, spec_dev_name, etype, create, delete, notify):
+        self.spec_dev_name = spec_dev_name
+        self.etype = etype
+        self.create = create
+        self.delete = delete
+        self.notify = notify
+        # dict<lower device name: (spec name, device name, alias)>
+        self.creations = collections.OrderedDict()
+        # dict<lower device name: device name>
+        self.deletions = collections.OrderedDict()
+
+    def add(self, element):
+        self.creations[element[1].lower()] = element
+
+    def remove(self, dev_name):
+        key = dev_name.lower()
+        if key in self.creations:
+            # device not created yet: cancel its creation
+            del self.creations[key]
+        else:
+            self.deletions[key] = dev_name
+
+    def merge(self, task):
+        """Merges the given task into this one. Returns True if merged or
+        False if the task is not compatible"""
+        if not isinstance(task, _ElementsTask) or \
+           task.spec_dev_name != self.spec_dev_name or \
+           task.etype != self.etype:
+            return False
+        for dev_name in task.deletions.values():
+            self.remove(dev_name)
+        for element in task.creations.values():
+            self.add(element)
+        return True
+
+    def __call__(self):
+        if self.deletions:
+            self.delete(list(self.deletions.values()))
+        if self.creations:
+            self.create(list(self.creations.values()))
+        self.notify()
+
+    def __str__(self):
+        return "{0}(create={1}, delete={2})".format(self.etype,
+            list(self.creations), list(self.deletions))
+
+
 class Spec(Device):
     """A TANGO_ device for SPEC_ based on SpecClient."""
     __metaclass__ = DeviceMeta
@@ -72,6 +156,15 @@ class Spec(Device):
     Spec = device_property(dtype=str, default_value="localhost:spec",
         doc="SPEC session (examples: localhost:spec, mach101:fourc)")
 
+    Backend = device_property(dtype=str, default_value="spec",
+        doc="'spec' (SpecClient) or 'sim' (in-process simulated SPEC, "
+            "for load tests without SPEC)")
+
+    SimConfig = device_property(dtype=str, default_value="",
+        doc="JSON configuration file of the simulated SPEC (motors, "
+            "counters, variables, scripted commands). Only with the "
+            "'sim' backend")
+
     AutoDiscovery = device_property(dtype=bool, default_value=False,
         doc="Enable/disable auto discovery")
 
@@ -88,6 +181,13 @@ class Spec(Device):
     BackDoorPort = device_property(dtype=int, default_value=0,
         doc="gevent backdoor port")
 
+    MetricsPort = device_property(dtype=int, default_value=0,
+        doc="HTTP port of the metrics (Prometheus text format). "
+            "0 means disabled")
+
+    MetricsHost = device_property(dtype=str, default_value="127.0.0.1",
+        doc="interface the metrics HTTP server listens on")
+
     Counters = device_property(dtype=[str], default_value=[],
         doc="List of registered SPEC counters to create "
             "(examples: mon, det, i0). "
@@ -98,6 +198,99 @@ class Spec(Device):
             "(examples: myvar, mayarr, A). "
             "Internal property. Not to be set by user")
 
+    WorkerThreads = device_property(dtype=int, default_value=2,
+        doc="Number of threads of the tango worker (device creation and "
+            "deletion). Only taken into account at server startup")
+
+    WorkerQueueMaxSize = device_property(dtype=int, default_value=1000,
+        doc="Maximum number of pending tasks per tango worker thread. "
+            "Only taken into account at server startup")
+
+    StatusEventBatchInterval = device_property(dtype=float, default_value=0,
+        doc="Interval (s) during which status events of all devices of the "
+            "server are batched (only the last status of each device is "
+            "sent). 0 disables batching")
+
+    EventRateWindow = device_property(dtype=int, default_value=60,
+        doc="Sliding window (s) over which the event rates of the "
+            "attributes (see HotAttributes) are computed")
+
+    ConnectBatchSize = device_property(dtype=int, default_value=20,
+        doc="Maximum number of elements (motors, counters, variables) "
+            "connecting to SPEC at the same time")
+
+    ConnectMaxRetryDelay = device_property(dtype=float, default_value=30,
+        doc="Maximum delay (s) between two connection attempts of an "
+            "element to SPEC")
+
+    ConversionPoolSize = device_property(dtype=int, default_value=0,
+        doc="Number of processes converting large variable values (JSON "
+            "encoding/decoding). 0 means values are converted in the server "
+            "process. Only taken into account at server startup")
+
+    ConversionThreshold = device_property(dtype=int, default_value=1048576,
+        doc="Minimum estimated size (bytes) of a variable value to be "
+            "converted by the conversion processes")
+
+    LoopMonitorInterval = device_property(dtype=float, default_value=0,
+        doc="Interval (s) at which the gevent loop latency is measured "
+            "(must be smaller than BlockingThreshold). 0 (default) "
+            "disables the loop monitor")
+
+    BlockingThreshold = device_property(dtype=float, default_value=0.5,
+        doc="Time (s) after which a greenlet which does not give control "
+            "back to the gevent loop is reported (with its stack)")
+
+    ProfileDirectory = device_property(dtype=str, default_value="",
+        doc="Directory where StopProfiling saves the cProfile statistics. "
+            "Empty string means the system temporary directory")
+
+    ShardMap = device_property(dtype=[str], default_value=[],
+        doc="Shard of SPEC elements in sharded mode (examples: 'th 0', "
+            "'tth 1'). Elements not listed are assigned by hash of their "
+            "SPEC name")
+
+    ReconfigChannels = device_property(dtype=[str],
+        default_value=["var/MOTORS", "var/COUNTERS"],
+        doc="SPEC channels signaling a possible configuration change "
+            "(reconfig). On update the cached SPEC motor/counter lists are "
+            "read again and compared to the previous ones. Status channels "
+            "signal when they become true")
+
+    AutoReconstruct = device_property(dtype=bool, default_value=False,
+        doc="Reconstruct automatically when SPEC configuration changes")
+
+    SnapshotFile = device_property(dtype=str, default_value="",
+        doc="Local file where the SPEC metadata (motor/counter lists, "
+            "variables) and the last known values are saved (periodically "
+            "and on shutdown). At start they are served from it until SPEC "
+            "confirms them. Empty string disables the snapshot")
+
+    SnapshotInterval = device_property(dtype=float, default_value=60,
+        doc="Interval (s) between two snapshot saves. 0 means the snapshot "
+            "is only saved on shutdown")
+
+    SnapshotQuality = device_property(dtype=str, default_value="ATTR_INVALID",
+        doc="Quality of the values served from the snapshot")
+
+    ScanDataVariable = device_property(dtype=str, default_value="",
+        doc="SPEC scan data array to publish (example: SCAN_D). "
+            "Empty string disables scan data publishing")
+
+    ScanPointsVariable = device_property(dtype=str, default_value="NPTS",
+        doc="SPEC variable with the number of points of the current scan")
+
+    ScanColumns = device_property(dtype=[str], default_value=[],
+        doc="Names of the scan data array columns (examples: tth, mon, det)")
+
+    DataFileVariable = device_property(dtype=str, default_value="DATAFILE",
+        doc="SPEC variable with the name of the current data file. "
+            "Empty string disables data file access")
+
+    DataFileIndexDirectory = device_property(dtype=str, default_value="",
+        doc="Directory of the data file scan indexes. Empty string means "
+            "the directory of the data file")
+
     ## Attribute containning the list of all SPEC_ motors
     SpecMotorList = str_1D_attr(doc="List of all SPEC motors")
 
@@ -113,6 +306,31 @@ class Spec(Device):
     ## Attribute containning the list of SPEC_ variables exported to TANGO_
     VariableList = str_1D_attr(doc="List of SPEC variables")
 
+    ## Attribute containning the counter values of the last CountAll
+    CounterValues = str_1D_attr(doc="List of counter values (<counter> "
+                                    "<value>) from the last CountAll")
+
+    ## Scan data column names
+    ScanColumnNames = str_1D_attr(doc="List of scan data column names")
+
+    ## Number of points of the current scan
+    ScanPointCount = attribute(dtype=int, access=AttrWriteType.READ,
+                               doc="number of points of the current scan")
+
+    ## Data of the current scan
+    ScanData = attribute(dtype=((float,),), access=AttrWriteType.READ,
+                         max_dim_x=1024, max_dim_y=65535,
+                         doc="data of the current scan (one row per point)")
+
+    ## Last scan points (events are fired only with the new rows)
+    ScanNewData = attribute(dtype=((float,),), access=AttrWriteType.READ,
+                            max_dim_x=1024, max_dim_y=65535,
+                            doc="last scan points (one row per point)")
+
+    ## Current SPEC data file
+    DataFile = attribute(dtype=str, access=AttrWriteType.READ,
+                         doc="current SPEC data file")
+
     ## Spec output
     Output = attribute(dtype=str, access=AttrWriteType.READ,
                        display_level=DispLevel.EXPERT)
@@ -121,6 +339,85 @@ class Spec(Device):
     CommandHistory = str_1D_attr(doc="List of spec commands executed from "
                                  "this server")
 
+    ## Tango worker statistics
+    WorkerQueueDepth = attribute(dtype=int, access=AttrWriteType.READ,
+                                 display_level=DispLevel.EXPERT,
+                                 doc="number of pending tango worker tasks")
+
+    WorkerTaskLatency = attribute(dtype=(float,), max_dim_x=5,
+                                  access=AttrWriteType.READ, unit="s",
+                                  display_level=DispLevel.EXPERT,
+                                  doc="tango worker task latency from "
+                                      "submission to end of execution "
+                                      "(last, mean, min, max, nb. tasks)")
+
+    WorkerFailedTasks = attribute(dtype=int, access=AttrWriteType.READ,
+                                  display_level=DispLevel.EXPERT,
+                                  doc="number of failed tango worker tasks")
+
+    WorkerCoalescedTasks = attribute(dtype=int, access=AttrWriteType.READ,
+                                     display_level=DispLevel.EXPERT,
+                                     doc="number of tango worker tasks "
+                                         "merged into a pending task")
+
+    ConnectAttempts = attribute(dtype=int, access=AttrWriteType.READ,
+                                display_level=DispLevel.EXPERT,
+                                doc="number of element connection attempts "
+                                    "to SPEC")
+
+    ConnectFailures = attribute(dtype=int, access=AttrWriteType.READ,
+                                display_level=DispLevel.EXPERT,
+                                doc="number of failed element connection "
+                                    "attempts to SPEC")
+
+    PendingConnections = attribute(dtype=int, access=AttrWriteType.READ,
+                                   display_level=DispLevel.EXPERT,
+                                   doc="number of element connections to "
+                                       "SPEC waiting to be made")
+
+    ReconnectDuration = attribute(dtype=(float,), max_dim_x=5,
+                                  access=AttrWriteType.READ, unit="s",
+                                  display_level=DispLevel.EXPERT,
+                                  doc="time for all elements to be connected "
+                                      "to SPEC (last, mean, min, max, nb. "
+                                      "reconnections)")
+
+    SuppressedEvents = attribute(dtype=int, access=AttrWriteType.READ,
+                                 display_level=DispLevel.EXPERT,
+                                 doc="number of state/status events of all "
+                                     "devices of the server not sent "
+                                     "because nothing changed or because "
+                                     "of status batching")
+
+    OffloadedConversions = attribute(dtype=int, access=AttrWriteType.READ,
+                                     display_level=DispLevel.EXPERT,
+                                     doc="number of variable value "
+                                         "conversions done by the "
+                                         "conversion processes")
+
+    LoopLatency = attribute(dtype=(float,), max_dim_x=5,
+                            access=AttrWriteType.READ, unit="s",
+                            display_level=DispLevel.EXPERT,
+                            doc="gevent loop latency (p50, p90, p99, max, "
+                                "nb. samples)")
+
+    BlockedLoops = attribute(dtype=int, access=AttrWriteType.READ,
+                             display_level=DispLevel.EXPERT,
+                             doc="number of times a greenlet blocked the "
+                                 "gevent loop longer than the "
+                                 "BlockingThreshold")
+
+    ## SPEC session channel statistics
+    ChannelStatistics = str_1D_attr(display_level=DispLevel.EXPERT,
+                                    doc="SPEC session channel statistics "
+                                        "(<channel> <messages in> <messages "
+                                        "out> <bytes in> <bytes out> "
+                                        "<callback time (s)>)")
+
+    SessionObjects = str_1D_attr(display_level=DispLevel.EXPERT,
+                                 doc="number of SpecClient objects sharing "
+                                     "the SPEC session (<type> <number>)")
+
     ## Version: TangoSpec version
     Version = attribute(dtype=str, access=AttrWriteType.READ)
 
@@ -133,13 +430,37 @@ class Spec(Device):
     def get_spec(self):
         return self.__spec
 
+    def get_spec_session(self):
+        return self.Spec
+
+    def wait_shards(self):
+        """In sharded mode, waits for the elements existing in the shards
+        to be registered"""
+        if self.__shards_synced is not None:
+            self.__shards_synced.wait()
+
     @DebugIt()
     def delete_device(self):
         Device.delete_device(self)
+        if self.__snapshot is not None:
+            self.__closeSnapshot()
+        registry.unregister(self)
+        forget_device(self)
         self.__spec_mgr = None
         self.__spec = None
         self.__spec_tty = None
-        self.__variables = None
+        for var_tango_name in self.__variables:
+            self.__scheduler.cancel(self.__variableConnectionName(
+                var_tango_name))
+        self.__variables = {}
+        self.__scan_data_var = None
+        self.__scan_points_var = None
+        self.__data_file_var = None
+        self.__reconfig_channels = None
+        if self.__reconstruct_task is not None:
+            self.__reconstruct_task.kill(block=False)
+        if self.__profiler.running:
+            self.__profiler.stop()
         if self.__backdoor:
             self.__backdoor.stop()
 
@@ -156,12 +477,39 @@ class Spec(Device):
         self.__spec = None
         self.__spec_tty = None
         self.__output = []
-        # dict<tango attr name: [SpecVariable, callback, info, enc_f, dec_f]>
+        # dict<tango attr name: [SpecVariable, callbacks, info, enc_f, dec_f]>
         self.__variables = dict()
         self.__executing_commands = dict()
         self.__command_history = []
+        self.__counter_values = []
+        # dict<etype: list<spec element names>>
+        self.__spec_elements = dict()
+        self.__reconfig_channels = dict()
+        self.__reconstruct_task = None
+        self.__scan_data_var = None
+        self.__scan_points_var = None
+        self.__scan_data = None
+        self.__scan_npts = 0
+        self.__scan_point_count = 0
+        self.__scan_new_data = None
+        self.__data_file_var = None
+        self.__data_file_name = ""
         self.__backdoor = None
         self.__backdoor_greenlet = None
+        self.__snapshot = None
+        self.__snapshot_task = None
+        self.__confirm_task = None
+        # dict<etype: list<spec element names>> not confirmed by SPEC yet
+        self.__snapshot_elements = dict()
+        # dict<(etype, spec name): element info> of the devices to be
+        # created by a pending worker task. Changed by the gevent hub and
+        # the tango worker thread
+        self.__pending_creations = dict()
+        self.__pending_lock = threading.Lock()
+        # dict<tango attr name: dict(info, value)> from the snapshot
+        self.__snapshot_values = dict()
+        # dict<tango attr name: last value> (only with a snapshot)
+        self.__variable_values = None
 
         self.set_change_event("State", True, True)
         self.set_change_event("Status", True, False)
@@ -170,8 +518,60 @@ class Spec(Device):
         self.set_change_event("CounterList", True, False)
         self.set_change_event("VariableList", True, False)
         self.set_change_event("CommandHistory", True, False)
+        self.set_change_event("CounterValues", True, False)
+        self.set_change_event("ScanPointCount", True, False)
+        self.set_change_event("ScanNewData", True, False)
 
         switch_state(self, DevState.INIT, "Initializing spec " + self.Spec)
+        registry.register(self)
+        set_status_batch_interval(self.StatusEventBatchInterval)
+        set_event_window(self.EventRateWindow)
+        self.__tango_worker = TangoWorker(spec_name,
+                                          size=max(self.WorkerThreads, 1),
+                                          max_queue_size=self.WorkerQueueMaxSize)
+        self.__conversion_pool = ConversionPool(
+            size=self.ConversionPoolSize, threshold=self.ConversionThreshold)
+        self.__session = get_session(spec_name, backend=self.Backend)
+        self.__scheduler = self.__session.scheduler
+        self.__profiler = Profiler(self.__session)
+        self.__loop_monitor = get_loop_monitor(
+            interval=self.LoopMonitorInterval,
+            threshold=self.BlockingThreshold)
+        if self.LoopMonitorInterval > 0:
+            try:
+                self.__loop_monitor.start()
+            except ValueError as error:
+                err("Loop monitor not started: %s", error)
+        self.__command_seconds = command_seconds.labels(spec_name)
+        if self.SnapshotFile:
+            self.__openSnapshot()
+        if self.MetricsPort:
+            start_metrics_server(self.MetricsPort, host=self.MetricsHost)
+        self.__scheduler.configure(batch_size=max(self.ConnectBatchSize, 1),
+                                   max_delay=self.ConnectMaxRetryDelay)
+        shard_map = dict((name, int(index)) for name, index in
+                         (item.split() for item in self.ShardMap))
+        self.__shards = None
+        if _SHARDED:
+            from TangoSpec.SpecShard import get_shard_router
+            self.__shards = get_shard_router(shard_map)
+        self.__shards_synced = None
+        if self.__shards is not None:
+            self.__shards_synced = self.__tango_worker.execute(
+                self.__syncShards)
+
+        if self.__session.simulator is not None and self.SimConfig:
+            try:
+                self.__session.simulator.load(self.SimConfig)
+            except (IOError, ValueError):
+                err("Error loading simulator configuration %s",
+                    self.SimConfig)
+                dbg("Details:", exc_info=1)
+                status = "Invalid simulator configuration '{0}'".format(
+                    self.SimConfig)
+                switch_state(self, DevState.FAULT, status)
+                self.__constructing = False
+                return
 
         try:
             spec_host, spec_session = spec_name.split(":")
@@ -188,8 +588,9 @@ class Spec(Device):
         # Create asynchronous spec access to get the data
         try:
             dbg("Creating SPEC object...")
-            self.__spec = _Spec.Spec()
-            self.__spec.connectToSpec(spec_name, timeout=.25)
+            self.__spec = self.__session.spec()
+            with startup_phase("SPEC connection"):
+                self.__spec.connectToSpec(spec_name, timeout=.25)
             dbg("Finished creating SPEC object")
         except SpecClientError as spec_error:
             err("Error creating SPEC object")
@@ -200,6 +601,7 @@ class Spec(Device):
             return
 
         if self.BackDoorPort:
+            from gevent.backdoor import BackdoorServer
             listener = '127.0.0.1', self.BackDoorPort
             banner = "Welcome to TangoSpec '{0}' console".format(self.Spec)
             locals = dict(device=weakref.ref(self),
@@ -211,10 +613,13 @@ class Spec(Device):
         cb = dict(update=self.__onUpdateOutput)
         try:
             dbg("Creating SPEC tty channel...")
-            self.__spec_tty = SpecVariable.SpecVariableA(callbacks=cb)
-            self.__spec_tty.connectToSpec("output/tty", spec_name,
-                                          dispatchMode=SpecEventsDispatcher.FIREEVENT,
-                                          prefix=False)
+            self.__spec_tty = self.__session.variable("output/tty", cb,
+                                                      asynchronous=True,
+                                                      prefix=False)
+            with startup_phase("SPEC connection"):
+                self.__spec_tty.connectToSpec("output/tty", spec_name,
+                                              dispatchMode=SpecEventsDispatcher.FIREEVENT,
+                                              prefix=False)
             dbg("Finished creating SPEC tty channel")
             switch_state(self, DevState.ON, "Connected to spec " + spec_name)
         except SpecClientError as spec_error:
@@ -228,6 +633,31 @@ class Spec(Device):
         for variable in self.Variables:
             self.__addVariableInit(variable)
 
+        for channel in self.ReconfigChannels:
+            try:
+                self.__connectReconfigChannel(channel)
+            except SpecClientError as spec_error:
+                err("Error connecting to reconfig channel %s", channel)
+                dbg("Details:", exc_info=1)
+
+        if self.ScanDataVariable:
+            try:
+                self.__connectScanData()
+            except SpecClientError as spec_error:
+                err("Error connecting to scan data %s", self.ScanDataVariable)
+                dbg("Details:", exc_info=1)
+                status = "Error connecting to Spec {0} scan data".format(
+                    spec_name)
+                switch_state(self, DevState.FAULT, status)
+
+        if self.DataFileVariable:
+            try:
+                self.__connectDataFile()
+            except SpecClientError as spec_error:
+                err("Error connecting to data file variable %s",
+                    self.DataFileVariable)
+                dbg("Details:", exc_info=1)
+
         if self.AutoDiscovery and not self.__constructing:
             self.Reconstruct()
         self.__constructing = False
@@ -242,7 +672,7 @@ class Spec(Device):
             info['name'], info['attr_name'] = variable_info[:2]
 
         try:
-            self.__addVariable(info)
+            self.__addVariable(info, scheduled=True)
         except SpecClientError as spec_error:
             self.__log.error("Error creating variable %s", variable_info[0])
             self.__log.debug("Details:", exc_info=1)
@@ -250,6 +680,146 @@ class Spec(Device):
                                                       str(spec_error))
             switch_state(self, DevState.FAULT, self.get_status + "\n" + msg)
 
+    def __connectReconfigChannel(self, channel):
+        # the first update is the current value sent on registration
+        initial = [True]
+        def update(value):
+            if initial:
+                del initial[:]
+            elif value or not channel.startswith("status/"):
+                # status channels (ex: status/ready) signal when they
+                # become true (ex: SPEC ready after a reconfig)
+                self.__onReconfig(channel)
+        cb = dict(update=update)
+        reconfig_channel = self.__session.variable(channel, cb,
+                                                   asynchronous=True,
+                                                   prefix=False)
+        self.__reconfig_channels[channel] = reconfig_channel
+        reconfig_channel.connectToSpec(channel, self.Spec,
+                                       dispatchMode=SpecEventsDispatcher.FIREEVENT,
+                                       prefix=False)
+
+    def __onReconfig(self, channel):
+        self.__log.debug("SPEC configuration may have changed (%s)", channel)
+        # several reconfig channels may fire for the same reconfig:
+        # postpone the check to do it only once
+        task = self.__reconstruct_task
+        if task is not None:
+            task.kill(block=False)
+        self.__reconstruct_task = gevent.spawn_later(0.5, self.__checkReconfig)
+
+    def __checkReconfig(self):
+        # a reconfig may change the motors/counters without changing their
+        # number: compare the mnemonic lists with the cached ones. Lists
+        # which are not cached are read when needed: nothing to compare
+        self.__reconstruct_task = None
+        changed = []
+        for etype, cached in list(self.__spec_elements.items()):
+            self.__spec_elements.pop(etype, None)
+            try:
+                elements = self.get_spec_elements(etype)
+            except SpecClientError:
+                self.__log.warning("Failed to read SPEC %s list after a "
+                                   "reconfig", etype.lower())
+                self.__log.debug("Details:", exc_info=1)
+                continue
+            if list(elements) != list(cached):
+                changed.append(etype.lower() + "s")
+        if not changed:
+            return
+        self.__log.info("SPEC configuration changed (%s)", ", ".join(changed))
+        if self.AutoReconstruct:
+            reconstruct(self)
+
+    def get_spec_elements(self, etype):
+        """
+        Returns the (cached) list of SPEC_ element names. The cache is
+        invalidated when SPEC_ configuration changes.
+
+        :param etype: element type ('Motor' or 'Counter')
+        :type etype: str
+        :return: list of SPEC_ element names
+        :rtype: list<str>
+        """
+        elements = self.__spec_elements.get(etype)
+        if elements is None:
+            get_f_name = "get{0}sMne".format(etype)
+            elements = getattr(self.__spec, get_f_name)()
+            self.__spec_elements[etype] = elements
+            self.__snapshot_elements.pop(etype, None)
+            if self.__snapshot is not None:
+                self.__snapshot.set(ELEMENTS, etype, list(elements))
+        return elements
+
+    def invalidate_spec_elements(self):
+        """Invalidates the cached lists of SPEC_ element names"""
+        self.__spec_elements.clear()
+
+    def __connectScanData(self):
+        dbg = self.__log.debug
+        dbg("Creating SPEC scan data channels...")
+        cb = dict(update=self.__onUpdateScanData)
+        self.__scan_data_var = self.__session.variable(self.ScanDataVariable,
+                                                       cb, asynchronous=True)
+        self.__scan_data_var.connectToSpec(self.ScanDataVariable, self.Spec,
+                                           dispatchMode=SpecEventsDispatcher.FIREEVENT)
+        cb = dict(update=self.__onUpdateScanPoints)
+        self.__scan_points_var = self.__session.variable(
+            self.ScanPointsVariable, cb, asynchronous=True)
+        self.__scan_points_var.connectToSpec(self.ScanPointsVariable, self.Spec,
+                                             dispatchMode=SpecEventsDispatcher.FIREEVENT)
+        dbg("Finished creating SPEC scan data channels")
+
+    def __connectDataFile(self):
+        cb = dict(update=self.__onUpdateDataFile)
+        self.__data_file_var = self.__session.variable(self.DataFileVariable,
+                                                       cb, asynchronous=True)
+        self.__data_file_var.connectToSpec(self.DataFileVariable, self.Spec,
+                                           dispatchMode=SpecEventsDispatcher.FIREEVENT)
+
+    def __onUpdateDataFile(self, name):
+        self.__data_file_name = str(name)
+        self.__log.debug("Data file: %s", self.__data_file_name)
+
+    def __getDataFile(self):
+        name = self.__data_file_name
+        if not name or name == "/dev/null":
+            raise ValueError("No SPEC data file")
+        return get_data_file(name,
+                             index_directory=self.DataFileIndexDirectory or None)
+
+    def __onUpdateScanData(self, data):
+        import numpy
+        self.__scan_data = numpy.atleast_2d(data)
+        self.__publishScanPoints()
+
+    def __onUpdateScanPoints(self, npts):
+        npts = int(npts)
+        if npts < self.__scan_point_count:
+            # a new scan started
+            self.__log.debug("New scan started")
+            self.__scan_point_count = 0
+            self.__scan_new_data = None
+            push_event(self, "ScanPointCount", 0)
+        self.__scan_npts = npts
+        self.__publishScanPoints()
+
+    def __publishScanPoints(self):
+        """Fires events with the scan points that are available in both the
+        scan data array and the number of points variable and were not
+        published yet"""
+        data = self.__scan_data
+        if data is None:
+            return
+        start = self.__scan_point_count
+        end = min(self.__scan_npts, len(data))
+        if end <= start:
+            return
+        self.__scan_new_data = data[start:end]
+        self.__scan_point_count = end
+        push_event(self, "ScanNewData", self.__scan_new_data)
+        push_event(self, "ScanPointCount", end)
+
     def __onUpdateOutput(self, output):
         if isinstance(output, numbers.Number):
             text = "{0:12}\n".format(output)
@@ -274,11 +844,23 @@ class Spec(Device):
         self.__output.append(text)
         while len(self.__output) > self.OutputBufferMaxLength:
             self.__output.pop(0)
-        self.push_change_event("Output", text)
+        push_event(self, "Output", text)
+
+    def __read_SpecElements(self, etype):
+        if etype not in self.__spec_elements:
+            elements = self.__snapshot_elements.get(etype)
+            if elements is not None:
+                # served from the snapshot until SPEC answers
+                if self.__confirm_task is None:
+                    self.__confirm_task = gevent.spawn(
+                        self.__confirmSpecElements)
+                return elements, self.__snapshot.time, \
+                       self.__snapshot.quality
+        return self.get_spec_elements(etype)
 
     @DebugIt()
     def read_SpecMotorList(self):
-        return self.__spec.getMotorsMne()
+        return self.__read_SpecElements("Motor")
 
     @DebugIt()
     def read_MotorList(self):
@@ -286,7 +868,7 @@ class Spec(Device):
 
     @DebugIt()
     def read_SpecCounterList(self):
-        return self.__spec.getCountersMne()
+        return self.__read_SpecElements("Counter")
 
     @DebugIt()
     def read_CounterList(self):
@@ -304,10 +886,19 @@ class Spec(Device):
     def read_Variable(self, attr):
         v_name = attr.get_name()
         spec_variable, _, info, spec_to_tango, _ = self.__variables[v_name]
+        values = self.__variable_values
+        if values is not None and v_name not in values:
+            snapshot_value = self.__snapshot_values.get(v_name)
+            if snapshot_value is not None and snapshot_value['info'] == info:
+                # no value from SPEC yet: serve the last known one
+                attr.set_value_date_quality(snapshot_value['value'],
+                                            self.__snapshot.time,
+                                            self.__snapshot.quality)
+                return
         worker = get_worker()
         with worker.get_context(self):
             value = worker.execute(self.__read_Variable, spec_variable)
-        value = spec_to_tango(value)
+        value = self.__conversion_pool.convert(spec_to_tango, value)
         attr.set_value(value)
 
     def __read_Variable(self, spec_variable):
@@ -318,7 +909,7 @@ class Spec(Device):
     def write_Variable(self, attr):
         v_name, value = attr.get_name(), attr.get_write_value()
         spec_variable, _, info, _, tango_to_spec = self.__variables[v_name]
-        value = tango_to_spec(value)
+        value = self.__conversion_pool.convert(tango_to_spec, value)
         worker = get_worker()
         with worker.get_context(self):
             worker.execute(self.__write_Variable, spec_variable, value)
@@ -327,9 +918,81 @@ class Spec(Device):
         self.__log.debug("set %s = %s", spec_variable.varName, value)
         spec_variable.setValue(value)
 
+    def read_CounterValues(self):
+        return self.__counter_values
+
+    def read_ScanColumnNames(self):
+        names = list(self.ScanColumns)
+        data = self.__scan_data
+        if data is not None:
+            ncols = data.shape[1]
+            names = names[:ncols] + ["col{0}".format(i)
+                                     for i in range(len(names), ncols)]
+        return names
+
+    def read_ScanPointCount(self):
+        return self.__scan_point_count
+
+    def read_ScanData(self):
+        data = self.__scan_data
+        if data is None:
+            return _empty_scan_data()
+        return data[:self.__scan_point_count]
+
+    def read_ScanNewData(self):
+        data = self.__scan_new_data
+        if data is None:
+            return _empty_scan_data()
+        return data
+
+    def read_DataFile(self):
+        return self.__data_file_name
+
     def read_CommandHistory(self):
         return self.__command_history
 
+    def read_WorkerQueueDepth(self):
+        return self.__tango_worker.queue_depth
+
+    def read_WorkerTaskLatency(self):
+        return self.__tango_worker.latency.summary()
+
+    def read_WorkerFailedTasks(self):
+        return self.__tango_worker.failed
+
+    def read_WorkerCoalescedTasks(self):
+        return self.__tango_worker.coalesced
+
+    def read_ConnectAttempts(self):
+        return self.__scheduler.attempts
+
+    def read_ConnectFailures(self):
+        return self.__scheduler.failures
+
+    def read_PendingConnections(self):
+        return self.__scheduler.pending
+
+    def read_ReconnectDuration(self):
+        return self.__scheduler.reconnect_duration.summary()
+
+    def read_SuppressedEvents(self):
+        return get_suppressed_events()
+
+    def read_OffloadedConversions(self):
+        return self.__conversion_pool.offloaded
+
+    def read_LoopLatency(self):
+        return self.__loop_monitor.latency.percentiles()
+
+    def read_BlockedLoops(self):
+        return self.__loop_monitor.blocked
+
+    def read_ChannelStatistics(self):
+        return self.__session.get_channel_statistics()
+
+    def read_SessionObjects(self):
+        return self.__session.get_object_statistics()
+
     def read_Version(self):
         import TangoSpec
         return TangoSpec.__version__
@@ -340,13 +1003,14 @@ class Spec(Device):
 
     def _execute_cmd(self, cmd, wait=True):
         try:
-            spec_cmd = SpecCommand.SpecCommand(None, self.Spec)
+            spec_cmd = self.__session.command()
         except SpecClientError as error:
             status = "Spec %s error: %s" % (self.Spec, error)
             switch_state(self, DevState.FAULT, status)
 
         if wait:
-            result = str(spec_cmd.executeCommand(cmd))
+            with timed(self.__command_seconds):
+                result = str(spec_cmd.executeCommand(cmd))
         else:
             task = spec_cmd.executeCommand(cmd, wait=False)
             self.__executing_commands[id(spec_cmd)] = task, cmd, spec_cmd
@@ -456,7 +1120,7 @@ class Spec(Device):
         variables = self.__get_VariableListEx()
         db.put_device_property(self.get_name(), {"Variables" : variables})
 
-        self.push_change_event("VariableList", variables)
+        push_event(self, "VariableList", variables)
         self.__log.info("Finished adding new variable")
 
     @command(dtype_in=str, doc_in="spec variable name")
@@ -480,6 +1144,10 @@ class Spec(Device):
                             (var_name,))
 
         del self.__variables[tango_var_name]
+        self.__scheduler.cancel(self.__variableConnectionName(tango_var_name))
+        self.__snapshot_values.pop(tango_var_name, None)
+        if self.__variable_values is not None:
+            self.__variable_values.pop(tango_var_name, None)
         self.remove_attribute(tango_var_name)
 
         # update property in the database
@@ -487,7 +1155,7 @@ class Spec(Device):
         variables = self.__get_VariableListEx()
         db.put_device_property(self.get_name(), {"Variables" : variables})
 
-        self.push_change_event("VariableList", variables)
+        push_event(self, "VariableList", variables)
         self.__log.info("Finished removing variable")
 
     @command(dtype_in=[str],
@@ -591,20 +1259,246 @@ class Spec(Device):
         self.__removeElement("Counter", counter_name)
 
 
+    @command(dtype_in=CmdArgType.DevVarDoubleStringArray,
+             doc_in="([count time (s)], [spec counter names])",
+             dtype_out=CmdArgType.DevVarDoubleStringArray,
+             doc_out="([counter values], [spec counter names])")
+    def CountAll(self, count_info):
+        """
+        Count by the specified time (s) with a single SPEC_ count and
+        return the values of the given exported counters.
+
+        When the count finishes, a single event is fired on the
+        CounterValues attribute with all the counter values.
+
+        :param count_info:
+            ([count_time], [counter names]). An empty list of counter
+            names means all counters exported to TANGO_
+        :return: ([counter values], [counter names])
+
+        Examples::
+
+            spec = PyTango.DeviceProxy("ID00/spec/fourc")
+            values, names = spec.CountAll(([0.1], ["mon", "det"]))
+
+        :throws PyTango.DevFailed:
+            If one of the counters is not exported to TANGO_
+        """
+        count_times, counter_names = count_info
+        if len(count_times) != 1:
+            raise ValueError("Expected exactly one count time")
+        count_time = float(count_times[0])
+
+        if not counter_names:
+            counter_names = sorted(registry.get_spec_names("SpecCounter",
+                                                           self.Spec))
+        counters = {}
+        for counter_name in counter_names:
+            counter = registry.get_device_by_spec_name("SpecCounter",
+                                                       counter_name, self.Spec)
+            if counter is None:
+                raise KeyError("No counter with name '{0}'".format(counter_name))
+            counters[counter_name] = counter
+
+        self.__log.debug("Counting %s on %s...", count_time,
+                         ", ".join(counter_names))
+        self._execute_cmd("count_em {0!r}; waitcount; get_counts".format(
+                          count_time))
+        values = [self.__getCounterValue(counters[name])
+                  for name in counter_names]
+
+        self.__counter_values = ["{0} {1}".format(name, value)
+                                 for name, value in zip(counter_names, values)]
+        push_event(self, "CounterValues", self.__counter_values)
+        self.__log.debug("Finished counting")
+        return values, counter_names
+
+    @command(dtype_in=CmdArgType.DevVarDoubleStringArray,
+             doc_in="([scan number], [column names])",
+             dtype_out=CmdArgType.DevVarDoubleStringArray,
+             doc_out="([scan data (one row per point)], [column names])")
+    def GetScan(self, scan_info):
+        """
+        Read a scan from the current SPEC_ data file.
+
+        The data file is memory mapped and the offsets of its scans are
+        kept in an index file (updated incrementally with the scans
+        appended since the last access), so the scans of large files are
+        read without parsing the whole file.
+
+        :param scan_info:
+            ([scan number], [column names]). A negative scan number counts
+            from the end of the file (-1 is the last scan). If the number
+            was used several times, the last scan with this number is
+            returned. An empty list of column names means all columns
+        :return:
+            ([scan data], [column names]). The data is flattened: reshape
+            it with the number of columns
+
+        Examples::
+
+            spec = PyTango.DeviceProxy("ID00/spec/fourc")
+            data, names = spec.GetScan(([12], ["th", "det"]))
+            data = data.reshape(-1, len(names))
+
+        :throws PyTango.DevFailed:
+            If there is no such scan or column
+        """
+        scan_numbers, columns = scan_info
+        if len(scan_numbers) != 1:
+            raise ValueError("Expected exactly one scan number")
+        data_file = self.__getDataFile()
+        names, data = execute_data_file(data_file.get_scan,
+                                        int(scan_numbers[0]), columns)
+        return data.ravel(), names
+
+    @command(dtype_in=[int], doc_in="[first scan number, last scan number] "
+                                    "(empty list means all scans)",
+             dtype_out=[str], doc_out="list of <scan number> <scan command>")
+    def ListScans(self, scan_range):
+        """
+        List the scans of the current SPEC_ data file
+
+        :param scan_range:
+            [first, last] scan numbers (included), [first] or empty list
+            for all scans
+        :return: list of ``<scan number> <scan command>``
+        """
+        first = scan_range[0] if len(scan_range) > 0 else None
+        last = scan_range[1] if len(scan_range) > 1 else None
+        data_file = self.__getDataFile()
+        scans = execute_data_file(data_file.list_scans, first, last)
+        return ["{0} {1}".format(number, cmd) for number, cmd in scans]
+
+    @command
+    def StartProfiling(self):
+        """
+        Start profiling the server: function statistics, CPU time per
+        greenlet and SPEC_ callback time per channel. Use
+        :meth:`~Spec.StopProfiling` to get the results.
+
+        :throws PyTango.DevFailed:
+            If the profiler is already running
+        """
+        self.__log.info("Start profiling")
+        self.__profiler.start()
+
+    @command(dtype_in=str, doc_in="file name (in ProfileDirectory) to save "
+                                  "the cProfile statistics (empty string: "
+                                  "don't save)",
+             dtype_out=str, doc_out="profiling report")
+    def StopProfiling(self, filename):
+        """
+        Stop profiling the server and return the report (CPU time per
+        greenlet, SPEC_ callback time per channel and top functions).
+
+        :param filename:
+            name of the file where to save the cProfile statistics (pstats
+            format) or empty string. Only the base name is used: the file
+            is saved in the ``ProfileDirectory``
+        :return: the profiling report
+
+        Examples::
+
+            spec = PyTango.DeviceProxy("ID00/spec/fourc")
+            spec.StartProfiling()
+            # ... wait for the slow operation ...
+            print(spec.StopProfiling("tangospec.prof"))
+
+        :throws PyTango.DevFailed:
+            If the profiler is not running
+        """
+        self.__log.info("Stop profiling")
+        if filename:
+            filename = self.__profileFilename(filename)
+        return self.__profiler.stop(filename=filename or None)
+
+    def __profileFilename(self, filename):
+        # never let a client choose where the server writes
+        name = os.path.basename(filename)
+        if name in ("", ".", ".."):
+            raise ValueError("Invalid profile file name '{0}'".format(
+                filename))
+        directory = self.ProfileDirectory or tempfile.gettempdir()
+        return os.path.join(directory, name)
+
+    @command
+    def ResetChannelStatistics(self):
+        """
+        Reset the SPEC_ session channel statistics
+        """
+        self.__session.reset_statistics()
+
+    @command(dtype_in=int, dtype_out=[str],
+             display_level=DispLevel.EXPERT)
+    def HotAttributes(self, n):
+        """
+        Returns the attributes of all devices of the server which pushed
+        the most events over the last ``EventRateWindow`` seconds
+        (``<device> <attribute> <events/s> <bytes/s>``)
+
+        :param n: maximum number of attributes (0 means all)
+        :type n: int
+        """
+        return get_hot_attributes(n or None)
+
     @command
     def Reconstruct(self):
         """
         Exposes to Tango all counters and motors that where found
         in SPEC.
         """
+        self.invalidate_spec_elements()
         reconstruct(self)
 
     #
     # Helper methods
     #
 
-    def __execute(self, f, *args, **kwargs):
-        self.__tango_worker.execute(f, *args, **kwargs)
+    def __getCounterValue(self, counter):
+        spec_counter = getattr(counter, "spec_counter", None)
+        if spec_counter is not None:
+            return spec_counter.getValue()
+        # counter of a shard process
+        return self.__tango_worker.execute(counter.read_value).result()
+
+    def __syncShards(self):
+        self.__shards.sync(self.Spec)
+        self.__pushElementList("Motor")
+        self.__pushElementList("Counter")
+
+    def __executeElements(self, etype, elements=(), dev_names=()):
+        """Creates (elements) and deletes (dev_names) TANGO_ devices in the
+        tango worker, after the previous tasks on the same element type"""
+        task = _ElementsTask(self.get_name(), etype,
+                             partial(self.__addElementsTango, etype),
+                             partial(self.__removeElementsTango, etype),
+                             partial(self.__pushElementList, etype))
+        with self.__pending_lock:
+            for element in elements:
+                task.add(element)
+                self.__pending_creations[(etype, element[0])] = element
+        for dev_name in dev_names:
+            task.remove(dev_name)
+        return self.__tango_worker.submit(etype, task)
+
+    def __getElementDeviceName(self, etype, spec_name):
+        """Returns the name of the device of a SPEC element, pending
+        creation first (so its removal cancels the creation), or None"""
+        with self.__pending_lock:
+            element = self.__pending_creations.pop((etype, spec_name), None)
+        if element is not None:
+            return element[1]
+        device = registry.get_device_by_spec_name("Spec" + etype, spec_name,
+                                                  self.Spec)
+        return None if device is None else device.get_name()
+
+    def __isPendingCreation(self, etype, spec_name):
+        with self.__pending_lock:
+            return (etype, spec_name) in self.__pending_creations
+
+    def __pushElementList(self, etype):
+        push_event(self, etype + "List", self.__get_ElementList(etype))
 
     def __addElement(self, etype, element_info):
         dev_type = "Spec" + etype
@@ -612,20 +1506,29 @@ class Spec(Device):
         spec_name = element_info[0]
         self.__log.info("Adding new %s '%s'...", etype_lower, spec_name)
 
-        get_f_name = "get{0}sMne".format(etype)
-        spec_elements = getattr(self.__spec, get_f_name)()
+        spec_elements = self.get_spec_elements(etype)
 
-        devices = Util.instance().get_device_list_by_class(dev_type)
-        for device in devices:
-            if device.get_spec_name() == spec_name:
-                raise ValueError("{0} '{1}' already registered".format(etype,
-                    spec_name))
+        if registry.get_device_by_spec_name(dev_type, spec_name,
+                                            self.Spec) is not None:
+            raise ValueError("{0} '{1}' already registered".format(etype,
+                spec_name))
+        if self.__isPendingCreation(etype, spec_name):
+            raise ValueError("{0} '{1}' already being added".format(etype,
+                spec_name))
 
         if not spec_name in spec_elements:
             Except.throw_exception("Spec_Unknown{0}".format(etype),
                 "Unknown {0} '{1}'".format(etype_lower, spec_name),
                 "Spec.Add{0}".format(etype))
 
+        self.__executeElements(etype,
+                               elements=[self.__getElementInfo(element_info)])
+        self.__log.info("Finished adding %s '%s'", etype_lower, spec_name)
+
+    def __getElementInfo(self, element_info):
+        """Returns (spec name, tango device name, tango alias) from the
+        given AddMotor/AddCounter argument"""
+        spec_name = element_info[0]
         if len(element_info) > 1:
             dev_name = element_info[1]
         else:
@@ -635,51 +1538,94 @@ class Spec(Device):
         element_alias = spec_name
         if len(element_info) > 2:
             element_alias = element_info[2]
+        return spec_name, dev_name, element_alias
 
-        execute(self.__addElementTango, etype, spec_name, dev_name,
-                element_alias)
-        self.__log.info("Finished adding %s '%s'", etype_lower, spec_name)
-
-    def __addElementTango(self, etype, spec_name, dev_name, dev_alias):
-        dev_type, attr = "Spec" + etype, etype + "List"
-        def cb(name):
-            db = Util.instance().get_database()
-            db.put_device_property(dev_name, {dev_type: spec_name})
-            try:
-                old_dev_name = db.get_device_alias(dev_alias)
-                self.__log.warning("%s already associated with device %s. "\
-                                   "Tango alias will NOT be created",
-                                   dev_alias, old_dev_name)
-            except DevFailed:
-                db.put_device_alias(dev_name, dev_alias)
+    def add_elements(self, etype, spec_names):
+        """
+        Exposes the given SPEC_ elements to TANGO_ with the default device
+        names and aliases. All devices are created in a single worker task
+        which fires a single list change event at the end (pending tasks
+        for the same element type are merged with it).
+
+        Contrary to :meth:`AddMotor`/:meth:`AddCounter`, the elements are
+        not checked against SPEC_ (the caller is expected to have done it).
+        Elements already being added are ignored.
+
+        :param etype: element type ('Motor' or 'Counter')
+        :type etype: str
+        :param spec_names: SPEC_ element names
+        :type spec_names: sequence<str>
+        """
+        elements = [self.__getElementInfo((spec_name,))
+                    for spec_name in spec_names
+                    if not self.__isPendingCreation(etype, spec_name)]
+        if elements:
+            self.__executeElements(etype, elements=elements)
 
-        Util.instance().create_device(dev_type, dev_name, cb=cb)
-        self.push_change_event(attr, self.__get_ElementList(etype))
+    def remove_elements(self, etype, spec_names):
+        """
+        Removes the given SPEC_ elements from this DS. All devices are
+        deleted in a single worker task which fires a single list change
+        event at the end. Unknown elements are ignored.
+
+        :param etype: element type ('Motor' or 'Counter')
+        :type etype: str
+        :param spec_names: SPEC_ element names
+        :type spec_names: sequence<str>
+        """
+        dev_names = [self.__getElementDeviceName(etype, spec_name)
+                     for spec_name in spec_names]
+        dev_names = [dev_name for dev_name in dev_names
+                     if dev_name is not None]
+        if dev_names:
+            self.__executeElements(etype, dev_names=dev_names)
+
+    def __addElementsTango(self, etype, elements):
+        try:
+            self.__createElementsTango(etype, elements)
+        finally:
+            # only the entries of this task: the element may have been
+            # removed and added again (a new entry) in the meantime
+            with self.__pending_lock:
+                for element in elements:
+                    key = etype, element[0]
+                    if self.__pending_creations.get(key) is element:
+                        del self.__pending_creations[key]
+
+    def __createElementsTango(self, etype, elements):
+        dev_type = "Spec" + etype
+        # the elements use the backend of the Spec (even if they are
+        # initialized first or in a shard process)
+        backend = "" if self.Backend == SPEC_BACKEND else self.Backend
+        if self.__shards is not None:
+            self.__shards.create_elements(dev_type, self.Spec, elements,
+                                          backend=backend)
+            return
+        # full name: unambiguous if the server has several Specs
+        elements = [("{0}:{1}".format(self.Spec, spec_name), dev_name,
+                     dev_alias) for spec_name, dev_name, dev_alias in elements]
+        properties = dict(Backend=backend) if backend else None
+        create_element_devices(dev_type, elements, log=self.__log,
+                               properties=properties)
 
     def __removeElement(self, etype, element_name):
         etype_lower = etype.lower()
-        dev_type = "Spec" + etype
         self.__log.info("Removing %s '%s'...", etype_lower, element_name)
-        devices = Util.instance().get_device_list_by_class(dev_type)
-        for device in devices:
-            if device.get_spec_name() == element_name:
-                dev_name = device.get_name()
-                execute(self.__removeElementTango, etype, dev_name)
-                break
-        else:
+        dev_name = self.__getElementDeviceName(etype, element_name)
+        if dev_name is None:
             raise KeyError("No {0} with name '{1}".format(etype_lower,
                                                           element_name))
+        self.__executeElements(etype, dev_names=[dev_name])
         self.__log.info("Finished removing %s '%s'", etype_lower, element_name)
 
-    def __removeElementTango(self, etype, dev_name):
-        dev_type, attr = "Spec" + etype, etype + "List"
-        Util.instance().delete_device(dev_type, dev_name)
-        self.push_change_event(attr, self.__get_ElementList(etype))
+    def __removeElementsTango(self, etype, dev_names):
+        dev_type = "Spec" + etype
+        if self.__shards is not None:
+            dev_names = self.__shards.delete_elements(dev_type, dev_names)
+        delete_element_devices(dev_type, dev_names, log=self.__log)
 
     def __get_ElementList(self, etype):
-        elements = Util.instance().get_device_list_by_class("Spec" + etype)
-        return ["{0} {1}".format(element.get_spec_name(), element.get_name())
-                for element in elements]
+        return registry.get_element_list("Spec" + etype, self.Spec)
 
     def __get_MotorList(self):
         return self.__get_ElementList("Motor")
@@ -701,7 +1647,7 @@ class Spec(Device):
             vl.append(json.dumps(info))
         return vl
 
-    def __addVariable(self, var_info):
+    def __addVariable(self, var_info, scheduled=False):
         var_name = str(var_info['name'])
         var_tango_name = str(var_info.get('attr_name', var_name))
         self.__log.debug("Adding variable %s as %s", var_name, var_tango_name)
@@ -741,15 +1687,133 @@ class Spec(Device):
         def update(value):
             self.__log.debug("start update variable '%s' value...", var_name)
             self.__log.debug("variable=%s (type=%s)", value, type(value))
-            value = spec_to_tango(value)
-            self.push_change_event(var_tango_name, value)
+            value = self.__conversion_pool.convert(spec_to_tango, value)
+            if self.__variable_values is not None:
+                self.__variable_values[var_tango_name] = value
+            push_event(self, var_tango_name, value)
             self.__log.debug("finish update variable '%s' value", var_name)
-        cb = dict(update=update)
-        v = SpecVariable.SpecVariable(callbacks=cb)
-        self.__variables[var_tango_name] = v, update, var_info, \
+        # the callbacks are kept here: SpecClient only keeps weak references
+        cb = dict(update=update,
+                  connected=partial(self.__onVariableConnected,
+                                    var_tango_name),
+                  disconnected=partial(self.__onVariableDisconnected,
+                                       var_tango_name))
+        v = self.__session.variable(var_name, cb)
+        self.__variables[var_tango_name] = v, cb, var_info, \
                                            spec_to_tango, tango_to_spec
-        v.connectToSpec(var_name, self.Spec,
-                        dispatchMode=SpecEventsDispatcher.FIREEVENT)
+        if scheduled:
+            self.__scheduler.schedule(self.__variableConnectionName(
+                var_tango_name), partial(self.__connectVariable,
+                                         var_tango_name))
+        else:
+            self.__connectVariable(var_tango_name)
+
+    def __variableConnectionName(self, var_tango_name):
+        return "{0}/{1}".format(self.get_name(), var_tango_name)
+
+    def __connectVariable(self, var_tango_name):
+        variable = self.__variables.get(var_tango_name)
+        if variable is None:
+            # removed in the meantime
+            return
+        spec_variable, var_info = variable[0], variable[2]
+        spec_variable.connectToSpec(str(var_info['name']), self.Spec,
+                                    dispatchMode=SpecEventsDispatcher.FIREEVENT)
+
+    def __onVariableConnected(self, var_tango_name):
+        self.__scheduler.connected(self.__variableConnectionName(
+            var_tango_name))
+
+    def __onVariableDisconnected(self, var_tango_name):
+        variable = self.__variables.get(var_tango_name)
+        if variable is None:
+            return
+        name = self.__variableConnectionName(var_tango_name)
+        self.__scheduler.disconnected(name)
+        # drop the SpecClient variable so it doesn't re-register its
+        # channel on its own when SPEC is back: the scheduler reconnects a
+        # new one in batches with the other elements of the session
+        cb, var_info = variable[1], variable[2]
+        spec_variable = self.__session.variable(str(var_info['name']), cb)
+        self.__variables[var_tango_name] = (spec_variable,) + variable[1:]
+        self.__scheduler.schedule(name, partial(self.__connectVariable,
+                                                var_tango_name))
+
+    def __openSnapshot(self):
+        snapshot = self.__snapshot = get_snapshot(self.Spec)
+        snapshot.open(self.SnapshotFile)
+        quality = AttrQuality.names.get(self.SnapshotQuality)
+        if quality is None:
+            self.__log.warning("Invalid SnapshotQuality '%s'. Using "
+                               "ATTR_INVALID", self.SnapshotQuality)
+            quality = AttrQuality.ATTR_INVALID
+        snapshot.quality = quality
+        if snapshot.time is None:
+            snapshot.time = time.time()
+        for etype in ("Motor", "Counter"):
+            elements = snapshot.get(ELEMENTS, etype)
+            if elements is not None:
+                self.__snapshot_elements[etype] = elements
+        self.__snapshot_values = dict(snapshot.get(VARIABLES,
+                                                   self.get_name(), {}))
+        self.__variable_values = dict()
+        if self.SnapshotInterval > 0:
+            self.__snapshot_task = gevent.spawn(self.__saveSnapshotLoop)
+
+    def __closeSnapshot(self):
+        if self.__snapshot_task is not None:
+            self.__snapshot_task.kill(block=False)
+        if self.__confirm_task is not None:
+            self.__confirm_task.kill(block=False)
+        try:
+            text = self.__collectSnapshot()
+            # file I/O (and fsync) out of the gevent loop. Wait for it
+            # (cooperatively): a new init reads the file
+            self.__tango_worker.execute(self.__snapshot.write, text).result()
+        except:
+            self.__log.warning("Failed to save snapshot")
+            self.__log.debug("Details:", exc_info=1)
+
+    def __confirmSpecElements(self):
+        try:
+            for etype in list(self.__snapshot_elements):
+                self.get_spec_elements(etype)
+        except:
+            self.__log.debug("Failed to get the SPEC elements", exc_info=1)
+        finally:
+            self.__confirm_task = None
+
+    def __collectSnapshot(self):
+        """Updates the snapshot with the values of this device and of its
+        elements and returns it as JSON text"""
+        snapshot = self.__snapshot
+        # values not confirmed by SPEC yet are kept
+        variables = dict(self.__snapshot_values)
+        for var_tango_name, value in list(self.__variable_values.items()):
+            variable = self.__variables.get(var_tango_name)
+            if variable is not None:
+                variables[var_tango_name] = dict(info=variable[2],
+                                                 value=value)
+        snapshot.set(VARIABLES, self.get_name(), variables)
+        for class_name, section in (("SpecMotor", MOTORS),
+                                    ("SpecCounter", COUNTERS)):
+            for device in registry.get_devices(class_name, self.Spec):
+                values = device.get_snapshot()
+                if values is not None:
+                    snapshot.set(section, device.get_spec_name(), values)
+        return snapshot.dumps()
+
+    def __saveSnapshotLoop(self):
+        while True:
+            gevent.sleep(self.SnapshotInterval)
+            try:
+                text = self.__collectSnapshot()
+            except:
+                self.__log.warning("Failed to collect snapshot")
+                self.__log.debug("Details:", exc_info=1)
+            else:
+                # file I/O out of the gevent loop
+                self.__tango_worker.execute(self.__snapshot.write, text)
 
     def __appendCommandHistory(self, cmd):
         """
@@ -763,7 +1827,7 @@ class Spec(Device):
         history.append(cmd)
         while len(history) > self.CommandHistoryMaxLength:
             history.pop(0)
-        self.push_change_event("CommandHistory", [cmd])
+        push_event(self, "CommandHistory", [cmd])
 
 
 
@@ -788,13 +1852,12 @@ def reconstruct(spec_dev):
     """
     log = logging.getLogger(spec_dev.get_name())
     log.debug("Reconstructing...")
-    spec = spec_dev.get_spec()
-    util = Util.instance()
-    get_class_devs = util.get_device_list_by_class
-    motor_devs = set([m.SpecMotor for m in get_class_devs("SpecMotor")])
-    counter_devs = set([m.SpecCounter for m in get_class_devs("SpecCounter")])
+    spec_dev.wait_shards()
+    session = spec_dev.get_spec_session()
+    motor_devs = set(registry.get_spec_names("SpecMotor", session))
+    counter_devs = set(registry.get_spec_names("SpecCounter", session))
 
-    spec_motors = set(spec.getMotorsMne())
+    spec_motors = set(spec_dev.get_spec_elements("Motor"))
     new_motors = spec_motors.difference(motor_devs)
     del_motors = motor_devs.difference(spec_motors)
     if new_motors:
@@ -805,12 +1868,10 @@ def reconstruct(spec_dev):
         log.debug("remove motors: %s", ", ".join(del_motors))
     else:
         log.debug("no motors to be removed")
-    for motor in new_motors:
-        spec_dev.AddMotor([motor])
-    for motor in del_motors:
-        spec_dev.RemoveMotor(motor)
+    spec_dev.remove_elements("Motor", del_motors)
+    spec_dev.add_elements("Motor", sorted(new_motors))
 
-    spec_counters = set(spec.getCountersMne())
+    spec_counters = set(spec_dev.get_spec_elements("Counter"))
     new_counters = spec_counters.difference(counter_devs)
     del_counters = counter_devs.difference(spec_counters)
     if new_counters:
@@ -821,21 +1882,38 @@ def reconstruct(spec_dev):
         log.debug("remove counters: %s", ", ".join(del_counters))
     else:
         log.debug("no counters to be removed")
-    for counter in new_counters:
-        spec_dev.AddCounter([counter])
-    for counter in del_counters:
-        spec_dev.RemoveCounter(counter)
+    spec_dev.remove_elements("Counter", del_counters)
+    spec_dev.add_elements("Counter", sorted(new_counters))
+
+
+def __reconstruct_init(spec_dev):
+    try:
+        reconstruct(spec_dev)
+    except:
+        log = logging.getLogger(spec_dev.get_name())
+        log.error("Failed to reconstruct")
+        log.debug("Details:", exc_info=1)
 
 
 def reconstruct_init():
-    util = Util.instance()
-    spec_devs = util.get_device_list_by_class("Spec")
-    if not spec_devs:
-        return
-    spec_dev = spec_devs[0]
-    if not spec_dev.AutoDiscovery:
-        return
-    reconstruct(spec_dev)
+    # each Spec in its own greenlet: a slow or dead SPEC session must not
+    # delay the others
+    return [gevent.spawn(__reconstruct_init, spec_dev)
+            for spec_dev in registry.get_devices("Spec")
+            if spec_dev.AutoDiscovery]
+
+
+def __report_startup(tasks):
+    # the server is ready when the elements are reconstructed, created (by
+    # the tango workers) and connected (or attempted) by the schedulers
+    gevent.joinall(tasks)
+    for worker in get_workers().values():
+        for future in worker.flush():
+            future.wait()
+    for session in get_sessions().values():
+        session.scheduler.wait_drained()
+    get_startup_timer().pop()
+    report_startup()
 
 
 def new_instance(instance_name="spec"):
@@ -909,19 +1987,65 @@ def __new_instance(instance_name="spec"):
 
 
 def run_server(**kwargs):
-    """Runs the TangoSpec device server"""
-    from PyTango.server import run
-    from .SpecMotor import SpecMotor
-    from .SpecCounter import SpecCounter
+    """Runs the TangoSpec device server.
+
+    ``--shards N`` starts N shard processes which host the motors and
+    counters of this server (``--shard`` is used internally to start a
+    shard process).
+
+    ``--startup-profile`` reports the time spent in each start-up phase
+    (imports, database access and server setup, device initialization,
+    SPEC connection, reconstruction and element connections) once the
+    server is ready"""
+    global _SHARDED
+    import sys
+    args = list(kwargs.get('args') or sys.argv)
+    timer = get_startup_timer()
+    if "--startup-profile" in args:
+        args.remove("--startup-profile")
+        kwargs['args'] = args
+        if not timer.enabled:
+            timer.enable()
+    with timer.phase("imports"):
+        from PyTango.server import run
+        from .SpecMotor import SpecMotor
+        from .SpecCounter import SpecCounter
+    if "--shard" in args:
+        from .SpecShard import SpecShard
+        args.remove("--shard")
+        kwargs['args'] = args
+        kwargs['green_mode'] = GreenMode.Gevent
+        run((SpecShard, SpecCounter, SpecMotor), **kwargs)
+        return
+    if "--shards" in args:
+        from .SpecShard import start_shards
+        _SHARDED = True
+        index = args.index("--shards")
+        nb_shards = int(args[index+1])
+        del args[index:index+2]
+        kwargs['args'] = args
+        with timer.phase("shard processes start"):
+            start_shards(args[1], nb_shards, args[2:])
     classes = Spec, SpecCounter, SpecMotor
     orig_post_init_cb = kwargs.get('post_init_callback')
     if orig_post_init_cb:
         def post_init_cb():
             orig_post_init_cb()
-            reconstruct_init()
+            return reconstruct_init()
     else:
         post_init_cb = reconstruct_init
-    kwargs['post_init_callback'] = post_init_cb
+    if timer.enabled:
+        for klass in classes:
+            klass.init_device = timer.timed("device init",
+                                            klass.init_device)
+        def startup_post_init_cb(post_init_cb=post_init_cb):
+            timer.pop()
+            timer.push("reconstruction and connection")
+            gevent.spawn(__report_startup, post_init_cb())
+        timer.push("database and server setup")
+        kwargs['post_init_callback'] = startup_post_init_cb
+    else:
+        kwargs['post_init_callback'] = post_init_cb
     kwargs['green_mode'] = GreenMode.Gevent
 
     run(classes, **kwargs)
@@ -10,15 +10,21 @@
 
 """A TANGO motor device for SPEC based on SpecClient."""
 
+import time
 import Queue
 import logging
 import threading
+import collections
+
+import gevent
 
 from PyTango import DevState, Util
 
 from SpecClient_gevent import SpecMotor
 from SpecClient_gevent import SpecCounter
 
+from TangoSpec.SpecMetrics import push_event
+
 SpecMotorState_2_TangoState = {
     SpecMotor.NOTINITIALIZED: DevState.UNKNOWN,
     SpecMotor.UNUSABLE: DevState.UNKNOWN,
@@ -41,68 +47,561 @@ SpecCounterType_2_str = {
     SpecCounter.MONITOR: 'Monitor'
 }
 
-class _TangoWorker(threading.Thread):
+class RollingStats(object):
+    """Rolling statistics over the last *maxlen* samples"""
 
-    def __init__(self, **kwargs):
-        kwargs['name'] = kwargs.pop('name', 'TangoWorker')
-        daemon = kwargs.pop('daemon', True)
-        threading.Thread.__init__(self, **kwargs)
-        self.stop = False
-        self.setDaemon(daemon)
-        self.tasks = Queue.Queue()
+    def __init__(self, maxlen=100):
+        self.samples = collections.deque(maxlen=maxlen)
 
-    def run(self):
-        tasks = self.tasks
-        while not self.stop:
-            try:
-                f, args, kwargs = tasks.get(timeout=0.5)
-            except Queue.Empty:
-                continue
+    def add(self, value):
+        self.samples.append(value)
+
+    def reset(self):
+        self.samples.clear()
+
+    def summary(self):
+        """Returns (last, mean, min, max, nb. samples) or an empty list if
+        no sample has been collected yet"""
+        samples = self.samples
+        n = len(samples)
+        if not n:
+            return []
+        return samples[-1], sum(samples) / float(n), min(samples), \
+               max(samples), n
+
+    def percentiles(self, points=(50, 90, 99)):
+        """Returns the given percentiles followed by max and nb. samples
+        or an empty list if no sample has been collected yet"""
+        samples = sorted(self.samples)
+        n = len(samples)
+        if not n:
+            return []
+        return [samples[min(n - 1, int(n * p / 100.0))] for p in points] + \
+               [samples[-1], n]
+
+
+class TaskTimeoutError(Exception):
+    """Raised when waiting for a task result times out"""
+
+
+def _get_hub_if_exists():
+    """Returns the gevent hub of the current thread or None"""
+    try:
+        from gevent._hub_local import get_hub_if_exists
+    except ImportError:
+        return getattr(gevent.hub._threadlocal, 'hub', None)
+    return get_hub_if_exists()
+
+
+def _new_async_watcher(loop):
+    # 'async' is a reserved word since python 3.7 (gevent >= 1.3 uses async_)
+    new_async = getattr(loop, 'async_', None) or getattr(loop, 'async')
+    return new_async()
+
+
+class TaskFuture(object):
+    """The result of a task executed by the tango worker.
+
+    It can be waited for from threads and from greenlets. Greenlets wait
+    cooperatively (the gevent hub is woken up by the worker thread when
+    the task is done)."""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__event = threading.Event()
+        self.__callbacks = []
+        self.__result = None
+        self.__exception = None
+
+    def done(self):
+        return self.__event.is_set()
+
+    def set_result(self, result):
+        self.__set(result, None)
+
+    def set_exception(self, exception):
+        self.__set(None, exception)
+
+    def __set(self, result, exception):
+        with self.__lock:
+            self.__result, self.__exception = result, exception
+            self.__event.set()
+            callbacks, self.__callbacks = self.__callbacks, []
+        for callback in callbacks:
+            self.__call(callback)
+
+    def __call(self, callback):
+        try:
+            callback(self)
+        except:
+            logging.warning("Failed to execute future callback %s",
+                            str(callback))
+            logging.debug("Details:", exc_info=1)
+
+    def add_done_callback(self, callback):
+        """Calls callback(future) when the task is done (from the thread
+        which finished the task or immediately if it is already done)"""
+        with self.__lock:
+            if not self.__event.is_set():
+                self.__callbacks.append(callback)
+                return
+        self.__call(callback)
+
+    def wait(self, timeout=None):
+        """Waits for the task to finish. Returns True if the task is done"""
+        if self.done():
+            return True
+        if _get_hub_if_exists() is None:
+            return self.__event.wait(timeout)
+        return self.__green_wait(timeout)
+
+    def __green_wait(self, timeout):
+        import gevent.event
+        watcher = _new_async_watcher(gevent.get_hub().loop)
+        event = gevent.event.Event()
+        watcher.start(event.set)
+        # the callback may run (in the worker thread) after a timeout: it
+        # must not use the watcher once it is closed
+        lock, active = threading.Lock(), [True]
+        def wake_up(future):
+            with lock:
+                if active:
+                    watcher.send()
+        try:
+            self.add_done_callback(wake_up)
+            event.wait(timeout)
+        finally:
+            with self.__lock:
+                if wake_up in self.__callbacks:
+                    self.__callbacks.remove(wake_up)
+            with lock:
+                del active[:]
+                watcher.stop()
+                close = getattr(watcher, 'close', None)
+                if close is not None:
+                    close()
+        return self.done()
+
+    def result(self, timeout=None):
+        """Waits for the task to finish and returns its result (or raises
+        the task exception)"""
+        if not self.wait(timeout):
+            raise TaskTimeoutError("Timeout waiting for task result")
+        if self.__exception is not None:
+            raise self.__exception
+        return self.__result
+
+    def exception(self, timeout=None):
+        """Waits for the task to finish and returns its exception (or None)"""
+        if not self.wait(timeout):
+            raise TaskTimeoutError("Timeout waiting for task result")
+        return self.__exception
+
+
+def _noop():
+    pass
+
+
+class _TangoWorker(object):
+    """A pool of threads executing tango tasks (ex: device creation).
+
+    Each thread has its own bounded task queue. Tasks with the same key are
+    always executed by the same thread, in submission order. Submitting a
+    task when the queue is full blocks the submitter (cooperatively if it
+    is a greenlet: it is woken up by the thread when it takes a task) until
+    there is room in the queue.
+
+    A task which has a *merge(task)* method is coalescable: when a new task
+    is submitted with the same key while it is the last pending task of the
+    queue, *merge* is called with the new task. If it returns True the new
+    task is considered part of the pending task (and shares its future)."""
+
+    def __init__(self, name='TangoWorker', size=2, max_queue_size=1000,
+                 daemon=True):
+        self.name = name
+        self.__queues = [Queue.Queue(max_queue_size) for _ in range(size)]
+        self.__threads = []
+        for index, queue in enumerate(self.__queues):
+            thread = threading.Thread(target=self.__run, args=(queue,),
+                                      name="{0}-{1}".format(name, index))
+            thread.setDaemon(daemon)
+            self.__threads.append(thread)
+        self.__next = 0
+        self.__lock = threading.Lock()
+        # dict<queue: TaskFuture> set when the thread takes a task of a full
+        # queue
+        self.__rooms = {}
+        self.executed = 0
+        self.failed = 0
+        self.coalesced = 0
+        self.latency = RollingStats(1000)
+
+    def start(self):
+        for thread in self.__threads:
+            thread.start()
+
+    def stop(self):
+        for queue in self.__queues:
+            self.__put(queue, None)
+
+    def __run(self, tasks):
+        while True:
+            task = tasks.get()
+            with self.__lock:
+                room = self.__rooms.pop(tasks, None)
+            if room is not None:
+                room.set_result(None)
+            if task is None:
+                break
+            f, args, kwargs, future, submit_time = task
             try:
-                f(*args, **kwargs)
-            except:
+                result = f(*args, **kwargs)
+            except Exception as error:
+                with self.__lock:
+                    self.failed += 1
                 logging.warning("Failed to execute %s", str(f))
                 logging.debug("Details:", exc_info=1)
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+            with self.__lock:
+                self.executed += 1
+                self.latency.add(time.time() - submit_time)
+
+    def __put(self, queue, task):
+        if _get_hub_if_exists() is None:
+            queue.put(task)
+            return
+        # don't block the gevent hub while the queue is full
+        while True:
+            try:
+                queue.put_nowait(task)
+                return
+            except Queue.Full:
+                pass
+            with self.__lock:
+                room = self.__rooms.get(queue)
+                if room is None:
+                    room = self.__rooms[queue] = TaskFuture()
+            # the thread may have taken a task before the room was set
+            try:
+                queue.put_nowait(task)
+                return
+            except Queue.Full:
+                room.wait()
+
+    def submit(self, key, f, *args, **kwargs):
+        """Executes f(*args, **kwargs) in a worker thread. Tasks with the
+        same key are executed in submission order. Returns a
+        :class:`TaskFuture`"""
+        queues = self.__queues
+        if key is None:
+            self.__next = index = (self.__next + 1) % len(queues)
+        else:
+            index = hash(key) % len(queues)
+        queue = queues[index]
+        if not args and not kwargs and hasattr(f, 'merge'):
+            future = self.__coalesce(queue, f)
+            if future is not None:
+                return future
+        future = TaskFuture()
+        self.__put(queue, (f, args, kwargs, future, time.time()))
+        return future
+
+    def __coalesce(self, queue, f):
+        """Tries to merge f into the last pending task of the queue.
+        Returns the future of the pending task if merged or None"""
+        with queue.mutex:
+            if not queue.queue:
+                return
+            pending = queue.queue[-1]
+            if pending is None:
+                return
+            pending_f, pending_future = pending[0], pending[3]
+            merge = getattr(pending_f, 'merge', None)
+            if merge is None or not merge(f):
+                return
+        with self.__lock:
+            self.coalesced += 1
+        return pending_future
 
     def execute(self, f, *args, **kwargs):
-        self.tasks.put((f, args, kwargs))
+        return self.submit(None, f, *args, **kwargs)
+
+    def flush(self):
+        """Returns a list of futures which are done when the tasks submitted
+        so far have been executed"""
+        futures = []
+        for queue in self.__queues:
+            future = TaskFuture()
+            self.__put(queue, (_noop, (), {}, future, time.time()))
+            futures.append(future)
+        return futures
+
+    @property
+    def queue_depth(self):
+        return sum(queue.qsize() for queue in self.__queues)
 
 
-__TANGO_WORKER = None
-def TangoWorker():
-    global __TANGO_WORKER
-    if __TANGO_WORKER is None:
-        __TANGO_WORKER = _TangoWorker()
-        __TANGO_WORKER.start()
-    return __TANGO_WORKER
+__TANGO_WORKERS = {}
+__TANGO_WORKERS_LOCK = threading.Lock()
+def TangoWorker(name=None, **kwargs):
+    """Returns the tango worker with the given name (ex: a SPEC session
+    name). None means the default worker. The keyword arguments (size,
+    max_queue_size) are only used when the worker is created"""
+    with __TANGO_WORKERS_LOCK:
+        worker = __TANGO_WORKERS.get(name)
+        if worker is None:
+            worker_name = 'TangoWorker'
+            if name is not None:
+                worker_name += '-' + name
+            worker = _TangoWorker(name=worker_name, **kwargs)
+            worker.start()
+            __TANGO_WORKERS[name] = worker
+    return worker
+
+
+def get_workers():
+    """Returns dict<name: worker> of the created tango workers"""
+    with __TANGO_WORKERS_LOCK:
+        return dict(__TANGO_WORKERS)
 
 
 def execute(f, *args, **kwargs):
-    """Helper to execute a task in the tango worker thread"""
+    """Helper to execute a task in the tango worker. Returns a
+    :class:`TaskFuture`"""
     return TangoWorker().execute(f, *args, **kwargs)
 
 
+def submit(key, f, *args, **kwargs):
+    """Helper to execute a task in the tango worker after all the previous
+    tasks with the same key. Returns a :class:`TaskFuture`"""
+    return TangoWorker().submit(key, f, *args, **kwargs)
+
+
+class _StateEvents(object):
+    """State/status change event bookkeeping used by :func:`switch_state`.
+
+    Counts the events not sent because nothing changed and, if a batch
+    interval is set, delays status events to send only the last status of
+    each device in the interval."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.batch_interval = 0
+        self.suppressed = 0
+        # dict<device name: number of suppressed events>
+        self.suppressed_by_device = collections.defaultdict(int)
+        # dict<device name: device>
+        self.pending_status = {}
+        self.flush_task = None
+
+    def suppress(self, device, n=1):
+        with self.lock:
+            self.suppressed += n
+            self.suppressed_by_device[device.get_name()] += n
+
+    def push_status(self, device):
+        if self.batch_interval <= 0 or _get_hub_if_exists() is None:
+            push_event(device, "status")
+            return
+        name = device.get_name()
+        with self.lock:
+            if name in self.pending_status:
+                self.suppressed += 1
+                self.suppressed_by_device[name] += 1
+            self.pending_status[name] = device
+            if self.flush_task is None:
+                self.flush_task = gevent.spawn_later(self.batch_interval,
+                                                     self.flush)
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending_status = self.pending_status, {}
+            self.flush_task = None
+        for device in pending.values():
+            try:
+                push_event(device, "status")
+            except:
+                logging.debug("Failed to push status of %s",
+                              device.get_name(), exc_info=1)
+
+
+__STATE_EVENTS = _StateEvents()
+
+
+def set_status_batch_interval(interval):
+    """Sets the interval (s) during which status events are batched (only
+    the last status of each device is sent). 0 disables batching"""
+    __STATE_EVENTS.batch_interval = interval
+
+
+def get_suppressed_events(device_name=None):
+    """Returns the number of state/status events not sent by
+    :func:`switch_state` (for the given device or for all devices)"""
+    if device_name is None:
+        return __STATE_EVENTS.suppressed
+    return __STATE_EVENTS.suppressed_by_device.get(device_name, 0)
+
+
 def switch_state(device, state=None, status=None):
-    """Helper to switch state and/or status and send event"""
+    """Helper to switch state and/or status and send event. Events are only
+    sent if the state/status changed"""
+    events = __STATE_EVENTS
     if state is not None:
-        device.set_state(state)
-        device.push_change_event("state")
-        if state in (DevState.ALARM, DevState.UNKNOWN, DevState.FAULT):
-            msg = "State changed to " + str(state) 
-            if status is not None:
-                msg += ": " + status
-            logging.getLogger(device.get_name()).error(msg)
+        if state == device.get_state():
+            events.suppress(device)
+        else:
+            device.set_state(state)
+            push_event(device, "state")
+            if state in (DevState.ALARM, DevState.UNKNOWN, DevState.FAULT):
+                log = logging.getLogger(device.get_name())
+                if status is None:
+                    log.error("State changed to %s", state)
+                else:
+                    log.error("State changed to %s: %s", state, status)
     if status is not None:
-        device.set_status(status)
-        device.push_change_event("status")
+        if status == device.get_status():
+            events.suppress(device)
+        else:
+            device.set_status(status)
+            events.push_status(device)
+
+
+def _get_spec_session(device):
+    return getattr(device, "get_spec_session", lambda: None)()
+
+
+def _get_class_name(device):
+    # elements of other processes (shards) are registered through proxies
+    return getattr(device, "element_class", None) or \
+           device.__class__.__name__
+
+
+class ElementRegistry(object):
+    """Server wide registry of the devices (Spec, SpecMotor, SpecCounter)
+    indexed by TANGO class and TANGO device name and, per SPEC session
+    (``<host>:<session>``), by SPEC name.
+
+    Devices register themselves on creation and unregister on deletion.
+    The formatted element lists (``<spec name> <device name>``) are only
+    rebuilt when the registry changes.
+
+    The *session* argument of the query methods restricts the result to
+    the devices of the given SPEC session (None means all sessions)."""
+
+    def __init__(self):
+        self.__lock = threading.RLock()
+        # dict<class name: dict<device name: device>>
+        self.__devices = collections.defaultdict(dict)
+        # dict<class name: dict<session: dict<spec name: device>>>
+        self.__spec_names = collections.defaultdict(
+            lambda: collections.defaultdict(dict))
+        # dict<(class name, session): list<str>>
+        self.__lists = {}
+
+    def register(self, device):
+        class_name = _get_class_name(device)
+        with self.__lock:
+            self.__devices[class_name][device.get_name().lower()] = device
+            spec_name = getattr(device, "get_spec_name", lambda: None)()
+            if spec_name is not None:
+                session = _get_spec_session(device)
+                self.__spec_names[class_name][session][spec_name] = device
+            self.__invalidate(class_name)
+
+    def unregister(self, device):
+        class_name = _get_class_name(device)
+        with self.__lock:
+            devices = self.__devices[class_name]
+            if devices.get(device.get_name().lower()) is device:
+                del devices[device.get_name().lower()]
+            for spec_names in self.__spec_names[class_name].values():
+                for spec_name, spec_device in list(spec_names.items()):
+                    if spec_device is device:
+                        del spec_names[spec_name]
+            self.__invalidate(class_name)
+
+    def __invalidate(self, class_name):
+        for key in list(self.__lists):
+            if key[0] == class_name:
+                del self.__lists[key]
+
+    def get_class_names(self):
+        """Returns the list of TANGO classes of the registered devices"""
+        return [class_name for class_name, devices
+                in list(self.__devices.items()) if devices]
+
+    def get_sessions(self, class_name):
+        """Returns the list of SPEC sessions of the registered devices of
+        the given class"""
+        return [session for session, spec_names
+                in self.__spec_names[class_name].items() if spec_names]
+
+    def get_devices(self, class_name, session=None):
+        """Returns the list of registered devices of the given class"""
+        devices = list(self.__devices[class_name].values())
+        if session is not None:
+            devices = [device for device in devices
+                       if _get_spec_session(device) == session]
+        return devices
+
+    def get_device(self, class_name, dev_name):
+        """Returns the device of the given class and device name or None"""
+        return self.__devices[class_name].get(dev_name.lower())
+
+    def get_device_by_spec_name(self, class_name, spec_name, session=None):
+        """Returns the device of the given class and SPEC name or None"""
+        sessions = self.__spec_names[class_name]
+        if session is not None:
+            return sessions[session].get(spec_name)
+        for spec_names in list(sessions.values()):
+            device = spec_names.get(spec_name)
+            if device is not None:
+                return device
+
+    def get_spec_names(self, class_name, session=None):
+        """Returns the list of SPEC names of the registered devices of the
+        given class"""
+        sessions = self.__spec_names[class_name]
+        if session is not None:
+            return list(sessions[session])
+        return [spec_name for spec_names in list(sessions.values())
+                for spec_name in spec_names]
+
+    def get_element_list(self, class_name, session=None):
+        """Returns the list of ``<spec name> <device name>`` of the
+        registered devices of the given class"""
+        key = class_name, session
+        element_list = self.__lists.get(key)
+        if element_list is None:
+            with self.__lock:
+                devices = self.get_devices(class_name, session=session)
+                element_list = ["{0} {1}".format(device.get_spec_name(),
+                                                 device.get_name())
+                                for device in devices]
+                element_list.sort()
+                self.__lists[key] = element_list
+        return element_list
+
+
+#: the server wide element registry
+registry = ElementRegistry()
 
 
 def get_spec_names():
-    util = Util.instance()
-    tango_specs = util.get_device_list_by_class("Spec")
-    if not tango_specs:
-        return []
-    return [ts.Spec for ts in tango_specs]
+    return [ts.Spec for ts in registry.get_devices("Spec")]
+
+
+def __find_device_spec(device):
+    """Returns the Spec name of the Spec device which owns the given
+    element device (by default, elements of Spec device d/f/m are named
+    d/f_m/<element>) or None"""
+    domain, family = device.get_name().lower().split("/")[:2]
+    for spec_device in registry.get_devices("Spec"):
+        d, f, m = spec_device.get_name().lower().split("/")
+        if domain == d and family == "{0}_{1}".format(f, m):
+            return spec_device.Spec
 
 
 def find_spec_name(device, name):
@@ -118,11 +617,62 @@ def find_spec_name(device, name):
             switch_state(device, DevState.FAULT, status)
             return
         elif len(specs) > 1:
-            status = "Wrong {0} property: More than one Spec in tango " \
-                     "server. Need the full {0} name".format(class_name)
-            switch_state(device, DevState.FAULT, status)
-            return
+            spec_version = __find_device_spec(device)
+            if spec_version is None:
+                status = "Wrong {0} property: More than one Spec in tango " \
+                         "server. Need the full {0} name".format(class_name)
+                switch_state(device, DevState.FAULT, status)
+                return
+            element = name
         else:
             spec_version = specs[0]
             element = name
     return spec_version, element
+
+
+#: serializes the creation and deletion of devices (Util.create_device and
+#: Util.delete_device are not safe to call from several threads at once)
+_DEVICES_LOCK = threading.Lock()
+
+
+def create_element_devices(dev_type, elements, log=logging,
+                           properties=None):
+    """Creates TANGO_ devices of the given class (SpecMotor or SpecCounter)
+    in this process. Failures are logged and the next devices are created.
+
+    :param elements: sequence of (full SPEC name, device name, alias)
+    :param properties: other device properties of the elements (dict)"""
+    util = Util.instance()
+    db = util.get_database()
+    aliases = set(db.get_device_alias_list("*").value_string)
+
+    for spec_name, dev_name, dev_alias in elements:
+        def cb(name, spec_name=spec_name, dev_alias=dev_alias):
+            element_properties = dict(properties or {})
+            element_properties[dev_type] = spec_name
+            db.put_device_property(name, element_properties)
+            if dev_alias in aliases:
+                log.warning("%s already associated with a device. "
+                            "Tango alias will NOT be created", dev_alias)
+            else:
+                db.put_device_alias(name, dev_alias)
+                aliases.add(dev_alias)
+        try:
+            with _DEVICES_LOCK:
+                util.create_device(dev_type, dev_name, cb=cb)
+        except:
+            log.warning("Failed to create %s %s", dev_type, dev_name)
+            log.debug("Details:", exc_info=1)
+
+
+def delete_element_devices(dev_type, dev_names, log=logging):
+    """Deletes TANGO_ devices of the given class from this process.
+    Failures are logged and the next devices are deleted"""
+    util = Util.instance()
+    for dev_name in dev_names:
+        try:
+            with _DEVICES_LOCK:
+                util.delete_device(dev_type, dev_name)
+        except:
+            log.warning("Failed to delete %s %s", dev_type, dev_name)
+            log.debug("Details:", exc_info=1)
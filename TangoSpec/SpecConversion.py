@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+#------------------------------------------------------------------------------
+# This file is part of the Tango SPEC device server
+#
+# Copyright (c) 2014, European Synchrotron Radiation Facility.
+# Distributed under the GNU Lesser General Public License.
+# See LICENSE.txt for more info.
+#------------------------------------------------------------------------------
+
+"""Offloading of large SPEC <-> TANGO value conversions to a process pool."""
+
+import sys
+import json
+import logging
+import threading
+
+from TangoSpec.SpecCommon import TaskFuture
+
+_string_types = bytes, type(u'')
+
+#: conversions worth sending to another process: object -> bytes encoders
+#: (the bytes are cheap to unpickle in the server, unlike decoded objects)
+OFFLOADABLE = json.dumps,
+
+#: pickle protocol of the requests and replies
+PICKLE_PROTOCOL = 2
+
+#: code run by the conversion processes. They are new interpreters (not
+#: forks of the server, which runs the ORB threads and the gevent hub) and
+#: don't even import TangoSpec. Requests and replies are pickled on
+#: stdin/stdout; errors are sent back as (False, message)
+_PROCESS_CODE = """
+import sys
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+while True:
+    try:
+        f, value = pickle.load(stdin)
+    except EOFError:
+        break
+    try:
+        reply = True, f(value)
+    except Exception as error:
+        reply = False, '{0}: {1}'.format(type(error).__name__, error)
+    pickle.dump(reply, stdout, 2)
+    stdout.flush()
+"""
+
+
+def estimate_size(value):
+    """Cheap (shallow) estimation of the size (bytes) of a value"""
+    if isinstance(value, _string_types):
+        return len(value)
+    nbytes = getattr(value, 'nbytes', None)
+    if nbytes is not None:
+        return nbytes
+    try:
+        return 16 * len(value)
+    except TypeError:
+        return 8
+
+
+class ConversionError(Exception):
+    """Raised when an offloaded conversion fails"""
+
+
+class _ConversionProcess(object):
+    """A conversion process fed by its own thread with the tasks of the
+    pool. The process is (re)started on demand: if it dies, the task fails
+    and the next one starts a new process"""
+
+    def __init__(self, tasks, index):
+        self.__process = None
+        self.__thread = threading.Thread(target=self.__run, args=(tasks,),
+                                         name="Conversion-{0}".format(index))
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __start(self):
+        import subprocess
+        return subprocess.Popen([sys.executable, "-c", _PROCESS_CODE],
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, close_fds=True)
+
+    def __run(self, tasks):
+        import cPickle as pickle
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            f, value, future = task
+            try:
+                if self.__process is None:
+                    self.__process = self.__start()
+                process = self.__process
+                pickle.dump((f, value), process.stdin,
+                            PICKLE_PROTOCOL)
+                process.stdin.flush()
+                ok, result = pickle.load(process.stdout)
+            except Exception as error:
+                logging.warning("Conversion process failed (%s)", error)
+                logging.debug("Details:", exc_info=1)
+                self.terminate()
+                future.set_exception(ConversionError(
+                    "conversion process failed: {0}".format(error)))
+                continue
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(ConversionError(result))
+        self.terminate()
+
+    def terminate(self):
+        process, self.__process = self.__process, None
+        if process is not None:
+            try:
+                process.kill()
+                process.wait()
+            except OSError:
+                pass
+
+
+class _ConversionPool(object):
+    """Converts values in a pool of *size* processes when their estimated
+    size is at least *threshold* bytes. Smaller values (and conversions
+    which are not in :data:`OFFLOADABLE`) are converted inline.
+
+    Greenlets waiting for a conversion do not block the gevent hub."""
+
+    def __init__(self, size=0, threshold=1024*1024, timeout=30):
+        self.size = size
+        self.threshold = threshold
+        self.timeout = timeout
+        self.offloaded = 0
+        self.__tasks = None
+        self.__processes = []
+        self.__lock = threading.Lock()
+
+    def __get_tasks(self):
+        with self.__lock:
+            if self.__tasks is None:
+                import Queue
+                self.__tasks = Queue.Queue()
+                self.__processes = [_ConversionProcess(self.__tasks, index)
+                                    for index in range(self.size)]
+            return self.__tasks
+
+    def convert(self, f, value):
+        """Returns f(value), computed in the process pool if value is
+        large"""
+        if self.size <= 0 or f not in OFFLOADABLE or \
+           estimate_size(value) < self.threshold:
+            return f(value)
+        future = TaskFuture()
+        self.__get_tasks().put((f, value, future))
+        self.offloaded += 1
+        return future.result(self.timeout)
+
+    def close(self):
+        with self.__lock:
+            tasks, self.__tasks = self.__tasks, None
+            processes, self.__processes = self.__processes, []
+        if tasks is not None:
+            for _ in processes:
+                tasks.put(None)
+
+
+__CONVERSION_POOL = None
+def ConversionPool(size=0, threshold=None):
+    """Returns the server wide conversion pool. The size is only used when
+    the pool is created. The threshold, if given, is always updated"""
+    global __CONVERSION_POOL
+    if __CONVERSION_POOL is None:
+        __CONVERSION_POOL = _ConversionPool(size=size)
+    if threshold is not None:
+        __CONVERSION_POOL.threshold = threshold
+    return __CONVERSION_POOL
+
+
+def convert(f, value):
+    """Helper to convert a value with the server wide conversion pool"""
+    return ConversionPool().convert(f, value)
@@ -13,17 +13,63 @@
 
 import time
 import logging
+import threading
+from functools import partial
 
 from PyTango import DevState, AttrWriteType, AttrQuality, DebugIt
 from PyTango.server import (Device, DeviceMeta, attribute, command,
                             device_property)
 
-from SpecClient_gevent.SpecCounter import SpecCounterA
 from SpecClient_gevent.SpecClientError import SpecClientError
 
+from TangoSpec.SpecSession import get_session, get_reconnect_scheduler
 from TangoSpec.SpecCommon import (SpecCounterState_2_TangoState,
                                   SpecCounterType_2_str,
-                                  switch_state, find_spec_name)
+                                  switch_state, find_spec_name, registry)
+from TangoSpec.SpecMetrics import push_event, forget_device
+from TangoSpec.SpecSnapshot import get_snapshot, COUNTERS
+
+#: maximum number of samples kept per count
+MAX_COUNT_SAMPLES = 65536
+
+#: read-only spectrum float attribute helper
+float_1D_attr = partial(attribute, dtype=(float,), access=AttrWriteType.READ,
+                        max_dim_x=MAX_COUNT_SAMPLES)
+
+
+class _CountBuffer(object):
+    """Bounded buffer of timestamped values of a single count. When full,
+    the oldest values are discarded"""
+
+    def __init__(self, max_length):
+        import numpy
+        self.max_length = max_length
+        self.timestamps = numpy.empty(max_length)
+        self.values = numpy.empty(max_length)
+        self.clear()
+
+    def clear(self):
+        self.start = 0
+        self.length = 0
+
+    def append(self, timestamp, value):
+        if self.length < self.max_length:
+            index = (self.start + self.length) % self.max_length
+            self.length += 1
+        else:
+            index = self.start
+            self.start = (self.start + 1) % self.max_length
+        self.timestamps[index] = timestamp
+        self.values[index] = value
+
+    def __indexes(self):
+        import numpy
+        return (self.start + numpy.arange(self.length)) % self.max_length
+
+    def snapshot(self):
+        """Returns copies of (timestamps, values)"""
+        indexes = self.__indexes()
+        return self.timestamps[indexes], self.values[indexes]
 
 
 class SpecCounter(Device):
@@ -37,8 +83,36 @@ class SpecCounter(Device):
                                       "it can be just the counter "
                                       "name")
 
+    Backend = device_property(dtype=str, default_value="",
+                              doc="'spec' (SpecClient) or 'sim' "
+                                  "(in-process simulated SPEC). Empty "
+                                  "string means the backend of the "
+                                  "session (set by its Spec device)")
+
+    CountBufferMaxLength = device_property(dtype=int, default_value=10000,
+                                           doc="maximum number of values "
+                                               "kept per count")
+
     Value = attribute(dtype=float, access=AttrWriteType.READ)
 
+    CountValues = float_1D_attr(doc="values of the current (or last) count")
+
+    CountTimestamps = float_1D_attr(unit="s",
+                                    doc="timestamps of the current (or "
+                                        "last) count values")
+
+    PreviousCountValues = float_1D_attr(doc="values of the previous count")
+
+    PreviousCountTimestamps = float_1D_attr(unit="s",
+                                            doc="timestamps of the previous "
+                                                "count values")
+
+    #: dict<attribute name: (count buffer name, index in snapshot)>
+    COUNT_ATTRS = dict(CountTimestamps=("current", 0),
+                       CountValues=("current", 1),
+                       PreviousCountTimestamps=("previous", 0),
+                       PreviousCountValues=("previous", 1))
+
     @property
     def spec_counter(self):
         return self.__spec_counter
@@ -50,10 +124,23 @@ class SpecCounter(Device):
         return self.__spec_counter_name
 
     get_spec_name = get_spec_counter_name
+    get_spec_session = get_spec_version_name
+
+    def get_snapshot(self):
+        """Returns the last known values to be saved in the snapshot (or
+        None if nothing is known)"""
+        if self.__value is None:
+            return None
+        return dict(value=self.__value)
 
     @DebugIt()
     def delete_device(self):
         Device.delete_device(self)
+        registry.unregister(self)
+        forget_device(self)
+        if self.__spec_version_name is not None:
+            scheduler = get_reconnect_scheduler(self.__spec_version_name)
+            scheduler.cancel(self.get_name())
         self.__spec_counter = None
 
     @DebugIt()
@@ -70,26 +157,37 @@ class SpecCounter(Device):
         self.__spec_counter = None
         self.__spec_counter_name = None
         self.__spec_version_name = None
+        self.__snapshot = None
+        self.__value = None
+        buffer_length = min(max(self.CountBufferMaxLength, 1),
+                            MAX_COUNT_SAMPLES)
+        # protects the count buffers: appended by SPEC events, copied by
+        # the read requests
+        self.__count_lock = threading.Lock()
+        self.__count_buffer = _CountBuffer(buffer_length)
+        self.__previous_count_buffer = _CountBuffer(buffer_length)
+        # dict<count buffer name: (timestamps, values)> of the read request
+        self.__count_snapshot = {}
 
         spec_info = find_spec_name(self, self.SpecCounter)
         if spec_info is None:
+            registry.register(self)
             return
         spec_version, counter = spec_info
         self.__spec_version_name = spec_version
         self.__spec_counter_name = counter
+        self.__snapshot = get_snapshot(spec_version)
+        registry.register(self)
 
-        cb = dict(connected=self.__counterConnected,
-                  disconnected=self.__counterDisconnected,
-                  counterValueChanged=self.__counterValueChanged,
-                  counterStateChanged=self.__counterStateChanged)
         try:
             self.__log.debug("Start creating Spec counter %s", counter)
-            self.__spec_counter = SpecCounterA(callbacks=cb)
+            self.__spec_counter = self.__newSpecCounter()
         except SpecClientError as spec_error:
             status = "Error creating Spec counter {0}".format(counter)
             switch_state(self, DevState.FAULT, status)
         else:
-            self.__counterConnect()
+            scheduler = get_reconnect_scheduler(spec_version)
+            scheduler.schedule(self.get_name(), self.__counterConnect)
         self.__log.debug("End creating Spec counter %s", counter)
 
     def __getTypeStr(self):
@@ -100,7 +198,20 @@ class SpecCounter(Device):
             ctype = 'Unknown'
         return ctype
 
+    def __newSpecCounter(self):
+        cb = dict(connected=self.__counterConnected,
+                  disconnected=self.__counterDisconnected,
+                  counterValueChanged=self.__counterValueChanged,
+                  counterStateChanged=self.__counterStateChanged)
+        session = get_session(self.__spec_version_name,
+                              backend=self.Backend or None)
+        return session.counter(self.__spec_counter_name, cb)
+
     def __counterConnect(self):
+        # already connected (the connection succeeded after a timeout)
+        if self.get_state() not in (DevState.INIT, DevState.FAULT,
+                                    DevState.OFF):
+            return
         counter = self.__spec_counter_name
         try:
             self.__spec_counter.connectToSpec(counter,
@@ -109,8 +220,11 @@ class SpecCounter(Device):
         except SpecClientError as spec_error:
             status = "Error connecting to Spec counter {0}".format(counter)
             switch_state(self, DevState.FAULT, status)
+            raise
 
     def __counterConnected(self):
+        get_reconnect_scheduler(self.__spec_version_name).connected(
+            self.get_name())
         state = DevState.ON
         if self.get_state() != state:
             ctype = self.__getTypeStr()
@@ -118,10 +232,17 @@ class SpecCounter(Device):
             switch_state(self, state, status)
 
     def __counterDisconnected(self):
+        scheduler = get_reconnect_scheduler(self.__spec_version_name)
+        scheduler.disconnected(self.get_name())
         state = DevState.OFF
         if self.get_state() != state:
             status = "Counter is now %s".format(state)
             switch_state(self, state, status)
+        # drop the SpecClient counter so it doesn't re-register its
+        # channels on its own when SPEC is back: the scheduler reconnects a
+        # new one in batches with the other elements of the session
+        self.__spec_counter = self.__newSpecCounter()
+        scheduler.schedule(self.get_name(), self.__counterConnect)
 
     def __counterStateChanged(self, spec_state):
         old_state = self.get_state()
@@ -135,24 +256,83 @@ class SpecCounter(Device):
         if sc:
             # Fire a value event with VALID quality
             if old_state != DevState.RUNNING and state == DevState.RUNNING:
-                value = sc.getValue()
-                self.push_change_event("Value", value, time.time(),
-                                       AttrQuality.ATTR_CHANGING)
+                value, timestamp = sc.getValue(), time.time()
+                with self.__count_lock:
+                    self.__startCountBuffer()
+                    self.__count_buffer.append(timestamp, value)
+                push_event(self, "Value", value, timestamp,
+                           AttrQuality.ATTR_CHANGING)
             elif old_state == DevState.RUNNING and state != DevState.RUNNING:
                 value = sc.getValue()
-                self.push_change_event("Value", value)
+                with self.__count_lock:
+                    self.__count_buffer.append(time.time(), value)
+                push_event(self, "Value", value)
 
+    def __startCountBuffer(self):
+        previous = self.__previous_count_buffer
+        previous.clear()
+        self.__previous_count_buffer = self.__count_buffer
+        self.__count_buffer = previous
 
     def __counterValueChanged(self, value):
+        self.__value = value
         if self.get_state() == DevState.RUNNING:
-            self.push_change_event("Value", value, time.time(),
-                                   AttrQuality.ATTR_CHANGING)
+            timestamp = time.time()
+            with self.__count_lock:
+                self.__count_buffer.append(timestamp, value)
+            push_event(self, "Value", value, timestamp,
+                       AttrQuality.ATTR_CHANGING)
         else:
-            self.push_change_event("Value", value)
+            push_event(self, "Value", value)
 
     def read_Value(self):
+        if self.get_state() == DevState.INIT and self.__snapshot is not None:
+            values = self.__snapshot.get(COUNTERS, self.__spec_counter_name)
+            if values is not None:
+                # not connected yet: last known value
+                return values['value'], self.__snapshot.time, \
+                       self.__snapshot.quality
         return self.spec_counter.getValue()
 
+    def read_attr_hardware(self, attr_list):
+        # the values and timestamps of a count are copied at once for the
+        # whole read request: reading both attributes together gives
+        # consistent arrays even if the count goes on in between
+        dev_attrs = self.get_device_attr()
+        names = set(self.COUNT_ATTRS[name][0] for name in
+                    (dev_attrs.get_attr_by_ind(index).get_name()
+                     for index in attr_list)
+                    if name in self.COUNT_ATTRS)
+        with self.__count_lock:
+            self.__count_snapshot = dict(
+                (name, self.__getCountBuffer(name).snapshot())
+                for name in names)
+
+    def __getCountBuffer(self, name):
+        if name == "current":
+            return self.__count_buffer
+        return self.__previous_count_buffer
+
+    def __readCountAttr(self, attr_name):
+        name, index = self.COUNT_ATTRS[attr_name]
+        snapshot = self.__count_snapshot.get(name)
+        if snapshot is None:
+            with self.__count_lock:
+                snapshot = self.__getCountBuffer(name).snapshot()
+        return snapshot[index]
+
+    def read_CountValues(self):
+        return self.__readCountAttr("CountValues")
+
+    def read_CountTimestamps(self):
+        return self.__readCountAttr("CountTimestamps")
+
+    def read_PreviousCountValues(self):
+        return self.__readCountAttr("PreviousCountValues")
+
+    def read_PreviousCountTimestamps(self):
+        return self.__readCountAttr("PreviousCountTimestamps")
+
     @command(dtype_in=float, doc_in="count time (s)")
     def Count(self, count_time):
         """
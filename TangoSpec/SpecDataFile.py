@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+
+#------------------------------------------------------------------------------
+# This file is part of the Tango SPEC device server
+#
+# Copyright (c) 2014, European Synchrotron Radiation Facility.
+# Distributed under the GNU Lesser General Public License.
+# See LICENSE.txt for more info.
+#------------------------------------------------------------------------------
+
+"""Indexed access to SPEC data files.
+
+The file is memory mapped and the offsets of the scan headers (``#S``
+lines) are kept in an index which is saved next to the data file (or in a
+given directory) and updated incrementally: only the bytes appended since
+the last update are searched. The index is only trusted for the same file
+(inode), modification time (if the size did not change) and first scan
+header."""
+
+import os
+import json
+import logging
+import tempfile
+import threading
+
+from TangoSpec.SpecCommon import TangoWorker
+
+#: extension of the index files
+INDEX_EXTENSION = ".tsidx"
+
+INDEX_VERSION = 2
+
+#: timeout (s) of the data file requests executed by the data file worker
+REQUEST_TIMEOUT = 30
+
+
+class DataFileError(Exception):
+    pass
+
+
+class DataFile(object):
+    """A SPEC data file.
+
+    :param filename: data file name
+    :param index_directory: directory of the index file (None means the
+                            directory of the data file)"""
+
+    def __init__(self, filename, index_directory=None):
+        self.filename = filename
+        directory = index_directory or os.path.dirname(
+            os.path.abspath(filename))
+        self.index_filename = os.path.join(
+            directory, os.path.basename(filename) + INDEX_EXTENSION)
+        self.__log = logging.getLogger("TangoSpec.DataFile")
+        self.__lock = threading.RLock()
+        self.__file = None
+        self.__map = None
+        self.__inode = None
+        self.__mtime = None
+        # size of the file already indexed (up to the end of a line)
+        self.__indexed_size = 0
+        # list<[scan number, header offset]>
+        self.__scans = []
+        # header line of the first scan
+        self.__first_line = None
+        self.__load_index()
+
+    def close(self):
+        with self.__lock:
+            self.__unmap()
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+
+    def __unmap(self):
+        if self.__map is not None:
+            self.__map.close()
+            self.__map = None
+
+    # ----------------------------------------------------------------
+    # index
+    # ----------------------------------------------------------------
+
+    def __load_index(self):
+        try:
+            with open(self.index_filename) as index_file:
+                index = json.load(index_file)
+        except (IOError, ValueError):
+            return
+        if index.get("version") != INDEX_VERSION:
+            return
+        self.__inode = index["inode"]
+        self.__mtime = index["mtime"]
+        self.__indexed_size = index["size"]
+        self.__scans = index["scans"]
+        self.__first_line = index["first_line"]
+
+    def __save_index(self):
+        index = dict(version=INDEX_VERSION, inode=self.__inode,
+                     mtime=self.__mtime, size=self.__indexed_size,
+                     scans=self.__scans, first_line=self.__first_line)
+        directory = os.path.dirname(self.index_filename)
+        try:
+            fd, tmp_name = tempfile.mkstemp(prefix=".tsidx", dir=directory)
+            with os.fdopen(fd, "w") as tmp_file:
+                json.dump(index, tmp_file)
+            os.rename(tmp_name, self.index_filename)
+        except (IOError, OSError):
+            # read-only directory: the index is only kept in memory
+            self.__log.debug("Could not save index %s", self.index_filename,
+                             exc_info=1)
+
+    def __reset(self):
+        self.__unmap()
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+        self.__mtime = None
+        self.__indexed_size = 0
+        self.__scans = []
+        self.__first_line = None
+
+    def update(self):
+        """Indexes the scans appended to the file since the last update.
+        Returns the number of new scans"""
+        with self.__lock:
+            try:
+                stat = os.stat(self.filename)
+            except OSError as error:
+                raise DataFileError("Cannot access data file {0}: {1}"
+                                    .format(self.filename, error))
+            size = stat.st_size
+            if stat.st_ino != self.__inode or size < self.__indexed_size or \
+               (size == self.__indexed_size and
+                stat.st_mtime != self.__mtime):
+                # new, truncated or rewritten file
+                self.__reset()
+                self.__inode = stat.st_ino
+            if self.__map is None or len(self.__map) < size:
+                self.__remap(size)
+            if self.__scans and \
+               self.__line(self.__scans[0][1]) != self.__first_line:
+                # another file (reused inode) or rewritten file
+                self.__reset()
+                self.__inode = stat.st_ino
+                self.__remap(size)
+            if size <= self.__indexed_size:
+                return 0
+            nb_scans = len(self.__scans)
+            self.__index(self.__indexed_size, size)
+            self.__mtime = stat.st_mtime
+            self.__save_index()
+            return len(self.__scans) - nb_scans
+
+    def __remap(self, size):
+        self.__unmap()
+        if size == 0:
+            return
+        if self.__file is None:
+            self.__file = open(self.filename, "rb")
+        import mmap
+        self.__map = mmap.mmap(self.__file.fileno(), size,
+                               access=mmap.ACCESS_READ)
+
+    def __index(self, start, end):
+        data = self.__map
+        # only complete lines are indexed
+        end = data.rfind(b"\n", start, end) + 1
+        if end <= start:
+            return
+        if start == 0 and data[:3] == b"#S ":
+            self.__add_scan(0)
+        pos = start - 1 if start else 0
+        while True:
+            pos = data.find(b"\n#S ", pos, end)
+            if pos < 0:
+                break
+            pos += 1
+            self.__add_scan(pos)
+        self.__indexed_size = end
+
+    def __add_scan(self, offset):
+        line = self.__line(offset)
+        try:
+            number = int(line.split()[1])
+        except (IndexError, ValueError):
+            self.__log.warning("Invalid scan header at %d: %r", offset, line)
+            return
+        if not self.__scans:
+            self.__first_line = line
+        self.__scans.append([number, offset])
+
+    def __line(self, offset):
+        data = self.__map
+        end = data.find(b"\n", offset)
+        if end < 0:
+            end = len(data)
+        return data[offset:end].decode("utf-8", "replace")
+
+    # ----------------------------------------------------------------
+    # scans
+    # ----------------------------------------------------------------
+
+    def list_scans(self, first=None, last=None):
+        """Returns the list of (scan number, scan command) of the scans
+        with a number between first and last (included)"""
+        with self.__lock:
+            self.update()
+            result = []
+            for number, offset in self.__scans:
+                if (first is None or number >= first) and \
+                   (last is None or number <= last):
+                    header = self.__line(offset).split(None, 2)
+                    result.append((number, header[2] if len(header) > 2
+                                   else ""))
+            return result
+
+    def __find(self, number):
+        """Returns (start, end) offsets of the given scan (the last one if
+        the number was used several times, from the end if negative)"""
+        scans = self.__scans
+        if number < 0:
+            if -number > len(scans):
+                raise DataFileError("No scan {0}".format(number))
+            index = len(scans) + number
+        else:
+            for index in range(len(scans) - 1, -1, -1):
+                if scans[index][0] == number:
+                    break
+            else:
+                raise DataFileError("No scan {0}".format(number))
+        start = scans[index][1]
+        if index + 1 < len(scans):
+            end = scans[index + 1][1]
+        else:
+            # current scan: up to the last complete line
+            end = self.__indexed_size
+        return start, end
+
+    def get_scan(self, number, columns=None):
+        """Returns (column names, data) of the given scan. data is a 2D
+        numpy array (one row per point). columns is an optional list of
+        the names of the columns to return"""
+        import numpy
+        with self.__lock:
+            self.update()
+            start, end = self.__find(number)
+            text = self.__map[start:end]
+        names, rows = None, []
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith(b"#L "):
+                # labels are separated by two spaces
+                names = [name.strip() for name in
+                         line[3:].decode("utf-8", "replace").split("  ")
+                         if name.strip()]
+            elif not line.startswith((b"#", b"@")):
+                rows.append(line)
+        if names is None:
+            names = []
+        ncols = len(names)
+        data = numpy.fromstring(b" ".join(rows), sep=" ") if rows \
+               else numpy.empty(0)
+        if ncols and len(data) == len(rows) * ncols:
+            data = data.reshape(len(rows), ncols)
+        else:
+            # incomplete or irregular rows: keep the complete ones
+            rows = [numpy.fromstring(row, sep=" ") for row in rows]
+            ncols = ncols or max([len(row) for row in rows] or [0])
+            rows = [row for row in rows if len(row) == ncols]
+            data = numpy.array(rows).reshape(len(rows), ncols)
+            names = names or ["col{0}".format(i) for i in range(ncols)]
+        if columns:
+            try:
+                indexes = [names.index(column) for column in columns]
+            except ValueError as error:
+                raise DataFileError("Unknown column in {0}: {1}"
+                                    .format(columns, error))
+            names, data = list(columns), data[:, indexes]
+        return names, data
+
+
+def execute(f, *args):
+    """Executes f(*args) in the data file worker thread (indexing a large
+    file must neither block the gevent loop nor the element tasks of the
+    tango workers) and returns its result"""
+    worker = TangoWorker("DataFile", size=1)
+    return worker.execute(f, *args).result(REQUEST_TIMEOUT)
+
+
+# dict<(filename, index directory): DataFile>
+__DATA_FILES = {}
+def get_data_file(filename, index_directory=None):
+    """Returns the (shared) :class:`DataFile` for the given file name"""
+    key = os.path.abspath(filename), index_directory
+    data_file = __DATA_FILES.get(key)
+    if data_file is None:
+        data_file = DataFile(filename, index_directory=index_directory)
+        __DATA_FILES[key] = data_file
+    return data_file
@@ -0,0 +1,447 @@
+# -*- coding: utf-8 -*-
+
+#------------------------------------------------------------------------------
+# This file is part of the Tango SPEC device server
+#
+# Copyright (c) 2014, European Synchrotron Radiation Facility.
+# Distributed under the GNU Lesser General Public License.
+# See LICENSE.txt for more info.
+#------------------------------------------------------------------------------
+
+"""Client load generator for a running TangoSpec server.
+
+Simulated TANGO_ clients subscribe to the ``Output`` event of a Spec
+device and to the ``Position``/``Value`` events of its motors/counters,
+poll its variables and execute commands at given rates. The client side
+latencies and the missed events are reported as JSON.
+
+Event latency is the difference between the reception time and the event
+timestamp set by the server (client and server clocks must be
+synchronized). Only the events with a timestamp in the measurement window
+(after a warmup period) are accounted.
+
+Missed events are the events pushed by the server during the window (its
+``tangospec_events_total`` metrics, read at the start and at the end of
+the window: the ``MetricsPort`` of the Spec device must be set) that a
+client did not receive. Without the server metrics, they are only relative
+between clients: an event received by one client and not by another is
+reported as missed, an event missed by all clients is not
+(``missed_events_reference`` is then ``clients`` instead of ``server``).
+
+Examples::
+
+    $ TangoSpecLoad id00/spec/fourc --clients 20 --duration 60
+    $ TangoSpecLoad id00/spec/fourc --clients 50 --processes 5 \\
+          --poll-rate 10 --cmd-rate 1 --command "p 1" -o load.json
+"""
+
+import re
+import time
+import json
+import logging
+import argparse
+import threading
+import collections
+
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
+from PyTango import DeviceProxy, EventType
+
+#: attribute subscribed per element list attribute of the Spec device
+ELEMENT_EVENTS = (("MotorList", "Position"), ("CounterList", "Value"))
+
+#: server metric of the events pushed per device attribute
+EVENTS_METRIC = "tangospec_events_total"
+
+_EVENTS_METRIC_RE = re.compile(EVENTS_METRIC + r'\{device="(?P<device>[^"]*)",'
+                               r'attribute="(?P<attribute>[^"]*)"\}\s+'
+                               r'(?P<value>\S+)$')
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    """Returns dict<'p<n>': value> (plus min, max, mean, n) of the
+    samples"""
+    if not samples:
+        return dict(n=0)
+    samples = sorted(samples)
+    n = len(samples)
+    result = dict(("p{0}".format(p), samples[min(n - 1, int(n * p / 100.0))])
+                  for p in points)
+    result.update(min=samples[0], max=samples[-1],
+                  mean=sum(samples) / float(n), n=n)
+    return result
+
+
+def discover(spec_device, max_elements=None):
+    """Returns the list of (device name, attribute name) to subscribe to
+    and the list of variable attribute names of the given Spec device"""
+    spec = DeviceProxy(spec_device)
+    events = [(spec_device, "Output")]
+    for list_name, attr_name in ELEMENT_EVENTS:
+        elements = spec.read_attribute(list_name).value or ()
+        for element in elements[:max_elements]:
+            events.append((element.split()[1], attr_name))
+    variables = [variable.split()[1] for variable
+                 in spec.read_attribute("VariableList").value or ()]
+    return events, variables
+
+
+def metrics_url(spec_device):
+    """Returns the URL of the metrics of the server of the given Spec
+    device or None if its metrics are disabled (MetricsPort)"""
+    proxy = DeviceProxy(spec_device)
+    props = proxy.get_property(["MetricsPort", "MetricsHost"])
+    port = int((props["MetricsPort"] or [0])[0])
+    if not port:
+        return None
+    host = (props["MetricsHost"] or ["127.0.0.1"])[0]
+    if host in ("", "0.0.0.0"):
+        host = proxy.info().server_host
+    return "http://{0}:{1}/metrics".format(host, port)
+
+
+def read_server_events(url, timeout=5):
+    """Returns the number of events pushed by the server per (device name,
+    attribute name) (lower case), read from its metrics"""
+    text = urlopen(url, timeout=timeout).read().decode('utf-8')
+    events = {}
+    for line in text.splitlines():
+        match = _EVENTS_METRIC_RE.match(line)
+        if match is not None:
+            key = match.group('device').lower(), \
+                  match.group('attribute').lower()
+            events[key] = float(match.group('value'))
+    return events
+
+
+class ServerEvents(object):
+    """Reads the server event totals at the start and at the end of the
+    measurement window [start, end[ (in a thread)"""
+
+    def __init__(self, url, start, end):
+        self.url = url
+        self.start = start
+        self.end = end
+        self.before = self.after = None
+        self.__log = logging.getLogger("TangoSpec.Load")
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __read(self, at):
+        time.sleep(max(0, at - time.time()))
+        try:
+            return read_server_events(self.url)
+        except Exception:
+            self.__log.warning("Failed to read the server metrics from %s",
+                               self.url, exc_info=1)
+
+    def __run(self):
+        self.before = self.__read(self.start)
+        if self.before is not None:
+            self.after = self.__read(self.end)
+
+    def counts(self):
+        """Returns dict<(device name, attribute name): events pushed during
+        the window> or None if the metrics could not be read"""
+        self.__thread.join()
+        if self.before is None or self.after is None:
+            return None
+        return dict((key, int(n - self.before.get(key, 0)))
+                    for key, n in self.after.items())
+
+
+class _EventCallback(object):
+
+    def __init__(self, stats, key):
+        self.stats = stats
+        self.key = key
+
+    def push_event(self, event):
+        now = time.time()
+        stats = self.stats
+        if event.err:
+            if stats.start <= now < stats.end:
+                with stats.lock:
+                    stats.event_errors[self.key] += 1
+            return
+        timestamp = event.attr_value.time.totime()
+        if stats.start <= timestamp < stats.end:
+            with stats.lock:
+                stats.events[self.key] += 1
+                stats.event_latency[self.key[1]].append(now - timestamp)
+
+
+class ClientStats(object):
+    """Samples and counters of a simulated client during the measurement
+    window [start, end["""
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.lock = threading.Lock()
+        # dict<(device name, attribute name): int>
+        self.events = collections.Counter()
+        self.event_errors = collections.Counter()
+        # dict<attribute name: list<latency (s)>>
+        self.event_latency = collections.defaultdict(list)
+        self.poll_latency = []
+        self.poll_errors = 0
+        self.cmd_latency = []
+        self.cmd_errors = 0
+
+    def to_dict(self):
+        with self.lock:
+            return dict(events=[(k[0], k[1], v)
+                                for k, v in self.events.items()],
+                        event_errors=sum(self.event_errors.values()),
+                        event_latency=dict(self.event_latency),
+                        poll_latency=list(self.poll_latency),
+                        poll_errors=self.poll_errors,
+                        cmd_latency=list(self.cmd_latency),
+                        cmd_errors=self.cmd_errors)
+
+
+class LoadClient(object):
+    """A simulated TANGO_ client of a Spec device"""
+
+    def __init__(self, spec_device, events, variables, start, end,
+                 poll_rate=0, cmd_rate=0, command="p 0"):
+        self.spec_device = spec_device
+        self.event_attributes = events
+        self.variables = variables
+        self.poll_rate = poll_rate
+        self.cmd_rate = cmd_rate
+        self.command = command
+        self.stats = ClientStats(start, end)
+        self.__log = logging.getLogger("TangoSpec.Load")
+        self.__stop = threading.Event()
+        self.__threads = []
+        self.__subscriptions = []
+
+    def start(self):
+        proxies = {}
+        for dev_name, attr_name in self.event_attributes:
+            proxy = proxies.get(dev_name)
+            if proxy is None:
+                proxy = proxies[dev_name] = DeviceProxy(dev_name)
+            callback = _EventCallback(self.stats, (dev_name, attr_name))
+            try:
+                event_id = proxy.subscribe_event(attr_name,
+                                                 EventType.CHANGE_EVENT,
+                                                 callback)
+            except Exception:
+                self.__log.warning("Failed to subscribe to %s/%s",
+                                   dev_name, attr_name, exc_info=1)
+                continue
+            self.__subscriptions.append((proxy, event_id))
+        if self.poll_rate > 0 and self.variables:
+            self.__start_thread(self.__poll)
+        if self.cmd_rate > 0:
+            self.__start_thread(self.__execute)
+
+    def stop(self):
+        self.__stop.set()
+        for thread in self.__threads:
+            thread.join()
+        for proxy, event_id in self.__subscriptions:
+            try:
+                proxy.unsubscribe_event(event_id)
+            except Exception:
+                pass
+        self.__subscriptions = []
+
+    def __start_thread(self, target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        self.__threads.append(thread)
+
+    def __paced(self, rate, f):
+        self.__stop.wait(max(0, self.stats.start - time.time()))
+        period, next_time = 1.0 / rate, time.time()
+        while not self.__stop.is_set() and next_time < self.stats.end:
+            f()
+            next_time += period
+            delay = next_time - time.time()
+            if delay > 0:
+                self.__stop.wait(delay)
+            else:
+                # late: don't try to catch up
+                next_time = time.time()
+
+    def __poll(self):
+        proxy = DeviceProxy(self.spec_device)
+        variables, index, stats = self.variables, [0], self.stats
+        def poll():
+            variable = variables[index[0] % len(variables)]
+            index[0] += 1
+            start = time.time()
+            try:
+                proxy.read_attribute(variable)
+            except Exception:
+                with stats.lock:
+                    stats.poll_errors += 1
+            else:
+                with stats.lock:
+                    stats.poll_latency.append(time.time() - start)
+        self.__paced(self.poll_rate, poll)
+
+    def __execute(self):
+        proxy = DeviceProxy(self.spec_device)
+        stats = self.stats
+        def execute():
+            start = time.time()
+            try:
+                proxy.ExecuteCmd(self.command)
+            except Exception:
+                with stats.lock:
+                    stats.cmd_errors += 1
+            else:
+                with stats.lock:
+                    stats.cmd_latency.append(time.time() - start)
+        self.__paced(self.cmd_rate, execute)
+
+
+def run_clients(options):
+    """Runs options['clients'] clients which measure between
+    options['start'] and options['start'] + options['duration'] (absolute
+    times). Returns the list of the client statistics (as dicts)"""
+    events, variables = discover(options['spec_device'],
+                                 options.get('max_elements'))
+    if options.get('variables'):
+        variables = options['variables']
+    start = options['start']
+    end = start + options['duration']
+    clients = [LoadClient(options['spec_device'], events, variables,
+                          start, end, poll_rate=options.get('poll_rate', 0),
+                          cmd_rate=options.get('cmd_rate', 0),
+                          command=options.get('command', "p 0"))
+               for _ in range(options['clients'])]
+    for client in clients:
+        client.start()
+    # give the last events of the window time to arrive
+    time.sleep(max(0, end - time.time()) + options.get('grace', 1.0))
+    for client in clients:
+        client.stop()
+    return [client.stats.to_dict() for client in clients]
+
+
+def summarize(results, duration, events=(), server_events=None):
+    """Merges the statistics of all clients into a report. Missed events
+    are counted against *server_events* (see :meth:`ServerEvents.counts`)
+    for the subscribed *events* (list<(device name, attribute name)>) or,
+    if not given, against the best client"""
+    # dict<(device name, attribute name): list<events per client>>
+    received = collections.defaultdict(list)
+    for result in results:
+        for dev_name, attr_name, n in result['events']:
+            received[dev_name.lower(), attr_name.lower()].append(n)
+    for counts in received.values():
+        counts += [0] * (len(results) - len(counts))
+    missed = 0
+    if server_events is not None:
+        for dev_name, attr_name in events:
+            key = dev_name.lower(), attr_name.lower()
+            pushed = server_events.get(key, 0)
+            counts = received.get(key) or [0] * len(results)
+            missed += sum(max(0, pushed - n) for n in counts)
+    else:
+        for counts in received.values():
+            missed += sum(max(counts) - n for n in counts)
+
+    event_latency = collections.defaultdict(list)
+    poll_latency, cmd_latency = [], []
+    for result in results:
+        for attr_name, samples in result['event_latency'].items():
+            event_latency[attr_name].extend(samples)
+        poll_latency.extend(result['poll_latency'])
+        cmd_latency.extend(result['cmd_latency'])
+
+    nb_events = sum(sum(counts) for counts in received.values())
+    return dict(clients=len(results), duration=duration,
+                events=nb_events, events_per_second=nb_events / duration,
+                missed_events=missed,
+                missed_events_reference="clients" if server_events is None
+                                        else "server",
+                event_errors=sum(r['event_errors'] for r in results),
+                event_latency=dict((attr_name, percentiles(samples))
+                                   for attr_name, samples
+                                   in event_latency.items()),
+                poll_latency=percentiles(poll_latency),
+                poll_errors=sum(r['poll_errors'] for r in results),
+                cmd_latency=percentiles(cmd_latency),
+                cmd_errors=sum(r['cmd_errors'] for r in results))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("spec_device", help="Spec TANGO device name")
+    parser.add_argument("-c", "--clients", type=int, default=10,
+                        help="number of simulated clients")
+    parser.add_argument("-p", "--processes", type=int, default=1,
+                        help="number of processes the clients are spread on")
+    parser.add_argument("-d", "--duration", type=float, default=30,
+                        help="duration (s) of the measurement")
+    parser.add_argument("-w", "--warmup", type=float, default=5,
+                        help="time (s) given to the clients to connect and "
+                        "subscribe before the measurement starts")
+    parser.add_argument("--max-elements", type=int, default=None,
+                        help="maximum number of motors (and counters) "
+                        "each client subscribes to")
+    parser.add_argument("--variable", dest="variables", action="append",
+                        help="variable attribute to poll (default: all)")
+    parser.add_argument("--poll-rate", type=float, default=0,
+                        help="variable reads per second per client")
+    parser.add_argument("--cmd-rate", type=float, default=0,
+                        help="ExecuteCmd per second per client")
+    parser.add_argument("--command", default="p 0",
+                        help="SPEC command executed by the clients")
+    parser.add_argument("--metrics-url", default=None,
+                        help="URL of the server metrics, to count the "
+                        "missed events (default: from the MetricsPort and "
+                        "MetricsHost of the Spec device)")
+    parser.add_argument("-o", "--output", help="JSON output file "
+                        "(default: stdout)")
+    args = parser.parse_args(argv)
+
+    options = vars(args)
+    options['start'] = time.time() + args.warmup
+    events, _ = discover(args.spec_device, args.max_elements)
+    url = args.metrics_url or metrics_url(args.spec_device)
+    server_events = None
+    if url:
+        server_events = ServerEvents(url, options['start'],
+                                     options['start'] + args.duration)
+    processes = max(1, min(args.processes, args.clients))
+    if processes == 1:
+        results = run_clients(options)
+    else:
+        import multiprocessing
+        jobs = []
+        for i in range(processes):
+            job = dict(options)
+            job['clients'] = args.clients // processes + \
+                             (i < args.clients % processes)
+            jobs.append(job)
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = [result for job_results in pool.map(run_clients, jobs)
+                       for result in job_results]
+        finally:
+            pool.close()
+
+    if server_events is not None:
+        server_events = server_events.counts()
+    report = summarize(results, args.duration, events=events,
+                       server_events=server_events)
+    report['parameters'] = options
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+    else:
+        print(text)
@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+
+#------------------------------------------------------------------------------
+# This file is part of the Tango SPEC device server
+#
+# Copyright (c) 2014, European Synchrotron Radiation Facility.
+# Distributed under the GNU Lesser General Public License.
+# See LICENSE.txt for more info.
+#------------------------------------------------------------------------------
+
+"""In-process metrics of the TangoSpec server, exported in Prometheus text
+format over HTTP.
+
+Metrics are plain python objects: incrementing a counter on a hot path is
+a dict lookup and an addition. Values which are already kept elsewhere
+(channel statistics, worker queues, registry) are read by collectors only
+when the metrics are scraped."""
+
+import time
+import logging
+import collections
+
+#: metric types
+COUNTER, GAUGE, SUMMARY = "counter", "gauge", "summary"
+
+_string_types = bytes, type(u'')
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n") \
+                     .replace('"', '\\"')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(name, _escape(value))
+                          for name, value in zip(names, values)) + "}"
+
+
+class _Child(object):
+
+    __slots__ = ('value', 'sum')
+
+    def __init__(self):
+        self.value = 0
+        self.sum = 0.0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def set(self, value):
+        self.value = value
+
+    def observe(self, value):
+        self.value += 1
+        self.sum += value
+
+
+class Metric(object):
+    """A metric with optional labels. Use :meth:`labels` once to get the
+    child of a label set and keep it to update it cheaply"""
+
+    def __init__(self, name, doc, mtype=COUNTER, labels=()):
+        self.name = name
+        self.doc = doc
+        self.type = mtype
+        self.label_names = tuple(labels)
+        # dict<label values: _Child>
+        self.children = {}
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children.setdefault(values, _Child())
+        return child
+
+    def inc(self, n=1):
+        self.labels().inc(n)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def render(self, lines):
+        lines.append("# HELP {0} {1}".format(self.name, self.doc))
+        lines.append("# TYPE {0} {1}".format(self.name, self.type))
+        for values, child in sorted(self.children.items()):
+            labels = _format_labels(self.label_names, values)
+            if self.type == SUMMARY:
+                lines.append("{0}_count{1} {2}".format(self.name, labels,
+                                                       child.value))
+                lines.append("{0}_sum{1} {2!r}".format(self.name, labels,
+                                                       child.sum))
+            else:
+                lines.append("{0}{1} {2!r}".format(self.name, labels,
+                                                   child.value))
+
+
+class MetricsRegistry(object):
+    """Registry of the metrics and collectors of the server"""
+
+    def __init__(self):
+        # dict<name: Metric>
+        self.metrics = {}
+        self.collectors = []
+
+    def metric(self, name, doc, mtype=COUNTER, labels=()):
+        """Returns the metric with the given name (created if needed)"""
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = Metric(name, doc, mtype=mtype, labels=labels)
+            self.metrics[name] = metric
+        return metric
+
+    def add_collector(self, collector):
+        """Adds a collector: a callable called with the registry before
+        rendering (to update gauges)"""
+        self.collectors.append(collector)
+
+    def render(self):
+        """Returns the metrics in Prometheus text format"""
+        for collector in self.collectors:
+            try:
+                collector(self)
+            except:
+                logging.debug("Failed to run metrics collector %s",
+                              collector, exc_info=1)
+        lines = []
+        for name in sorted(self.metrics):
+            self.metrics[name].render(lines)
+        lines.append("")
+        return "\n".join(lines)
+
+
+#: the server wide metrics registry
+metrics = MetricsRegistry()
+
+events = metrics.metric("tangospec_events_total",
+                        "TANGO events pushed per device attribute",
+                        labels=("device", "attribute"))
+
+command_seconds = metrics.metric("tangospec_spec_command_seconds",
+                                 "SPEC command execution time",
+                                 mtype=SUMMARY, labels=("spec",))
+
+event_bytes = metrics.metric("tangospec_event_bytes_total",
+                             "Estimated payload bytes of the TANGO events "
+                             "pushed per device attribute",
+                             labels=("device", "attribute"))
+
+
+def payload_size(value):
+    """Returns an estimation of the size (bytes) of a value"""
+    if isinstance(value, _string_types):
+        return len(value)
+    nbytes = getattr(value, 'nbytes', None)
+    if nbytes is not None:
+        return nbytes
+    if isinstance(value, dict):
+        return sum(payload_size(k) + payload_size(v)
+                   for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(payload_size(v) for v in value)
+    return 8
+
+
+class EventStats(object):
+    """Events pushed on a device attribute: totals (exported as metrics)
+    and per second buckets of the last *window* seconds"""
+
+    __slots__ = ('device_name', 'attr_name', 'events', 'bytes', 'second',
+                 'second_events', 'second_bytes', 'buckets')
+
+    def __init__(self, device_name, attr_name, window):
+        self.device_name = device_name
+        self.attr_name = attr_name
+        self.events = events.labels(device_name, attr_name)
+        self.bytes = event_bytes.labels(device_name, attr_name)
+        self.second = 0
+        self.second_events = self.second_bytes = 0
+        # deque<(second, events, bytes)>
+        self.buckets = collections.deque(maxlen=window)
+
+    def add(self, size):
+        now = int(time.time())
+        if now != self.second:
+            if self.second_events:
+                self.buckets.append((self.second, self.second_events,
+                                     self.second_bytes))
+            self.second, self.second_events, self.second_bytes = now, 0, 0
+        self.second_events += 1
+        self.second_bytes += size
+        self.events.value += 1
+        self.bytes.value += size
+
+    def rates(self, window, now=None):
+        """Returns (events/s, bytes/s) over the last *window* seconds"""
+        start = int(time.time() if now is None else now) - window
+        nb_events = nb_bytes = 0
+        for second, n, size in list(self.buckets) + \
+                [(self.second, self.second_events, self.second_bytes)]:
+            if second > start:
+                nb_events += n
+                nb_bytes += size
+        return nb_events / float(window), nb_bytes / float(window)
+
+
+class _Events(object):
+
+    def __init__(self, window=60):
+        self.window = window
+        # dict<(device, attribute name): EventStats>
+        self.stats = {}
+
+
+__EVENTS = _Events()
+
+
+def set_event_window(window):
+    """Sets the sliding window (s) of the event rates"""
+    state = __EVENTS
+    window = max(int(window), 1)
+    if window != state.window:
+        state.window = window
+        for stats in list(state.stats.values()):
+            stats.buckets = collections.deque(stats.buckets, maxlen=window)
+
+
+def push_event(device, attr_name, *args):
+    """Pushes a change event and accounts it (number of events and
+    payload size) in the event statistics of the attribute"""
+    key = device, attr_name
+    stats = __EVENTS.stats.get(key)
+    if stats is None:
+        stats = EventStats(device.get_name(), attr_name, __EVENTS.window)
+        stats = __EVENTS.stats.setdefault(key, stats)
+    stats.add(payload_size(args[0]) if args else 0)
+    device.push_change_event(attr_name, *args)
+
+
+def get_hot_attributes(n=10):
+    """Returns the list of the *n* attributes which pushed the most events
+    over the event window: ``<device> <attribute> <events/s> <bytes/s>``"""
+    window, now = __EVENTS.window, time.time()
+    rates = []
+    for stats in list(__EVENTS.stats.values()):
+        event_rate, byte_rate = stats.rates(window, now)
+        if event_rate:
+            rates.append((event_rate, byte_rate, stats.device_name,
+                          stats.attr_name))
+    rates.sort(key=lambda rate: (-rate[0], -rate[1]))
+    return ["{2} {3} {0:.2f} {1:.1f}".format(*rate) for rate in rates[:n]]
+
+
+def forget_device(device):
+    """Forgets the event statistics of a deleted device, exported totals
+    included"""
+    for key in list(__EVENTS.stats):
+        if key[0] is device:
+            stats = __EVENTS.stats.pop(key)
+            labels = stats.device_name, stats.attr_name
+            events.children.pop(labels, None)
+            event_bytes.children.pop(labels, None)
+
+
+class timed(object):
+    """Context manager which observes the time spent in it in a summary
+    child"""
+
+    __slots__ = ('child', 'start')
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.child.observe(time.time() - self.start)
+
+
+def _collect_server(registry):
+    from TangoSpec.SpecCommon import registry as elements, get_workers
+    from TangoSpec.SpecSession import get_sessions
+
+    devices = registry.metric("tangospec_devices",
+                              "Number of TANGO devices per class",
+                              mtype=GAUGE, labels=("class",))
+    for class_name in elements.get_class_names():
+        devices.labels(class_name).set(len(elements.get_devices(class_name)))
+
+    queue = registry.metric("tangospec_worker_queue_depth",
+                            "Number of pending tango worker tasks",
+                            mtype=GAUGE, labels=("worker",))
+    failed = registry.metric("tangospec_worker_failed_tasks_total",
+                             "Number of failed tango worker tasks",
+                             labels=("worker",))
+    for worker in get_workers().values():
+        name = worker.name
+        queue.labels(name).set(worker.queue_depth)
+        failed.labels(name).set(worker.failed)
+
+    # channel totals (ResetChannelStatistics does not reset them)
+    channel_metrics = [
+        (registry.metric("tangospec_spec_messages_in_total",
+                         "SPEC messages received per channel",
+                         labels=("spec", "channel")),
+         'messages_in'),
+        (registry.metric("tangospec_spec_messages_out_total",
+                         "SPEC messages sent per channel",
+                         labels=("spec", "channel")),
+         'messages_out'),
+        (registry.metric("tangospec_spec_bytes_in_total",
+                         "SPEC bytes received per channel",
+                         labels=("spec", "channel")),
+         'bytes_in'),
+        (registry.metric("tangospec_spec_bytes_out_total",
+                         "SPEC bytes sent per channel",
+                         labels=("spec", "channel")),
+         'bytes_out'),
+        (registry.metric("tangospec_spec_callback_seconds_total",
+                         "Time spent in SPEC callbacks per channel",
+                         labels=("spec", "channel")),
+         'callback_time'),
+    ]
+    attempts = registry.metric("tangospec_connect_attempts_total",
+                               "Element connection attempts to SPEC",
+                               labels=("spec",))
+    failures = registry.metric("tangospec_connect_failures_total",
+                               "Failed element connection attempts to SPEC",
+                               labels=("spec",))
+    pending = registry.metric("tangospec_pending_connections",
+                              "Element connections to SPEC waiting to be "
+                              "made", mtype=GAUGE, labels=("spec",))
+    reconnects = registry.metric("tangospec_reconnects_total",
+                                 "Number of complete reconnections to SPEC",
+                                 labels=("spec",))
+    for name, session in get_sessions().items():
+        for channel, stats in list(session.channels.items()):
+            for metric, field in channel_metrics:
+                metric.labels(name, channel).set(getattr(stats, field))
+        scheduler = session.scheduler
+        attempts.labels(name).set(scheduler.attempts)
+        failures.labels(name).set(scheduler.failures)
+        pending.labels(name).set(scheduler.pending)
+        reconnects.labels(name).set(scheduler.reconnects)
+
+
+metrics.add_collector(_collect_server)
+
+
+def _application(environ, start_response):
+    if environ.get('PATH_INFO', '/') not in ('/', '/metrics'):
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return [b"not found\n"]
+    body = metrics.render().encode('utf-8')
+    start_response('200 OK', [('Content-Type',
+                               'text/plain; version=0.0.4; charset=utf-8'),
+                              ('Content-Length', str(len(body)))])
+    return [body]
+
+
+# dict<(host, port): WSGIServer>
+__SERVERS = {}
+
+
+def start_metrics_server(port, host='127.0.0.1'):
+    """Starts (once) the HTTP server of the metrics in the gevent loop"""
+    key = host, port
+    server = __SERVERS.get(key)
+    if server is None:
+        from gevent.pywsgi import WSGIServer
+        server = WSGIServer(key, _application, log=None)
+        server.start()
+        __SERVERS[key] = server
+    return server
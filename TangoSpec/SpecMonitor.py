@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+#------------------------------------------------------------------------------
+# This file is part of the Tango SPEC device server
+#
+# Copyright (c) 2014, European Synchrotron Radiation Facility.
+# Distributed under the GNU Lesser General Public License.
+# See LICENSE.txt for more info.
+#------------------------------------------------------------------------------
+
+"""gevent hub monitoring: loop latency and blocking greenlet detection."""
+
+import sys
+import time
+import logging
+import threading
+import traceback
+
+import gevent
+import greenlet
+
+from TangoSpec.SpecCommon import RollingStats
+from TangoSpec.SpecProfiler import greenlet_name
+
+
+class LoopMonitor(object):
+    """Monitors the gevent hub of the thread which starts it.
+
+    A greenlet sleeps *interval* seconds in a loop and measures how late
+    it wakes up (loop latency). A thread checks that greenlets keep
+    switching: when the same greenlet runs for more than *threshold*
+    seconds without giving control back to the hub, its stack is logged
+    (once per blocking episode). The interval must be smaller than the
+    threshold (:meth:`start` raises ValueError otherwise)."""
+
+    def __init__(self, interval=0.1, threshold=0.5, maxlen=1000):
+        self.interval = interval
+        self.threshold = threshold
+        self.latency = RollingStats(maxlen)
+        self.blocked = 0
+        self.__log = logging.getLogger("TangoSpec.LoopMonitor")
+        self.__task = None
+        self.__thread = None
+        self.__stop = threading.Event()
+        self.__previous_trace = None
+        self.__tracing = False
+        self.__switches = 0
+        self.__active = None
+        self.__hub_thread_id = None
+
+    @property
+    def running(self):
+        return self.__task is not None
+
+    def start(self):
+        if self.running:
+            return
+        if self.interval <= 0 or self.interval >= self.threshold:
+            raise ValueError("Loop monitor interval ({0}s) must be positive "
+                             "and smaller than the blocking threshold "
+                             "({1}s)".format(self.interval, self.threshold))
+        self.__hub_thread_id = threading.current_thread().ident
+        self.__active = greenlet.getcurrent()
+        if not self.__tracing:
+            self.__previous_trace = greenlet.settrace(self.__trace)
+            self.__tracing = True
+        self.__stop = threading.Event()
+        self.__task = gevent.spawn(self.__measure)
+        self.__thread = threading.Thread(target=self.__watch,
+                                         args=(self.__stop,),
+                                         name="LoopMonitor")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        task, self.__task = self.__task, None
+        task.kill(block=False)
+        self.__stop.set()
+        # a tracer installed after this one (ex: the profiler) calls it:
+        # it is then left in place and only calls the previous tracer
+        if greenlet.gettrace() == self.__trace:
+            greenlet.settrace(self.__previous_trace)
+            self.__previous_trace = None
+            self.__tracing = False
+
+    def __trace(self, event, args):
+        if self.__task is not None and event in ('switch', 'throw'):
+            self.__switches += 1
+            self.__active = args[1]
+        if self.__previous_trace is not None:
+            self.__previous_trace(event, args)
+
+    def __measure(self):
+        while True:
+            start = time.time()
+            gevent.sleep(self.interval)
+            self.latency.add(max(0.0, time.time() - start - self.interval))
+
+    def __watch(self, stop):
+        # the measure greenlet switches every interval: no switch during a
+        # whole threshold period means the active greenlet is blocking
+        last_switches, reported = None, False
+        while not stop.wait(self.threshold):
+            switches = self.__switches
+            if switches != last_switches:
+                last_switches, reported = switches, False
+            elif not reported:
+                reported = True
+                self.__report()
+
+    def __report(self):
+        self.blocked += 1
+        active = self.__active
+        frame = sys._current_frames().get(self.__hub_thread_id)
+        stack = "".join(traceback.format_stack(frame)) if frame else "?"
+        self.__log.warning("gevent hub blocked for more than %.3fs by %s:"
+                           "\n%s", self.threshold,
+                           "?" if active is None else greenlet_name(active),
+                           stack)
+
+
+__LOOP_MONITOR = None
+def get_loop_monitor(interval=None, threshold=None):
+    """Returns the server wide loop monitor (started from the gevent
+    thread). The given interval and threshold, if any, are applied"""
+    global __LOOP_MONITOR
+    if __LOOP_MONITOR is None:
+        __LOOP_MONITOR = LoopMonitor()
+    if interval is not None:
+        __LOOP_MONITOR.interval = interval
+    if threshold is not None:
+        __LOOP_MONITOR.threshold = threshold
+    return __LOOP_MONITOR
@@ -20,17 +20,24 @@ from PyTango import (DevState, DispLevel, AttrWriteType, AttrQuality,
 from PyTango.server import (Device, DeviceMeta, attribute, command,
                             device_property)
 
-from SpecClient_gevent.SpecMotor import SpecMotorA
 from SpecClient_gevent.SpecClientError import SpecClientError
 
+from TangoSpec.SpecSession import get_session, get_reconnect_scheduler
 from TangoSpec.SpecCommon import (SpecMotorState_2_TangoState, switch_state,
-                                  find_spec_name)
+                                  find_spec_name, RollingStats, registry)
+from TangoSpec.SpecMetrics import push_event, forget_device
+from TangoSpec.SpecSnapshot import get_snapshot, MOTORS
 
 
 #: read-write scalar float attribute helper
 float_rw_mem_attr = partial(attribute, dtype=float, memorized=True,
                             access=AttrWriteType.READ_WRITE)
 
+#: read-only move statistics attribute helper
+move_stats_attr = partial(attribute, dtype=(float,), max_dim_x=5,
+                          access=AttrWriteType.READ,
+                          display_level=DispLevel.EXPERT)
+
 
 class SpecMotor(Device):
     """A TANGO SPEC motor device based on SpecClient."""
@@ -42,6 +49,16 @@ class SpecMotor(Device):
                                     "along with a Spec it can be "
                                     "just the motor name")
 
+    Backend = device_property(dtype=str, default_value="",
+                              doc="'spec' (SpecClient) or 'sim' "
+                                  "(in-process simulated SPEC). Empty "
+                                  "string means the backend of the "
+                                  "session (set by its Spec device)")
+
+    MoveStatisticsLength = device_property(dtype=int, default_value=100,
+                                           doc="number of moves kept in "
+                                               "the move statistics")
+
     Position = float_rw_mem_attr(doc="motor position", unit="mm",
                                  display_unit="mm", standard_unit="mm")
 
@@ -74,6 +91,20 @@ class SpecMotor(Device):
                                doc="limit switches (home, upper, "
                                    "lower)")
 
+    MoveStartLatency = move_stats_attr(unit="s",
+                                       doc="time from move request to "
+                                           "first MOVING state (last, "
+                                           "mean, min, max, nb. moves)")
+
+    MoveDuration = move_stats_attr(unit="s",
+                                   doc="time from move request to final "
+                                       "ON/ALARM state (last, mean, min, "
+                                       "max, nb. moves)")
+
+    MovePositionEvents = move_stats_attr(doc="number of position events "
+                                             "received per move (last, "
+                                             "mean, min, max, nb. moves)")
+
     @property
     def spec_motor(self):
         return self.__spec_motor
@@ -85,9 +116,22 @@ class SpecMotor(Device):
         return self.__spec_motor_name
 
     get_spec_name = get_spec_motor_name
+    get_spec_session = get_spec_version_name
+
+    def get_snapshot(self):
+        """Returns the last known values to be saved in the snapshot (or
+        None if nothing is known)"""
+        if self.__position is None:
+            return None
+        return dict(position=self.__position)
 
     def delete_device(self):
         Device.delete_device(self)
+        registry.unregister(self)
+        forget_device(self)
+        if self.__spec_version_name is not None:
+            scheduler = get_reconnect_scheduler(self.__spec_version_name)
+            scheduler.cancel(self.get_name())
         self.__spec_motor = None
 
     def init_device(self):
@@ -104,32 +148,53 @@ class SpecMotor(Device):
         self.__spec_motor = None
         self.__spec_motor_name = None
         self.__spec_version_name = None
+        self.__snapshot = None
+        self.__position = None
         self.__step_size = 1
+        self.__move_start = None
+        self.__move_moving = None
+        self.__move_events = 0
+        stats_length = self.MoveStatisticsLength
+        self.__move_start_latency = RollingStats(stats_length)
+        self.__move_duration = RollingStats(stats_length)
+        self.__move_position_events = RollingStats(stats_length)
 
         spec_info = find_spec_name(self, self.SpecMotor)
         if spec_info is None:
+            registry.register(self)
             return
         spec_version, motor = spec_info
         self.__spec_version_name = spec_version
         self.__spec_motor_name = motor
-
-        cb=dict(connected=self.__motorConnected,
-                disconnected=self.__motorDisconnected,
-                motorPositionChanged=self.__motorPositionChanged,
-                motorStateChanged=self.__motorStateChanged)
-                #motorLimitsChanged=self.__motorLimitsChanged)
+        self.__snapshot = get_snapshot(spec_version)
+        registry.register(self)
 
         try:
             self.__log.debug("Start creating Spec motor %s", motor)
-            self.__spec_motor = SpecMotorA(callbacks=cb)
+            self.__spec_motor = self.__newSpecMotor()
         except SpecClientError as spec_error:
             status = "Error creating Spec motor {0}".format(motor)
             switch_state(self, DevState.FAULT, status)
         else:
-            self.__motorConnect()
+            scheduler = get_reconnect_scheduler(spec_version)
+            scheduler.schedule(self.get_name(), self.__motorConnect)
         self.__log.debug("End creating Spec motor %s", motor)
 
+    def __newSpecMotor(self):
+        cb=dict(connected=self.__motorConnected,
+                disconnected=self.__motorDisconnected,
+                motorPositionChanged=self.__motorPositionChanged,
+                motorStateChanged=self.__motorStateChanged)
+                #motorLimitsChanged=self.__motorLimitsChanged)
+        session = get_session(self.__spec_version_name,
+                              backend=self.Backend or None)
+        return session.motor(self.__spec_motor_name, cb)
+
     def __motorConnect(self):
+        # already connected (the connection succeeded after a timeout)
+        if self.get_state() not in (DevState.INIT, DevState.FAULT,
+                                    DevState.OFF):
+            return
         motor = self.__spec_motor_name
         try:
             self.__spec_motor.connectToSpec(motor, self.__spec_version_name,
@@ -140,37 +205,70 @@ class SpecMotor(Device):
             raise
 
     def __motorConnected(self):
+        get_reconnect_scheduler(self.__spec_version_name).connected(
+            self.get_name())
         state = DevState.ON
         if self.get_state() != state:
             status = "Motor is now {0}".format(state)
             switch_state(self, state, status)
 
     def __motorDisconnected(self):
+        scheduler = get_reconnect_scheduler(self.__spec_version_name)
+        scheduler.disconnected(self.get_name())
         state = DevState.OFF
         if self.get_state() != state:
             status = "Motor is now %s".format(state)
             switch_state(self, state, status)
+        # drop the SpecClient motor so it doesn't re-register its channels
+        # on its own when SPEC is back: the scheduler reconnects a new one
+        # in batches with the other elements of the session
+        self.__spec_motor = self.__newSpecMotor()
+        scheduler.schedule(self.get_name(), self.__motorConnect)
 
     def __motorPositionChanged(self, position):
+        self.__position = position
+        if self.__move_start is not None:
+            self.__move_events += 1
         state = self.get_state()
         if state == DevState.MOVING:
-            self.push_change_event("Position", position, time.time(),
-                                   AttrQuality.ATTR_CHANGING)
+            push_event(self, "Position", position, time.time(),
+                       AttrQuality.ATTR_CHANGING)
         else:
-            self.push_change_event("Position", position)
+            push_event(self, "Position", position)
 
     def __motorStateChanged(self, spec_state):
         old_state = self.get_state()
         state = SpecMotorState_2_TangoState[spec_state]
+        if self.__move_start is not None:
+            self.__updateMoveStatistics(state)
 
         # Fire a position event with VALID quality
         if old_state == DevState.MOVING and state != DevState.MOVING:
             position = self.__spec_motor.getPosition()
-            self.push_change_event("Position", position)
+            push_event(self, "Position", position)
 
         # switch tango state and status attributes and send events
         switch_state(self, state, "Motor is now {0}".format(state))
 
+    def __startMove(self):
+        self.__move_start = time.time()
+        self.__move_moving = None
+        self.__move_events = 0
+
+    def __updateMoveStatistics(self, state):
+        now = time.time()
+        if state == DevState.MOVING:
+            if self.__move_moving is None:
+                self.__move_moving = now
+                self.__move_start_latency.add(now - self.__move_start)
+        elif state in (DevState.ON, DevState.ALARM):
+            # ignore state updates arriving before the motor starts moving
+            if self.__move_moving is None:
+                return
+            self.__move_duration.add(now - self.__move_start)
+            self.__move_position_events.add(self.__move_events)
+            self.__move_start = None
+
     def __motorLimitsChanged(self):
         try:
             self.__updateLimits()
@@ -191,13 +289,20 @@ class SpecMotor(Device):
         position_attr.set_properties(multi_prop)
 
     def read_Position(self):
-        position = self.__spec_motor.getPosition()
         state = self.get_state()
+        if state == DevState.INIT and self.__snapshot is not None:
+            values = self.__snapshot.get(MOTORS, self.__spec_motor_name)
+            if values is not None:
+                # not connected yet: last known position
+                return values['position'], self.__snapshot.time, \
+                       self.__snapshot.quality
+        position = self.__spec_motor.getPosition()
         if state == DevState.MOVING:
             return position, time.time(), AttrQuality.ATTR_CHANGING
         return position
 
     def write_Position(self, position):
+        self.__startMove()
         self.__spec_motor.move(position)
 
     def read_DialPosition(self):
@@ -236,13 +341,22 @@ class SpecMotor(Device):
     @DebugIt()
     def write_StepSize(self, step_size):
         self.__step_size = step_size
-        self.push_change_event("StepSize", step_size)
+        push_event(self, "StepSize", step_size)
 
     def read_Limit_Switches(self):
         m = self.__spec_motor
         return False, m.getParameter('high_lim_hit'), \
                m.getParameter('low_lim_hit')
 
+    def read_MoveStartLatency(self):
+        return self.__move_start_latency.summary()
+
+    def read_MoveDuration(self):
+        return self.__move_duration.summary()
+
+    def read_MovePositionEvents(self):
+        return self.__move_position_events.summary()
+
     @command
     def Stop(self):
         """
@@ -265,6 +379,7 @@ class SpecMotor(Device):
         :param abs_position: absolute destination position
         :type abs_position: float
         """
+        self.__startMove()
         self.__spec_motor.move(abs_position)
 
     @command(dtype_in=float)
@@ -275,6 +390,7 @@ class SpecMotor(Device):
         :param rel_position: displacement
         :type rel_position: float
         """
+        self.__startMove()
         self.__spec_motor.moveRelative(rel_position)
 
     @command
@@ -282,6 +398,7 @@ class SpecMotor(Device):
         """
         Move the motor up by the currently configured step size
         """
+        self.__startMove()
         self.__spec_motor.moveRelative(self.__step_size)
 
     @command
@@ -289,8 +406,18 @@ class SpecMotor(Device):
         """
         Move the motor down by the currently configured step size
         """
+        self.__startMove()
         self.__spec_motor.moveRelative(-self.__step_size)
 
+    @command
+    def ResetMoveStatistics(self):
+        """
+        Reset the move statistics
+        """
+        self.__move_start_latency.reset()
+        self.__move_duration.reset()
+        self.__move_position_events.reset()
+
 
 def main():
     from PyTango.server import run
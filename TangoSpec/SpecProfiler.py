@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+#------------------------------------------------------------------------------
+# This file is part of the Tango SPEC device server
+#
+# Copyright (c) 2014, European Synchrotron Radiation Facility.
+# Distributed under the GNU Lesser General Public License.
+# See LICENSE.txt for more info.
+#------------------------------------------------------------------------------
+
+"""Greenlet aware profiler of the running TangoSpec server."""
+
+import time
+import collections
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import greenlet
+
+from TangoSpec.SpecCommon import registry
+
+#: CPU time of the current thread (process CPU time on old pythons)
+_cpu_time = getattr(time, 'thread_time', None) or \
+            getattr(time, 'process_time', None) or time.clock
+
+#: SpecSession channel prefix: TANGO class of the element
+_CHANNEL_CLASSES = {"motor": "SpecMotor", "scaler": "SpecCounter"}
+
+
+def greenlet_name(glet):
+    """Returns a readable name of a greenlet"""
+    if glet.parent is None:
+        return "main"
+    name = getattr(glet, 'name', None)
+    if name:
+        return name
+    run = getattr(glet, '_run', None) or getattr(glet, 'run', None)
+    run = getattr(run, 'func', run)
+    return "{0}({1})".format(type(glet).__name__,
+                             getattr(run, '__name__', '?'))
+
+
+class Profiler(object):
+    """Profiles the gevent thread between :meth:`start` and :meth:`stop`:
+
+    * function statistics (cProfile)
+    * CPU time per greenlet (greenlet switch tracing)
+    * SPEC callback time per channel (from the :class:`SpecSession`
+      statistics), with the TANGO_ device of the channel"""
+
+    def __init__(self, session):
+        self.session = session
+        self.profile = None
+        self.start_time = None
+        self.__previous_trace = None
+        self.__tracing = False
+        self.__switch_time = None
+        # dict<greenlet name: [cpu time, switches]>
+        self.greenlets = collections.defaultdict(lambda: [0.0, 0])
+        self.__callback_times = {}
+
+    @property
+    def running(self):
+        return self.profile is not None
+
+    def start(self):
+        if self.running:
+            raise RuntimeError("Profiler already running")
+        self.greenlets.clear()
+        self.__callback_times = dict(
+            (name, stats.callback_time)
+            for name, stats in self.session.channels.items())
+        self.__switch_time = _cpu_time()
+        if not self.__tracing:
+            self.__previous_trace = greenlet.settrace(self.__trace)
+            self.__tracing = True
+        self.start_time = time.time()
+        import cProfile
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def __trace(self, event, args):
+        if self.profile is not None and event in ('switch', 'throw'):
+            origin, target = args
+            now = _cpu_time()
+            stats = self.greenlets[greenlet_name(origin)]
+            stats[0] += now - self.__switch_time
+            stats[1] += 1
+            self.__switch_time = now
+        if self.__previous_trace is not None:
+            self.__previous_trace(event, args)
+
+    def stop(self, filename=None, top=30):
+        """Stops profiling and returns a text report. If filename is given
+        the cProfile statistics are saved in it (pstats format)"""
+        if not self.running:
+            raise RuntimeError("Profiler not running")
+        profile, self.profile = self.profile, None
+        profile.disable()
+        # a tracer installed after this one (ex: the loop monitor) calls
+        # it: it is then left in place and only calls the previous tracer
+        if greenlet.gettrace() == self.__trace:
+            greenlet.settrace(self.__previous_trace)
+            self.__previous_trace = None
+            self.__tracing = False
+        duration = time.time() - self.start_time
+        if filename:
+            profile.dump_stats(filename)
+        return self.report(profile, duration, top=top)
+
+    def __channel_device(self, channel):
+        parts = channel.split("/")
+        class_name = _CHANNEL_CLASSES.get(parts[0])
+        if class_name is None or len(parts) < 2:
+            return ""
+        device = registry.get_device_by_spec_name(class_name, parts[1],
+                                                  self.session.name)
+        return "" if device is None else device.get_name()
+
+    def report(self, profile, duration, top=30):
+        out = StringIO()
+        out.write("Profiled {0:.3f}s\n\n".format(duration))
+
+        out.write("CPU time per greenlet:\n")
+        greenlets = sorted(self.greenlets.items(), key=lambda i: -i[1][0])
+        for name, (cpu_time, switches) in greenlets[:top]:
+            out.write("  {0:10.6f}s {1:8d} switches  {2}\n".format(
+                cpu_time, switches, name))
+
+        out.write("\nSPEC callback time per channel:\n")
+        callbacks = []
+        for name, stats in list(self.session.channels.items()):
+            callback_time = stats.callback_time - \
+                            self.__callback_times.get(name, 0.0)
+            if callback_time > 0:
+                callbacks.append((callback_time, name))
+        for callback_time, name in sorted(callbacks, reverse=True)[:top]:
+            out.write("  {0:10.6f}s  {1} {2}\n".format(
+                callback_time, name, self.__channel_device(name)))
+
+        out.write("\nTop functions:\n")
+        import pstats
+        stats = pstats.Stats(profile, stream=out)
+        stats.sort_stats("cumulative").print_stats(top)
+        return out.getvalue()
@@ -0,0 +1,457 @@
+# -*- coding: utf-8 -*-
+
+#------------------------------------------------------------------------------
+# This file is part of the Tango SPEC device server
+#
+# Copyright (c) 2014, European Synchrotron Radiation Facility.
+# Distributed under the GNU Lesser General Public License.
+# See LICENSE.txt for more info.
+#------------------------------------------------------------------------------
+
+"""SPEC session helpers shared by the TANGO SPEC devices."""
+
+import time
+import heapq
+import random
+import logging
+import weakref
+import threading
+import collections
+from functools import partial
+
+import gevent
+import gevent.event
+
+from SpecClient_gevent import Spec as _Spec
+from SpecClient_gevent import SpecCommand
+from SpecClient_gevent import SpecVariable
+from SpecClient_gevent.SpecMotor import SpecMotorA
+from SpecClient_gevent.SpecCounter import SpecCounterA
+
+from TangoSpec.SpecCommon import RollingStats, _new_async_watcher
+from TangoSpec.SpecMetrics import payload_size
+
+_string_types = bytes, type(u'')
+
+#: SpecClient methods answered locally (no message exchanged with SPEC on
+#: the object channel): connection, state and getters of the values of the
+#: registered channels (cached by SpecClient, updated by SPEC events)
+_LOCAL_METHODS = frozenset(('connectToSpec', 'isConnected',
+                            'isSpecConnected', 'getState', 'getType',
+                            'getPosition', 'getDialPosition', 'getValue',
+                            'getLimits', 'getSign', 'getOffset'))
+
+#: SpecClient callbacks which are connection notifications (not messages)
+_CONNECTION_CALLBACKS = frozenset(('connected', 'disconnected'))
+
+
+#: backends: SpecClient (real SPEC) or in-process simulation
+SPEC_BACKEND, SIM_BACKEND = "spec", "sim"
+BACKENDS = SPEC_BACKEND, SIM_BACKEND
+
+
+def _in_main_thread():
+    return isinstance(threading.current_thread(), threading._MainThread)
+
+
+class _HubCalls(object):
+    """Calls functions in the gevent hub (main thread) on behalf of other
+    threads (ex: the tango worker)"""
+
+    def __init__(self):
+        self.__calls = collections.deque()
+        self.__watcher = _new_async_watcher(gevent.get_hub().loop)
+        # don't keep the loop alive just for this watcher
+        self.__watcher.ref = False
+        self.__watcher.start(self.__run)
+
+    def __run(self):
+        calls = self.__calls
+        while calls:
+            f, args = calls.popleft()
+            try:
+                f(*args)
+            except:
+                logging.warning("Failed to execute %s in the hub", str(f))
+                logging.debug("Details:", exc_info=1)
+
+    def call(self, f, *args):
+        self.__calls.append((f, args))
+        self.__watcher.send()
+
+
+__HUB_CALLS = None
+def get_hub_calls():
+    """Returns the server wide :class:`_HubCalls`. It is created by the
+    first call from the main thread (so its watcher belongs to the main
+    thread hub): other threads can only use it afterwards"""
+    global __HUB_CALLS
+    if __HUB_CALLS is None:
+        if not _in_main_thread():
+            raise RuntimeError("hub calls must first be set up from the "
+                               "main thread (gevent hub)")
+        __HUB_CALLS = _HubCalls()
+    return __HUB_CALLS
+
+
+class ReconnectScheduler(object):
+    """Sequences the connections to a SPEC session.
+
+    Instead of every element connecting (and registering its channels) at
+    the same time, connections are made in batches of *batch_size* with a
+    pause of *batch_interval* (s) between batches. A connection that fails
+    is retried after a jittered exponential backoff (from *min_delay* up to
+    *max_delay* seconds).
+
+    A connection is a callable which raises an exception if it fails. The
+    elements must report their connection state with :meth:`connected` and
+    :meth:`disconnected` so the scheduler can measure how long it takes
+    for the whole session to be connected again."""
+
+    def __init__(self, session, batch_size=20, batch_interval=0.05,
+                 min_delay=0.25, max_delay=30):
+        self.session = session
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.__log = logging.getLogger("TangoSpec.Session." + session)
+        # heap<(due time, sequence, name)>
+        self.__queue = []
+        # dict<name: (connect, attempt, sequence)>
+        self.__pending = {}
+        self.__sequence = 0
+        self.__wakeup = gevent.event.Event()
+        # set when every scheduled connection was attempted at least once
+        self.__drained = gevent.event.Event()
+        self.__drained.set()
+        self.__task = None
+        self.__disconnected = set()
+        self.__disconnect_time = None
+        self.attempts = 0
+        self.failures = 0
+        # number of complete reconnections
+        self.reconnects = 0
+        self.reconnect_duration = RollingStats(100)
+        if _in_main_thread():
+            # ready for the requests of the other threads
+            get_hub_calls()
+
+    def configure(self, **kwargs):
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+    @property
+    def pending(self):
+        return len(self.__pending)
+
+    def schedule(self, name, connect, delay=0, attempt=0):
+        """Schedules connect() to be called in *delay* seconds. It can be
+        called from any thread (the connection is always made by the
+        scheduler in the main (gevent) thread)"""
+        if not _in_main_thread():
+            get_hub_calls().call(self.schedule, name, connect, delay, attempt)
+            return
+        self.__setDisconnected(name)
+        self.__sequence += 1
+        sequence = self.__sequence
+        self.__pending[name] = connect, attempt, sequence
+        if attempt == 0:
+            self.__drained.clear()
+        heapq.heappush(self.__queue, (time.time() + delay, sequence, name))
+        if self.__task is None or self.__task.ready():
+            self.__task = gevent.spawn(self.__run)
+        self.__wakeup.set()
+
+    def cancel(self, name):
+        """Cancels the pending connection with the given name"""
+        if not _in_main_thread():
+            # keep the order with the connections scheduled from threads
+            get_hub_calls().call(self.cancel, name)
+            return
+        self.__pending.pop(name, None)
+        self.__checkDrained()
+        # forget it without accounting a reconnection
+        disconnected = self.__disconnected
+        disconnected.discard(name)
+        if not disconnected:
+            self.__disconnect_time = None
+
+    def wait_drained(self, timeout=None):
+        """Waits until every scheduled connection was attempted at least
+        once (retries are not waited for). Returns True if drained"""
+        return self.__drained.wait(timeout)
+
+    def __checkDrained(self):
+        if not any(attempt == 0 for _, attempt, _ in self.__pending.values()):
+            self.__drained.set()
+
+    def connected(self, name):
+        disconnected = self.__disconnected
+        if name not in disconnected:
+            return
+        disconnected.discard(name)
+        if not disconnected and self.__disconnect_time is not None:
+            duration = time.time() - self.__disconnect_time
+            self.__disconnect_time = None
+            self.reconnects += 1
+            self.reconnect_duration.add(duration)
+            self.__log.info("All connections to %s established in %.3fs",
+                            self.session, duration)
+
+    def disconnected(self, name):
+        if not _in_main_thread():
+            get_hub_calls().call(self.disconnected, name)
+            return
+        self.__setDisconnected(name)
+
+    def __setDisconnected(self, name):
+        if not self.__disconnected:
+            self.__disconnect_time = time.time()
+        self.__disconnected.add(name)
+
+    def __backoff(self, attempt):
+        delay = min(self.max_delay, self.min_delay * 2 ** attempt)
+        return delay * random.uniform(0.5, 1.5)
+
+    def __run(self):
+        queue = self.__queue
+        while queue:
+            due = queue[0][0]
+            now = time.time()
+            if due > now:
+                self.__wakeup.clear()
+                self.__wakeup.wait(due - now)
+                continue
+            batch = []
+            while queue and queue[0][0] <= now and \
+                  len(batch) < self.batch_size:
+                _, sequence, name = heapq.heappop(queue)
+                pending = self.__pending.get(name)
+                # ignore cancelled and rescheduled connections
+                if pending is not None and pending[2] == sequence:
+                    del self.__pending[name]
+                    batch.append((name, pending[0], pending[1]))
+            for name, connect, attempt in batch:
+                self.__connect(name, connect, attempt)
+            self.__checkDrained()
+            gevent.sleep(self.batch_interval)
+
+    def __connect(self, name, connect, attempt):
+        self.attempts += 1
+        try:
+            connect()
+        except Exception:
+            self.failures += 1
+            delay = self.__backoff(attempt)
+            self.__log.info("Failed to connect %s (attempt %d). Retrying "
+                            "in %.2fs", name, attempt + 1, delay)
+            self.__log.debug("Details:", exc_info=1)
+            self.schedule(name, connect, delay=delay, attempt=attempt + 1)
+
+
+class ChannelStats(object):
+    """Statistics of a SPEC channel. The fields are totals since the
+    channel was first used (exported as metric counters): :meth:`reset`
+    only moves the baseline of :meth:`since_reset`"""
+
+    FIELDS = ('messages_in', 'messages_out', 'bytes_in', 'bytes_out',
+              'callback_time')
+
+    __slots__ = FIELDS + ('baseline',)
+
+    def __init__(self):
+        self.messages_in = self.messages_out = 0
+        self.bytes_in = self.bytes_out = 0
+        self.callback_time = 0.0
+        self.baseline = self.totals()
+
+    def totals(self):
+        return tuple(getattr(self, field) for field in self.FIELDS)
+
+    def reset(self):
+        self.baseline = self.totals()
+
+    def since_reset(self):
+        """Returns the statistics since the last reset (same order as
+        :attr:`FIELDS`)"""
+        return tuple(total - base
+                     for total, base in zip(self.totals(), self.baseline))
+
+
+class _SessionObject(object):
+    """Proxy to a SpecClient object which accounts its requests to SPEC
+    (method calls exchanging messages with SPEC: commands, writes and
+    uncached reads).
+
+    It also keeps the callbacks given to the SpecClient object, which only
+    keeps weak references to them, for the lifetime of the object"""
+
+    def __init__(self, obj, stats, callbacks=None):
+        self.__obj = obj
+        self.__stats = stats
+        self.__callbacks = callbacks
+
+    def __getattr__(self, name):
+        attr = getattr(self.__obj, name)
+        if not callable(attr) or name.startswith('_') or \
+           name in _LOCAL_METHODS:
+            return attr
+        stats = self.__stats
+        def request(*args, **kwargs):
+            stats.messages_out += 1
+            stats.bytes_out += payload_size(args)
+            result = attr(*args, **kwargs)
+            if result is not None:
+                stats.messages_in += 1
+                stats.bytes_in += payload_size(result)
+            return result
+        return request
+
+
+class SpecSession(object):
+    """A SPEC session shared by all the TANGO devices of the server which
+    are connected to it.
+
+    The SpecClient objects (spec, motors, counters, variables, commands)
+    of the session are created through it so they all share the session
+    connection and its :class:`ReconnectScheduler`. Their callbacks
+    (incoming messages) and requests (outgoing messages) are accounted
+    per channel.
+
+    With the ``sim`` backend, the objects are the simulated ones of
+    :mod:`TangoSpec.SpecSim` instead of SpecClient objects."""
+
+    def __init__(self, name, backend=SPEC_BACKEND):
+        if backend not in BACKENDS:
+            raise ValueError("Unknown backend {0!r} (expected one of "
+                             "{1})".format(backend, ", ".join(BACKENDS)))
+        self.name = name
+        self.backend = backend
+        self.simulator = None
+        if backend == SIM_BACKEND:
+            from TangoSpec import SpecSim
+            self.simulator = SpecSim.get_simulator(name)
+            sim = self.simulator
+            self.__classes = dict(
+                spec=partial(SpecSim.SimSpec, sim),
+                motor=partial(SpecSim.SimMotor, sim),
+                counter=partial(SpecSim.SimCounter, sim),
+                variable=partial(SpecSim.SimVariable, sim),
+                variableA=partial(SpecSim.SimVariable, sim),
+                command=partial(SpecSim.SimCommand, sim))
+        else:
+            self.__classes = dict(
+                spec=_Spec.Spec, motor=SpecMotorA, counter=SpecCounterA,
+                variable=SpecVariable.SpecVariable,
+                variableA=SpecVariable.SpecVariableA,
+                command=SpecCommand.SpecCommand)
+        self.scheduler = ReconnectScheduler(name)
+        # dict<channel name: ChannelStats>
+        self.channels = collections.defaultdict(ChannelStats)
+        # dict<object type: number of alive objects>
+        self.objects = collections.defaultdict(int)
+        # weak references to the alive objects (to account their release)
+        self.__refs = set()
+
+    def reset_statistics(self):
+        for stats in self.channels.values():
+            stats.reset()
+
+    def __wrap_callbacks(self, stats, callbacks):
+        def wrap(name, callback):
+            if name in _CONNECTION_CALLBACKS:
+                return callback
+            def wrapped(*args):
+                stats.messages_in += 1
+                stats.bytes_in += payload_size(args)
+                start = time.time()
+                try:
+                    return callback(*args)
+                finally:
+                    stats.callback_time += time.time() - start
+            return wrapped
+        return dict((name, wrap(name, callback))
+                    for name, callback in callbacks.items())
+
+    def __create(self, otype, channel, klass, callbacks=None, *args):
+        stats = self.channels[channel]
+        if callbacks is None:
+            obj = klass(*args)
+        else:
+            callbacks = self.__wrap_callbacks(stats, callbacks)
+            obj = klass(*args, callbacks=callbacks)
+        session_obj = _SessionObject(obj, stats, callbacks)
+        self.objects[otype] += 1
+        self.__refs.add(weakref.ref(session_obj,
+                                    partial(self.__released, otype)))
+        return session_obj
+
+    def __released(self, otype, ref):
+        self.__refs.discard(ref)
+        self.objects[otype] -= 1
+
+    def spec(self):
+        """Returns a new (not connected) SpecClient Spec"""
+        return self.__create("spec", "spec", self.__classes["spec"])
+
+    def motor(self, name, callbacks):
+        """Returns a new (not connected) SpecClient SpecMotorA"""
+        return self.__create("motor", "motor/" + name,
+                             self.__classes["motor"], callbacks)
+
+    def counter(self, name, callbacks):
+        """Returns a new (not connected) SpecClient SpecCounterA"""
+        return self.__create("counter", "scaler/" + name,
+                             self.__classes["counter"], callbacks)
+
+    def variable(self, name, callbacks, asynchronous=False, prefix=True):
+        """Returns a new (not connected) SpecClient SpecVariable (or
+        SpecVariableA if asynchronous is True)"""
+        channel = "var/" + name if prefix else name
+        klass = self.__classes["variableA" if asynchronous else "variable"]
+        return self.__create("variable", channel, klass, callbacks)
+
+    def command(self):
+        """Returns a new SpecClient SpecCommand connected to the session"""
+        return self.__create("command", "cmd", self.__classes["command"],
+                             None, None, self.name)
+
+    def get_channel_statistics(self):
+        """Returns the list of channel statistics: ``<channel> <messages in>
+        <messages out> <bytes in> <bytes out> <callback time (s)>``"""
+        return ["{0} {1[0]} {1[1]} {1[2]} {1[3]} {1[4]:.6f}".format(
+                    name, stats.since_reset())
+                for name, stats in sorted(self.channels.items())]
+
+    def get_object_statistics(self):
+        """Returns the number of alive SpecClient objects per type:
+        ``<type> <number>``"""
+        return ["{0} {1}".format(otype, n)
+                for otype, n in sorted(self.objects.items())]
+
+
+__SESSIONS = {}
+def get_session(name, backend=None):
+    """Returns the :class:`SpecSession` for the given SPEC session name
+    (<host>:<session>). The backend (``spec`` or ``sim``) is the one given
+    when the session is first requested"""
+    session = __SESSIONS.get(name)
+    if session is None:
+        session = SpecSession(name, backend=backend or SPEC_BACKEND)
+        __SESSIONS[name] = session
+    elif backend is not None and backend != session.backend:
+        logging.warning("Session %s already uses the %s backend (not %s)",
+                        name, session.backend, backend)
+    return session
+
+
+def get_sessions():
+    """Returns dict<name: SpecSession> of the created sessions"""
+    return dict(__SESSIONS)
+
+
+def get_reconnect_scheduler(session):
+    """Returns the reconnect scheduler for the given SPEC session
+    (<host>:<session>)"""
+    return get_session(session).scheduler
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+
+#------------------------------------------------------------------------------
+# This file is part of the Tango SPEC device server
+#
+# Copyright (c) 2014, European Synchrotron Radiation Facility.
+# Distributed under the GNU Lesser General Public License.
+# See LICENSE.txt for more info.
+#------------------------------------------------------------------------------
+
+"""Process sharding of the TANGO SPEC elements.
+
+In sharded mode (``TangoSpec <instance> --shards N``) the coordinator
+process hosts the Spec devices and N shard processes (TANGO_ servers
+``TangoSpec/<instance>_shard<i>``) host the SpecMotor/SpecCounter devices.
+Each shard process has a :class:`SpecShard` device which creates and
+deletes elements on behalf of the coordinator."""
+
+import sys
+import time
+import zlib
+import atexit
+import logging
+import threading
+import subprocess
+
+from PyTango import DevState, AttrWriteType, DeviceProxy, DevFailed
+from PyTango.server import Device, DeviceMeta, attribute, command
+
+from TangoSpec.SpecCommon import (switch_state, registry, TangoWorker,
+                                  create_element_devices,
+                                  delete_element_devices)
+from TangoSpec.SpecMetrics import push_event
+
+#: TANGO classes of the elements hosted by the shards
+ELEMENT_CLASSES = "SpecMotor", "SpecCounter"
+
+
+def shard_server_name(instance, index):
+    return "TangoSpec/{0}_shard{1}".format(instance, index)
+
+
+def shard_device_name(instance, index):
+    return "tangospec/{0}/shard{1}".format(instance, index)
+
+
+class SpecShard(Device):
+    """A TANGO device which creates and deletes the SPEC elements of a
+    shard process on behalf of the coordinator Spec devices."""
+    __metaclass__ = DeviceMeta
+
+    ElementList = attribute(dtype=[str], access=AttrWriteType.READ,
+                            max_dim_x=65535,
+                            doc="List of elements of this shard (<class> "
+                                "<spec session> <spec name> <device name>)")
+
+    def init_device(self):
+        Device.init_device(self)
+        self.set_change_event("ElementList", True, False)
+        self.__log = logging.getLogger(self.get_name())
+        switch_state(self, DevState.ON, "Ready")
+
+    def read_ElementList(self):
+        return get_element_list()
+
+    @command(dtype_in=[str],
+             doc_in="flat list of (<class>, <full spec name>, <device name>, "
+                    "<alias>, <backend>)")
+    def CreateElements(self, elements):
+        """
+        Creates the given elements in this shard (asynchronously). A single
+        ElementList event is fired at the end.
+        """
+        by_class = _group(elements, 5)
+        TangoWorker("shard").submit("elements", self.__createElements,
+                                    by_class)
+
+    @command(dtype_in=[str], doc_in="flat list of (<class>, <device name>)")
+    def DeleteElements(self, elements):
+        """
+        Deletes the given elements from this shard (asynchronously). A
+        single ElementList event is fired at the end.
+        """
+        by_class = _group(elements, 2)
+        TangoWorker("shard").submit("elements", self.__deleteElements,
+                                    by_class)
+
+    def __createElements(self, by_class):
+        for dev_type, elements in by_class.items():
+            by_backend = {}
+            for full_name, dev_name, dev_alias, backend in elements:
+                by_backend.setdefault(backend, []).append((full_name,
+                                                           dev_name,
+                                                           dev_alias))
+            for backend, items in by_backend.items():
+                properties = dict(Backend=backend) if backend else None
+                create_element_devices(dev_type, items, log=self.__log,
+                                       properties=properties)
+        push_event(self, "ElementList", get_element_list())
+
+    def __deleteElements(self, by_class):
+        for dev_type, dev_names in by_class.items():
+            delete_element_devices(dev_type, [dev_name for dev_name,
+                                              in dev_names], log=self.__log)
+        push_event(self, "ElementList", get_element_list())
+
+
+def _group(items, n):
+    """Groups the flat list of (<class>, ...) n-tuples by class"""
+    result = {}
+    for i in range(0, len(items) - n + 1, n):
+        result.setdefault(items[i], []).append(tuple(items[i+1:i+n]))
+    return result
+
+
+def get_element_list():
+    """Returns the list of ``<class> <spec session> <spec name> <device
+    name>`` of the elements of this process"""
+    result = []
+    for class_name in ELEMENT_CLASSES:
+        for device in registry.get_devices(class_name):
+            result.append("{0} {1} {2} {3}".format(
+                class_name, device.get_spec_session(),
+                device.get_spec_name(), device.get_name()))
+    return result
+
+
+class ShardElement(object):
+    """Registry entry of an element hosted by a shard process"""
+
+    def __init__(self, element_class, dev_name, spec_name, session, shard):
+        self.element_class = element_class
+        self.__dev_name = dev_name
+        self.__spec_name = spec_name
+        self.__session = session
+        self.shard = shard
+
+    def get_name(self):
+        return self.__dev_name
+
+    def get_spec_name(self):
+        return self.__spec_name
+
+    def get_spec_session(self):
+        return self.__session
+
+    def read_value(self):
+        """Reads the element value (blocking: call it from a worker)"""
+        return DeviceProxy(self.__dev_name).read_attribute("Value").value
+
+    def get_snapshot(self):
+        """Elements hosted by a shard process are not in the snapshot"""
+        return None
+
+
+class ShardRouter(object):
+    """Routes the creation and deletion of the elements of a coordinator
+    process to its shards. An element goes to the shard given by the
+    *shard_map* (dict<spec name: shard index>) or else to the shard given
+    by the crc32 hash of its SPEC name.
+
+    The methods are blocking: they are meant to be called from a tango
+    worker thread."""
+
+    def __init__(self, instance, count, shard_map=None, timeout=30):
+        self.instance = instance
+        self.count = count
+        self.shard_map = shard_map or {}
+        self.timeout = timeout
+        self.__proxies = {}
+        self.__lock = threading.Lock()
+
+    def get_shard(self, spec_name):
+        index = self.shard_map.get(spec_name)
+        if index is None:
+            index = zlib.crc32(spec_name.encode("utf-8")) & 0xffffffff
+        return index % self.count
+
+    def get_proxy(self, index):
+        with self.__lock:
+            proxy = self.__proxies.get(index)
+            if proxy is None:
+                name = shard_device_name(self.instance, index)
+                proxy = DeviceProxy(name)
+                self.__proxies[index] = proxy
+        return proxy
+
+    def __wait_shard(self, index):
+        """Waits for the shard process to be running (it is started at
+        the same time as the coordinator)"""
+        proxy = self.get_proxy(index)
+        start = time.time()
+        while True:
+            try:
+                proxy.ping()
+                return proxy
+            except DevFailed:
+                if time.time() - start > self.timeout:
+                    raise
+                time.sleep(0.5)
+
+    def sync(self, session):
+        """Registers the elements of the SPEC session which already exist
+        in the shards"""
+        for index in range(self.count):
+            proxy = self.__wait_shard(index)
+            for item in proxy.read_attribute("ElementList").value or ():
+                class_name, element_session, spec_name, dev_name = item.split()
+                if element_session != session:
+                    continue
+                registry.register(ShardElement(class_name, dev_name,
+                                               spec_name, session, index))
+
+    def create_elements(self, dev_type, session, elements, backend=""):
+        """Creates the given elements of the SPEC session in the shards
+
+        :param elements: sequence of (spec name, device name, alias)
+        :param backend: Backend property of the elements (empty string:
+                        not set)"""
+        by_shard = {}
+        for spec_name, dev_name, dev_alias in elements:
+            index = self.get_shard(spec_name)
+            full_name = "{0}:{1}".format(session, spec_name)
+            by_shard.setdefault(index, []).extend((dev_type, full_name,
+                                                   dev_name, dev_alias,
+                                                   backend))
+            registry.register(ShardElement(dev_type, dev_name, spec_name,
+                                           session, index))
+        for index, args in by_shard.items():
+            self.__wait_shard(index).command_inout("CreateElements", args)
+
+    def delete_elements(self, dev_type, dev_names):
+        """Deletes the given elements from the shards. Returns the names
+        of the devices which are not in a shard"""
+        by_shard, local = {}, []
+        for dev_name in dev_names:
+            device = registry.get_device(dev_type, dev_name)
+            if not isinstance(device, ShardElement):
+                local.append(dev_name)
+                continue
+            by_shard.setdefault(device.shard, []).extend((dev_type, dev_name))
+            registry.unregister(device)
+        for index, args in by_shard.items():
+            self.__wait_shard(index).command_inout("DeleteElements", args)
+        return local
+
+
+__SHARDS = None
+def set_shards(instance, count):
+    """Enables the sharded mode of this (coordinator) process"""
+    global __SHARDS
+    __SHARDS = instance, count
+
+
+def get_shard_router(shard_map=None):
+    """Returns a new :class:`ShardRouter` or None if this process is not a
+    coordinator"""
+    if __SHARDS is None:
+        return
+    instance, count = __SHARDS
+    return ShardRouter(instance, count, shard_map=shard_map)
+
+
+def register_shards(instance, count):
+    """Registers the shard servers (and their SpecShard device) of the
+    given instance in the TANGO database"""
+    from PyTango import Database, DbDevInfo
+    db = Database()
+    for index in range(count):
+        info = DbDevInfo()
+        info.name = shard_device_name(instance, index)
+        info._class = "SpecShard"
+        info.server = shard_server_name(instance, index)
+        db.add_device(info)
+
+
+def start_shards(instance, count, args=()):
+    """Starts the shard processes of the given instance. They are
+    terminated when this process exits"""
+    register_shards(instance, count)
+    processes = []
+    for index in range(count):
+        shard_instance = "{0}_shard{1}".format(instance, index)
+        cmd = [sys.executable, sys.argv[0], shard_instance, "--shard"]
+        cmd.extend(args)
+        processes.append(subprocess.Popen(cmd))
+    def stop():
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+    atexit.register(stop)
+    set_shards(instance, count)
+    return processes
@@ -0,0 +1,714 @@
+# -*- coding: utf-8 -*-
+
+#------------------------------------------------------------------------------
+# This file is part of the Tango SPEC device server
+#
+# Copyright (c) 2014, European Synchrotron Radiation Facility.
+# Distributed under the GNU Lesser General Public License.
+# See LICENSE.txt for more info.
+#------------------------------------------------------------------------------
+
+"""Simulated SPEC session (``Backend = sim``).
+
+An in-process replacement of the SpecClient objects (spec, motors,
+counters, variables and commands) of a session, to run TangoSpec without
+SPEC (load and soak tests). Motors follow a trapezoidal velocity profile,
+counters count at a configured rate and the commands (a small subset of
+SPEC plus scripted replies) write to the simulated tty.
+
+All the motors and counters of a simulator are updated by a single
+greenlet, every ``update_interval`` seconds, while they move or count.
+The configuration is a JSON file::
+
+    {
+      "update_interval": 0.05,
+      "motors": {"th": {"position": 0, "velocity": 2, "acceleration": 100,
+                        "limits": [-180, 180]}},
+      "counters": {"sec": {"type": "timer"},
+                   "mon": {"type": "monitor", "rate": 10000}},
+      "generate": {"motors": 200, "counters": 50},
+      "variables": {"A": [1, 2, 3]},
+      "commands": [{"match": "^newfile", "output": "Using file ...",
+                    "delay": 0.1}]
+    }
+
+``generate`` adds motors ``m<n>`` and counters ``c<n>`` with the default
+parameters. Unknown motors and counters are created on connection."""
+
+import re
+import json
+import math
+import time
+import random
+import logging
+import weakref
+
+import gevent
+import gevent.event
+
+from SpecClient_gevent import SpecMotor
+from SpecClient_gevent import SpecCounter
+
+#: default simulator configuration
+DEFAULT_CONFIG = {
+    "update_interval": 0.05,
+    "counters": {"sec": {"type": "timer"},
+                 "mon": {"type": "monitor", "rate": 10000},
+                 "det": {"type": "scaler", "rate": 1000}},
+}
+
+MOTOR_DEFAULTS = dict(position=0.0, velocity=1.0, acceleration=100.0,
+                      backlash=0.0, sign=1, offset=0.0,
+                      limits=(-1e9, 1e9))
+
+COUNTER_DEFAULTS = dict(type="scaler", rate=1000.0)
+
+COUNTER_TYPES = {
+    "timer": SpecCounter.TIMER,
+    "monitor": SpecCounter.MONITOR,
+    "scaler": SpecCounter.SCALER,
+}
+
+#: initial values of the channels which are not configured
+CHANNEL_DEFAULTS = {
+    "output/tty": "",
+    "var/DATAFILE": "/dev/null",
+    "var/NPTS": 0,
+}
+
+
+_ASSIGNMENT = re.compile(r"^(\w+)\s*=\s*(.+)$")
+
+
+def _dispatch(callback, *args):
+    """Calls the callback from the gevent loop (like the SpecClient
+    dispatcher: never from the caller stack)"""
+    gevent.get_hub().loop.run_callback(callback, *args)
+
+
+class SimMotorState(object):
+    """A simulated motor (trapezoidal velocity profile). Positions (and
+    backlash) are in user units; velocity in units/s and acceleration (time
+    to reach the velocity) in ms like in SPEC.
+
+    Like in SPEC, a move in the direction opposite to the backlash sign
+    goes past the target by the backlash and comes back"""
+
+    def __init__(self, simulator, name, **config):
+        self.simulator = simulator
+        self.name = name
+        self.state = SpecMotor.READY
+        # set<SimMotor> (not kept alive by the simulator)
+        self.listeners = weakref.WeakSet()
+        self.target = None
+        self.final_target = None
+        self.on_limit = False
+        self.direction = 0
+        self.configure(**dict(MOTOR_DEFAULTS, **config))
+
+    def configure(self, position=None, velocity=None, acceleration=None,
+                  backlash=None, sign=None, offset=None, limits=None):
+        if position is not None:
+            self.position = float(position)
+        if velocity is not None:
+            self.velocity = float(velocity)
+        if acceleration is not None:
+            self.acceleration = float(acceleration)
+        if backlash is not None:
+            self.backlash = float(backlash)
+        if sign is not None:
+            self.sign = int(sign)
+        if offset is not None:
+            self.offset = float(offset)
+        if limits is not None:
+            self.limits = tuple(map(float, limits))
+
+    def fire(self, event, *args):
+        for listener in list(self.listeners):
+            listener._callback(event, *args)
+
+    def move(self, position):
+        low, high = self.limits
+        target = min(max(float(position), low), high)
+        self.on_limit = target != position
+        self.direction = (target > self.position) - (target < self.position)
+        self.final_target = target
+        if self.backlash * self.direction < 0:
+            # backlash correction: first go past the target
+            target = min(max(target - self.backlash, low), high)
+        self.__start_leg(target)
+        self.state = SpecMotor.MOVESTARTED
+        self.fire("motorStateChanged", self.state)
+        self.simulator.start_motion(self)
+
+    def __start_leg(self, target):
+        self.start, self.target = self.position, target
+        self.start_time = time.time()
+        self.duration = self.__duration(abs(target - self.start))
+
+    def __duration(self, distance):
+        velocity, accel_time = self.velocity, self.acceleration / 1000.0
+        if velocity <= 0 or distance == 0:
+            return 0.0
+        if accel_time <= 0:
+            return distance / velocity
+        if distance >= velocity * accel_time:
+            return distance / velocity + accel_time
+        # triangular profile: the velocity is never reached
+        return 2 * math.sqrt(distance * accel_time / velocity)
+
+    def __distance(self, t):
+        """Distance moved t seconds after the start"""
+        velocity, accel_time = self.velocity, self.acceleration / 1000.0
+        total = abs(self.target - self.start)
+        duration = self.duration
+        if t >= duration:
+            return total
+        if accel_time <= 0:
+            return velocity * t
+        accel = velocity / accel_time
+        ramp = min(accel_time, duration / 2.0)
+        if t < ramp:
+            return accel * t * t / 2
+        if t > duration - ramp:
+            left = duration - t
+            return total - accel * left * left / 2
+        return accel * ramp * ramp / 2 + velocity * (t - ramp)
+
+    def update(self, now):
+        """Updates the position. Returns False when the move is finished"""
+        if self.target is None:
+            return False
+        t = now - self.start_time
+        direction = 1 if self.target >= self.start else -1
+        self.position = self.start + direction * self.__distance(t)
+        if self.state == SpecMotor.MOVESTARTED:
+            self.state = SpecMotor.MOVING
+            self.fire("motorStateChanged", self.state)
+        self.fire("motorPositionChanged", self.position)
+        if t < self.duration:
+            return True
+        self.position = self.target
+        if self.position != self.final_target:
+            # end of the backlash correction
+            self.__start_leg(self.final_target)
+            return True
+        self.target = self.final_target = None
+        self.state = SpecMotor.ONLIMIT if self.on_limit else SpecMotor.READY
+        self.fire("motorStateChanged", self.state)
+        return False
+
+    def stop(self):
+        if self.target is not None:
+            self.target = self.final_target = self.position
+            self.start_time = time.time() - self.duration
+
+    def get_parameter(self, name):
+        """Returns a motor parameter (SpecClient getParameter)"""
+        if name == "high_lim_hit":
+            return self.on_limit and self.direction > 0
+        if name == "low_lim_hit":
+            return self.on_limit and self.direction < 0
+        return getattr(self, name)
+
+
+class SimCounterState(object):
+    """A simulated counter: timers count the time, monitors and scalers
+    count at the configured rate (with poisson-like noise)"""
+
+    def __init__(self, simulator, name, **config):
+        self.simulator = simulator
+        self.name = name
+        self.state = SpecCounter.NOTCOUNTING
+        self.enabled = True
+        # set<SimCounter> (not kept alive by the simulator)
+        self.listeners = weakref.WeakSet()
+        self.value = 0.0
+        self.configure(**dict(COUNTER_DEFAULTS, **config))
+
+    def configure(self, type=None, rate=None):
+        if type is not None:
+            self.type = COUNTER_TYPES[type]
+        if rate is not None:
+            self.rate = float(rate)
+
+    def fire(self, event, *args):
+        for listener in list(self.listeners):
+            listener._callback(event, *args)
+
+    def start(self):
+        self.value = 0.0
+        self.state = SpecCounter.COUNTING
+        self.fire("counterStateChanged", self.state)
+        self.fire("counterValueChanged", self.value)
+
+    def update(self, dt, counting):
+        if self.type == SpecCounter.TIMER:
+            self.value += dt
+        else:
+            mean = self.rate * dt
+            self.value += max(0, round(random.gauss(mean, math.sqrt(mean))))
+        self.fire("counterValueChanged", self.value)
+        if not counting:
+            self.state = SpecCounter.NOTCOUNTING
+            self.fire("counterStateChanged", self.state)
+
+
+class Simulator(object):
+    """The simulated SPEC of a session: motors, counters, channels
+    (variables, tty) and command interpreter"""
+
+    def __init__(self, name):
+        self.name = name
+        self.update_interval = DEFAULT_CONFIG["update_interval"]
+        # dict<name: SimMotorState>
+        self.motors = {}
+        # dict<name: SimCounterState>
+        self.counters = {}
+        # dict<channel name: value>
+        self.channels = {}
+        # dict<channel name: set<SimVariable>> (not kept alive by the
+        # simulator)
+        self.channel_listeners = {}
+        # list<(compiled regex, output, delay)>
+        self.scripts = []
+        self.config_file = None
+        self.count_end = None
+        self.__moving = set()
+        self.__updater = None
+        self.__motion_done = gevent.event.Event()
+        self.__motion_done.set()
+        self.__count_done = gevent.event.Event()
+        self.__count_done.set()
+        self.__log = logging.getLogger("TangoSpec.Sim." + name)
+        self.configure(DEFAULT_CONFIG)
+
+    def configure(self, config):
+        """Applies a configuration (dict). Existing motors and counters
+        are updated"""
+        self.update_interval = float(config.get("update_interval",
+                                                self.update_interval))
+        generate = config.get("generate", {})
+        motors = dict(("m{0}".format(i), {})
+                      for i in range(generate.get("motors", 0)))
+        motors.update(config.get("motors", {}))
+        for name, motor_config in motors.items():
+            self.get_motor(name).configure(**motor_config)
+        counters = dict(("c{0}".format(i), {})
+                        for i in range(generate.get("counters", 0)))
+        counters.update(config.get("counters", {}))
+        for name, counter_config in counters.items():
+            self.get_counter(name).configure(**counter_config)
+        for name, value in config.get("variables", {}).items():
+            self.set_channel("var/" + name, value)
+        if "commands" in config:
+            self.scripts = [(re.compile(script["match"]),
+                             script.get("output", ""),
+                             float(script.get("delay", 0)))
+                            for script in config["commands"]]
+        self.__log.info("Simulating %d motors and %d counters",
+                        len(self.motors), len(self.counters))
+
+    def load(self, filename):
+        """Loads a configuration file (only once)"""
+        if filename == self.config_file:
+            return
+        with open(filename) as config_file:
+            self.configure(json.load(config_file))
+        self.config_file = filename
+
+    def get_motor(self, name):
+        motor = self.motors.get(name)
+        if motor is None:
+            motor = self.motors[name] = SimMotorState(self, name)
+        return motor
+
+    def get_counter(self, name):
+        counter = self.counters.get(name)
+        if counter is None:
+            counter = self.counters[name] = SimCounterState(self, name)
+        return counter
+
+    # ----------------------------------------------------------------
+    # channels (variables, tty)
+    # ----------------------------------------------------------------
+
+    def get_channel(self, channel):
+        return self.channels.get(channel, CHANNEL_DEFAULTS.get(channel, 0))
+
+    def set_channel(self, channel, value):
+        self.channels[channel] = value
+        for listener in list(self.channel_listeners.get(channel, ())):
+            listener._callback("update", value)
+
+    def write(self, text):
+        """Writes text to the tty"""
+        self.set_channel("output/tty", text)
+
+    # ----------------------------------------------------------------
+    # motion and counting
+    # ----------------------------------------------------------------
+
+    def start_motion(self, motor):
+        self.__moving.add(motor)
+        self.__motion_done.clear()
+        self.__start_updater()
+
+    def count(self, count_time):
+        self.count_end = time.time() + float(count_time)
+        self.__count_done.clear()
+        for counter in self.counters.values():
+            if counter.enabled:
+                counter.start()
+        self.__start_updater()
+
+    def stop(self):
+        for motor in list(self.__moving):
+            motor.stop()
+        if self.count_end is not None:
+            self.count_end = time.time()
+
+    def wait_motion(self):
+        self.__motion_done.wait()
+
+    def wait_count(self):
+        self.__count_done.wait()
+
+    def __start_updater(self):
+        if self.__updater is None:
+            self.__updater = gevent.spawn(self.__update_loop)
+
+    def __update_loop(self):
+        last = time.time()
+        try:
+            while self.__moving or self.count_end is not None:
+                gevent.sleep(self.update_interval)
+                now = time.time()
+                for motor in list(self.__moving):
+                    if not motor.update(now):
+                        self.__moving.discard(motor)
+                if not self.__moving:
+                    self.__motion_done.set()
+                if self.count_end is not None:
+                    counting = now < self.count_end
+                    dt = (now if counting else self.count_end) - last
+                    for counter in self.counters.values():
+                        if counter.state == SpecCounter.COUNTING:
+                            counter.update(max(dt, 0), counting)
+                    if not counting:
+                        self.count_end = None
+                        self.__count_done.set()
+                last = now
+        finally:
+            self.__updater = None
+
+    # ----------------------------------------------------------------
+    # commands
+    # ----------------------------------------------------------------
+
+    def execute(self, cmd):
+        """Executes a command (``;`` separated statements). Returns the
+        output"""
+        output = []
+        for statement in cmd.split(";"):
+            statement = statement.strip()
+            if statement:
+                text = self.__execute(statement)
+                if text:
+                    self.write(text)
+                    output.append(text)
+        return "".join(output)
+
+    def __execute(self, statement):
+        for regex, output, delay in self.scripts:
+            if regex.search(statement):
+                if delay:
+                    gevent.sleep(delay)
+                return output + "\n" if output else ""
+        assignment = _ASSIGNMENT.match(statement)
+        if assignment is not None:
+            var_name, value = assignment.groups()
+            self.set_channel("var/" + var_name, self.__eval(value))
+            return ""
+        words = statement.split()
+        name, args = words[0], words[1:]
+        handler = getattr(self, "_cmd_" + name, None)
+        if handler is None:
+            return "sim: unknown command '{0}'\n".format(statement)
+        return handler(*args)
+
+    def __eval(self, expr):
+        try:
+            return json.loads(expr)
+        except ValueError:
+            channel = "var/" + expr
+            if channel in self.channels:
+                return self.channels[channel]
+            return expr.strip("\"'")
+
+    def __moves(self, args, relative=False):
+        for name, position in zip(args[::2], args[1::2]):
+            motor = self.motors[name]
+            position = float(position)
+            motor.move(motor.position + position if relative else position)
+
+    def _cmd_p(self, *args):
+        return "{0}\n".format(self.__eval(" ".join(args)))
+
+    _cmd_print = _cmd_p
+
+    def _cmd_mv(self, *args):
+        self.__moves(args)
+
+    def _cmd_mvr(self, *args):
+        self.__moves(args, relative=True)
+
+    def _cmd_umv(self, *args):
+        self.__moves(args)
+        self.wait_motion()
+
+    def _cmd_umvr(self, *args):
+        self.__moves(args, relative=True)
+        self.wait_motion()
+
+    def _cmd_waitmove(self):
+        self.wait_motion()
+
+    def _cmd_count_em(self, count_time=1):
+        self.count(count_time)
+
+    def _cmd_waitcount(self):
+        self.wait_count()
+
+    def _cmd_get_counts(self):
+        pass
+
+    def _cmd_ct(self, count_time=1):
+        self.count(count_time)
+        self.wait_count()
+        return "".join("{0:>12} = {1:g}\n".format(name, counter.value)
+                       for name, counter in sorted(self.counters.items()))
+
+    def _cmd_wa(self):
+        return "".join("{0:>12} = {1:.4f}\n".format(name, motor.position)
+                       for name, motor in sorted(self.motors.items()))
+
+    _cmd_wm = _cmd_wa
+
+    def _cmd_sleep(self, seconds):
+        gevent.sleep(float(seconds.strip("()")))
+
+    def _cmd_stop(self):
+        self.stop()
+
+    def _cmd_ascan(self, motor, start, end, intervals, count_time):
+        self.__scan(self.__points(start, end, intervals),
+                    self.motors[motor], count_time)
+
+    def _cmd_dscan(self, motor, start, end, intervals, count_time):
+        motor = self.motors[motor]
+        origin = motor.position
+        points = [origin + point
+                  for point in self.__points(start, end, intervals)]
+        self.__scan(points, motor, count_time)
+        # back to the start position
+        motor.move(origin)
+        self.wait_motion()
+
+    def __points(self, start, end, intervals):
+        start, end, intervals = float(start), float(end), int(intervals)
+        step = (end - start) / max(intervals, 1)
+        return [start + i * step for i in range(intervals + 1)]
+
+    def _cmd_loopscan(self, npoints, count_time):
+        self.__scan([None] * int(npoints), None, count_time)
+
+    def __scan(self, points, motor, count_time):
+        names = sorted(self.counters)
+        data = []
+        self.set_channel("var/NPTS", 0)
+        for npts, position in enumerate(points):
+            if motor is not None:
+                motor.move(position)
+                self.wait_motion()
+            self.count(count_time)
+            self.wait_count()
+            row = [npts if motor is None else motor.position] + \
+                  [self.counters[name].value for name in names]
+            data.append(row)
+            self.set_channel("var/SCAN_D", [list(r) for r in data])
+            self.set_channel("var/NPTS", npts + 1)
+            self.write(" ".join("{0:g}".format(v) for v in row) + "\n")
+
+
+# dict<session name: Simulator>
+__SIMULATORS = {}
+def get_simulator(session):
+    """Returns the :class:`Simulator` of the given SPEC session
+    (<host>:<session>)"""
+    simulator = __SIMULATORS.get(session)
+    if simulator is None:
+        simulator = Simulator(session)
+        __SIMULATORS[session] = simulator
+    return simulator
+
+
+# ----------------------------------------------------------------
+# SpecClient like objects (see TangoSpec.SpecSession)
+# ----------------------------------------------------------------
+
+class _SimObject(object):
+
+    def __init__(self, simulator, callbacks=None):
+        self.simulator = simulator
+        self.callbacks = callbacks or {}
+        self.connected = False
+
+    def _callback(self, name, *args):
+        callback = self.callbacks.get(name)
+        if callback is not None:
+            _dispatch(callback, *args)
+
+    def _connected(self):
+        self.connected = True
+        self._callback("connected")
+
+    def isConnected(self):
+        return self.connected
+
+
+class SimSpec(_SimObject):
+    """Simulated SpecClient Spec"""
+
+    def connectToSpec(self, spec_name, timeout=None):
+        self._connected()
+
+    def getMotorsMne(self):
+        return sorted(self.simulator.motors)
+
+    def getCountersMne(self):
+        return sorted(self.simulator.counters)
+
+
+class SimMotor(_SimObject):
+    """Simulated SpecClient SpecMotorA"""
+
+    motor = None
+
+    def connectToSpec(self, name, spec_name, timeout=None):
+        self.motor = self.simulator.get_motor(name)
+        self.motor.listeners.add(self)
+        self._connected()
+        self._callback("motorStateChanged", self.motor.state)
+        self._callback("motorPositionChanged", self.motor.position)
+
+    def getState(self):
+        return self.motor.state
+
+    def getPosition(self):
+        return self.motor.position
+
+    def getDialPosition(self):
+        motor = self.motor
+        return (motor.position - motor.offset) / motor.sign
+
+    def getSign(self):
+        return self.motor.sign
+
+    def setSign(self, sign):
+        self.motor.sign = int(sign)
+
+    def getOffset(self):
+        return self.motor.offset
+
+    def setOffset(self, offset):
+        self.motor.offset = float(offset)
+
+    def getLimits(self):
+        return self.motor.limits
+
+    def getParameter(self, name):
+        return self.motor.get_parameter(name)
+
+    def setParameter(self, name, value):
+        self.motor.configure(**{name: value})
+
+    def move(self, position):
+        self.motor.move(position)
+
+    def moveRelative(self, position):
+        self.motor.move(self.motor.position + position)
+
+    def stop(self):
+        self.motor.stop()
+
+
+class SimCounter(_SimObject):
+    """Simulated SpecClient SpecCounterA"""
+
+    counter = None
+
+    def connectToSpec(self, name, spec_name, timeout=None):
+        self.counter = self.simulator.get_counter(name)
+        self.counter.listeners.add(self)
+        self._connected()
+        self._callback("counterStateChanged", self.counter.state)
+        self._callback("counterValueChanged", self.counter.value)
+
+    def getState(self):
+        return self.counter.state
+
+    def getType(self):
+        return self.counter.type
+
+    def getValue(self):
+        return self.counter.value
+
+    def count(self, count_time):
+        self.simulator.count(count_time)
+
+    def stop(self):
+        self.simulator.stop()
+
+    def setEnabled(self, enabled):
+        self.counter.enabled = bool(enabled)
+
+
+class SimVariable(_SimObject):
+    """Simulated SpecClient SpecVariable (and SpecVariableA)"""
+
+    channel = None
+
+    def connectToSpec(self, name, spec_name, timeout=None,
+                      dispatchMode=None, prefix=True):
+        self.channel = "var/" + name if prefix else name
+        if "update" in self.callbacks:
+            listeners = self.simulator.channel_listeners
+            listeners.setdefault(self.channel, weakref.WeakSet()).add(self)
+        self._connected()
+        self._callback("update", self.getValue())
+
+    def getValue(self):
+        return self.simulator.get_channel(self.channel)
+
+    def setValue(self, value):
+        self.simulator.set_channel(self.channel, value)
+
+
+class SimCommand(object):
+    """Simulated SpecClient SpecCommand"""
+
+    def __init__(self, simulator, command=None, connection=None):
+        self.simulator = simulator
+        self.__task = None
+
+    def executeCommand(self, cmd, wait=True):
+        if wait:
+            return self.simulator.execute(cmd)
+        self.__task = gevent.spawn(self.simulator.execute, cmd)
+        return self.__task
+
+    def abort(self):
+        self.simulator.stop()
+        if self.__task is not None:
+            self.__task.kill(block=False)
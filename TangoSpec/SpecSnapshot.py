@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+#------------------------------------------------------------------------------
+# This file is part of the Tango SPEC device server
+#
+# Copyright (c) 2014, European Synchrotron Radiation Facility.
+# Distributed under the GNU Lesser General Public License.
+# See LICENSE.txt for more info.
+#------------------------------------------------------------------------------
+
+"""Snapshot of the metadata and last known values of a SPEC session.
+
+The snapshot is saved in a local JSON file (periodically and on shutdown)
+and loaded at start so the devices can answer before SPEC is connected."""
+
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+
+#: snapshot sections
+ELEMENTS, VARIABLES, MOTORS, COUNTERS = \
+    "elements", "variables", "motors", "counters"
+
+SNAPSHOT_VERSION = 1
+
+
+def _json_default(value):
+    # numpy arrays and scalars
+    tolist = getattr(value, 'tolist', None)
+    if tolist is None:
+        raise TypeError("{0!r} is not JSON serializable".format(value))
+    return tolist()
+
+
+class Snapshot(object):
+    """Snapshot of a SPEC session: dict<section: dict<key: value>>"""
+
+    def __init__(self, session):
+        self.session = session
+        self.filename = None
+        self.time = None
+        # quality (PyTango AttrQuality) of the values served from it
+        self.quality = None
+        self.sections = dict((section, {}) for section in
+                             (ELEMENTS, VARIABLES, MOTORS, COUNTERS))
+        self.__lock = threading.Lock()
+        self.__log = logging.getLogger("TangoSpec.Snapshot." + session)
+
+    def open(self, filename):
+        """Sets the snapshot file and loads it (only the first time)"""
+        if self.filename is not None:
+            if filename != self.filename:
+                self.__log.warning("Snapshot of %s already in %s (not "
+                                   "using %s)", self.session, self.filename,
+                                   filename)
+            return
+        self.filename = filename
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename) as snapshot_file:
+                data = json.load(snapshot_file)
+        except IOError:
+            self.__log.info("No snapshot %s", self.filename)
+            return
+        except ValueError:
+            self.__log.warning("Ignoring corrupt snapshot %s", self.filename)
+            return
+        if data.get("version") != SNAPSHOT_VERSION or \
+           data.get("session") != self.session:
+            self.__log.warning("Ignoring snapshot %s (other version or "
+                               "session)", self.filename)
+            return
+        self.time = data.get("time")
+        for section, values in data.get("sections", {}).items():
+            self.sections.setdefault(section, {}).update(values)
+        self.__log.info("Loaded snapshot %s", self.filename)
+
+    def get(self, section, key, default=None):
+        return self.sections[section].get(key, default)
+
+    def set(self, section, key, value):
+        self.sections[section][key] = value
+
+    def dumps(self):
+        """Returns the snapshot as JSON text"""
+        data = dict(version=SNAPSHOT_VERSION, session=self.session,
+                    time=time.time(), sections=self.sections)
+        return json.dumps(data, default=_json_default)
+
+    def write(self, text):
+        """Writes the snapshot text atomically (temporary file renamed)"""
+        if self.filename is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        with self.__lock:
+            fd, tmp_name = tempfile.mkstemp(prefix=".snapshot",
+                                            dir=directory)
+            try:
+                with os.fdopen(fd, "w") as tmp_file:
+                    tmp_file.write(text)
+                    tmp_file.flush()
+                    os.fsync(tmp_file.fileno())
+                os.rename(tmp_name, self.filename)
+            except:
+                os.remove(tmp_name)
+                raise
+        self.__log.debug("Saved snapshot %s", self.filename)
+
+    def save(self):
+        self.write(self.dumps())
+
+
+__SNAPSHOTS = {}
+def get_snapshot(session):
+    """Returns the :class:`Snapshot` of the given SPEC session
+    (<host>:<session>)"""
+    snapshot = __SNAPSHOTS.get(session)
+    if snapshot is None:
+        snapshot = Snapshot(session)
+        __SNAPSHOTS[session] = snapshot
+    return snapshot
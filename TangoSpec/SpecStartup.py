@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+#------------------------------------------------------------------------------
+# This file is part of the Tango SPEC device server
+#
+# Copyright (c) 2014, European Synchrotron Radiation Facility.
+# Distributed under the GNU Lesser General Public License.
+# See LICENSE.txt for more info.
+#------------------------------------------------------------------------------
+
+"""Server start-up timing (``TangoSpec <instance> --startup-profile``).
+
+The start-up is split in phases. Phases may be nested: the time spent in a
+nested phase is not accounted in the enclosing one."""
+
+import sys
+import time
+import functools
+import collections
+
+
+class _NullPhase(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase(object):
+
+    __slots__ = ('timer', 'name')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.timer.push(self.name)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timer.pop()
+
+
+class StartupTimer(object):
+    """Accounts the time spent in each start-up phase (only when
+    enabled)"""
+
+    def __init__(self):
+        self.enabled = False
+        self.start_time = None
+        # dict<phase name: [time (s), count]>
+        self.phases = collections.OrderedDict()
+        # list<[phase name, resume time]>
+        self.__stack = []
+
+    def enable(self, start_time=None):
+        self.enabled = True
+        self.start_time = time.time() if start_time is None else start_time
+
+    def add(self, name, duration, count=0):
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = [0.0, 0]
+        phase[0] += duration
+        phase[1] += count
+
+    def push(self, name):
+        if not self.enabled:
+            return
+        now = time.time()
+        if self.__stack:
+            parent = self.__stack[-1]
+            self.add(parent[0], now - parent[1])
+        self.__stack.append([name, now])
+
+    def pop(self):
+        if not self.enabled or not self.__stack:
+            return
+        now = time.time()
+        name, resume_time = self.__stack.pop()
+        self.add(name, now - resume_time, count=1)
+        if self.__stack:
+            self.__stack[-1][1] = now
+
+    def phase(self, name):
+        """Returns a context manager which accounts the time spent in it in
+        the given phase"""
+        if not self.enabled:
+            return _NULL_PHASE
+        return _Phase(self, name)
+
+    def timed(self, name, f):
+        """Returns f decorated to account its time in the given phase"""
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with self.phase(name):
+                return f(*args, **kwargs)
+        return wrapper
+
+    def report(self):
+        total = time.time() - self.start_time
+        lines = ["TangoSpec start-up: {0:.3f}s".format(total)]
+        for name, (duration, count) in self.phases.items():
+            lines.append("  {0:8.3f}s {1:5.1f}% {2:6d}x  {3}".format(
+                duration, 100 * duration / (total or 1), count, name))
+        return "\n".join(lines)
+
+
+__STARTUP_TIMER = StartupTimer()
+
+
+def get_startup_timer():
+    """Returns the server start-up timer"""
+    return __STARTUP_TIMER
+
+
+def startup_phase(name):
+    """Helper returning a context manager which accounts the time spent in
+    it in the given start-up phase"""
+    return __STARTUP_TIMER.phase(name)
+
+
+def report_startup(stream=None):
+    """Writes the start-up report (if start-up profiling is enabled)"""
+    timer = __STARTUP_TIMER
+    if timer.enabled:
+        stream = sys.stderr if stream is None else stream
+        stream.write(timer.report() + "\n")
+        stream.flush()
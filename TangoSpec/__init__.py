@@ -10,18 +10,71 @@
 
 """A TANGO_ device server which provides a TANGO_ interface to SPEC_."""
 
-import datetime
-__this_year = datetime.date.today().year
-del datetime
-
 __project__ = 'TangoSpec'
 __version_info__ = (3, 0, 0, 'final', 0)
 __version__ = "{0[0]}.{0[1]}.{0[2]}".format(__version_info__)
 __authors__ = ['Tiago Coutinho', 'Matias Guijarro', 'Andy Gotz']
 __author__ = __authors__[0]
-__copyright__ = '{0}, European Synchrotron Radiation Facility'.format(__this_year)
+__copyright__ = '2014, European Synchrotron Radiation Facility'
 __description__ = __doc__
 
-from .Spec import Spec, run
-from .SpecMotor import SpecMotor
-from .SpecCounter import SpecCounter
+import sys
+from types import ModuleType
+
+
+def run(**kwargs):
+    """Runs the TangoSpec device server (see :func:`TangoSpec.Spec.run`).
+
+    The device modules (and SpecClient, gevent, numpy...) are only imported
+    when the server runs (accounted in the ``imports`` phase of
+    ``--startup-profile``): importing the package stays cheap"""
+    from .SpecStartup import get_startup_timer
+    timer = get_startup_timer()
+    if "--startup-profile" in (kwargs.get('args') or sys.argv) and \
+       not timer.enabled:
+        timer.enable()
+    with timer.phase("imports"):
+        from .Spec import run
+    return run(**kwargs)
+
+
+def _device_class(name):
+    """Returns a property of the package which imports the device module of
+    the given name when first used and returns its device class"""
+    def fget(package):
+        module_name = package.__name__ + '.' + name
+        __import__(module_name)
+        return getattr(sys.modules[module_name], name)
+
+    def fset(package, value):
+        # importing a device module binds it in the package (python 3):
+        # the property keeps returning the device class
+        package.__dict__[name] = value
+
+    return property(fget, fset, doc="TANGO_ device class {0}".format(name))
+
+
+class _Package(ModuleType):
+    """The TangoSpec package: the device classes (:class:`Spec`,
+    :class:`SpecMotor` and :class:`SpecCounter`) are imported when first
+    used"""
+
+    Spec = _device_class('Spec')
+    SpecMotor = _device_class('SpecMotor')
+    SpecCounter = _device_class('SpecCounter')
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(['Spec', 'SpecMotor',
+                                                'SpecCounter']))
+
+
+def __install():
+    module = sys.modules[__name__]
+    package = _Package(__name__, __doc__)
+    package.__dict__.update(module.__dict__)
+    # python 2 clears the globals of a deleted module: keep it alive for
+    # the functions defined here
+    package.__dict__['_module'] = module
+    sys.modules[__name__] = package
+
+__install()
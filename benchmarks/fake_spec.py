@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+
+#------------------------------------------------------------------------------
+# This file is part of the Tango SPEC device server
+#
+# Copyright (c) 2014, European Synchrotron Radiation Facility.
+# Distributed under the GNU Lesser General Public License.
+# See LICENSE.txt for more info.
+#------------------------------------------------------------------------------
+
+"""A stand-in SPEC server speaking the SpecClient protocol (benchmarks only).
+
+It knows a configurable set of motors, counters and variables and can
+generate tty output at a given rate. Clients connect to it with the spec
+name ``localhost:<port>``.
+
+Supported messages: HELLO, REGISTER/UNREGISTER (an EVENT with the current
+value is sent on registration), CHAN_READ, CHAN_SEND, CMD/CMD_WITH_RETURN
+and FUNC/FUNC_WITH_RETURN (``motor_mne(i)``, ``cnt_mne(i)``, ``count_em``,
+``get_counts``; anything else is echoed on the tty)."""
+
+import re
+import time
+import socket
+import struct
+import logging
+import threading
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+MAGIC_NUMBER = 4277009102
+
+HEADER_FORMATS = {
+    2: "<IiiiIIiiIII80s",
+    3: "<IiiiIIiiIIIi80s",
+    4: "<IiiiIIiiIIIii80s",
+}
+
+# commands
+CLOSE, ABORT, CMD, CMD_WITH_RETURN = 1, 2, 3, 4
+REGISTER, UNREGISTER, EVENT = 6, 7, 8
+FUNC, FUNC_WITH_RETURN = 9, 10
+CHAN_READ, CHAN_SEND, REPLY = 11, 12, 13
+HELLO, HELLO_REPLY = 14, 15
+
+# data types
+DOUBLE, STRING, ERROR, ASSOC = 1, 2, 3, 4
+ARRAY_DOUBLE = 5
+
+DELETED = 0x1000
+
+_FuncRE = re.compile(r"^\s*(\w+)\s*\(\s*(\d+)\s*\)\s*$")
+
+log = logging.getLogger("FakeSpec")
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode("utf-8")
+
+
+def _to_str(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8", "replace")
+    return value
+
+
+def encode(value):
+    """Returns (data type, rows, cols, data) for the given value"""
+    if isinstance(value, dict):
+        data = b"".join(_to_bytes(k) + b"\0" + _to_bytes(v) + b"\0"
+                        for k, v in value.items())
+        return ASSOC, 0, 0, data + b"\0"
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return DOUBLE, 0, 0, _to_bytes(repr(value)) + b"\0"
+    if isinstance(value, (list, tuple)):
+        data = struct.pack("<{0}d".format(len(value)), *value)
+        return ARRAY_DOUBLE, 1, len(value), data
+    return STRING, 0, 0, _to_bytes(value) + b"\0"
+
+
+def decode(data_type, data):
+    """Decodes the data of a message (only scalar types are needed)"""
+    text = _to_str(data.rstrip(b"\0"))
+    if data_type == DOUBLE:
+        try:
+            return float(text)
+        except ValueError:
+            return text
+    if data_type == ASSOC:
+        items = text.split("\0")
+        return dict(zip(items[::2], items[1::2]))
+    return text
+
+
+class Message(object):
+
+    def __init__(self, version, cmd, name, value=None, sn=0, err=0,
+                 flags=0):
+        self.version = version
+        self.cmd = cmd
+        self.name = name
+        self.value = value
+        self.sn = sn
+        self.err = err
+        self.flags = flags
+
+    def pack(self):
+        fmt = HEADER_FORMATS[self.version]
+        data_type, rows, cols, data = encode("" if self.value is None
+                                             else self.value)
+        if self.err:
+            data_type = ERROR
+        now = time.time()
+        header = [MAGIC_NUMBER, self.version, struct.calcsize(fmt), self.sn,
+                  int(now), int((now % 1) * 1e6), self.cmd, data_type, rows,
+                  cols, len(data)]
+        if self.version >= 3:
+            header.append(self.err)
+        if self.version >= 4:
+            header.append(self.flags)
+        header.append(_to_bytes(self.name))
+        return struct.pack(fmt, *header) + data
+
+
+def read_message(sock_file):
+    """Reads a message from the client. Returns None at end of stream"""
+    start = sock_file.read(12)
+    if len(start) < 12:
+        return
+    magic, version, size = struct.unpack("<Iii", start)
+    if magic != MAGIC_NUMBER:
+        raise ValueError("Bad magic number (only little endian supported)")
+    fmt = HEADER_FORMATS[version]
+    header = struct.unpack(fmt, start + sock_file.read(size - 12))
+    sn, cmd, data_type, data_len = header[3], header[6], header[7], \
+                                   header[10]
+    name = _to_str(header[-1].rstrip(b"\0"))
+    data = sock_file.read(data_len) if data_len else b""
+    message = Message(version, cmd, name, decode(data_type, data), sn=sn)
+    return message
+
+
+class _Client(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.version = 4
+        self.lock = threading.Lock()
+        self.channels = set()
+
+    def send(self, message):
+        try:
+            with self.lock:
+                self.request.sendall(message.pack())
+        except socket.error:
+            pass
+
+    def send_event(self, channel, value, flags=0):
+        self.send(Message(self.version, EVENT, channel, value, flags=flags))
+
+    def handle(self):
+        spec = self.server.spec
+        spec.add_client(self)
+        sock_file = self.request.makefile("rb")
+        try:
+            while True:
+                message = read_message(sock_file)
+                if message is None or message.cmd == CLOSE:
+                    break
+                self.version = message.version
+                spec.handle_message(self, message)
+        finally:
+            spec.remove_client(self)
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeSpec(object):
+    """A fake SPEC session.
+
+    :param motors: motor mnemonics
+    :param counters: counter mnemonics
+    :param variables: dict<variable name: initial value>
+    :param velocity: motor velocity (units/s)
+    :param tty_rate: tty output lines per second (0: no output)
+    :param port: TCP port (0 means any free port)"""
+
+    def __init__(self, name="fakespec", motors=(), counters=(),
+                 variables=None, velocity=100.0, tty_rate=0, port=0):
+        self.name = name
+        self.motors = list(motors)
+        self.counters = list(counters)
+        self.velocity = velocity
+        self.tty_rate = tty_rate
+        self.tty_lines = 0
+        self.lock = threading.RLock()
+        self.clients = set()
+        # dict<channel: value>
+        self.values = {"var/MOTORS": len(self.motors),
+                       "var/COUNTERS": len(self.counters),
+                       "status/ready": 1, "status/shell": 0,
+                       "status/simulate": 0, "output/tty": ""}
+        for motor in self.motors:
+            prefix = "motor/{0}/".format(motor)
+            self.values.update({prefix + "position": 0.0,
+                                prefix + "dial_position": 0.0,
+                                prefix + "move_done": 0,
+                                prefix + "low_limit": -1e9,
+                                prefix + "high_limit": 1e9,
+                                prefix + "offset": 0.0,
+                                prefix + "sign": 1,
+                                prefix + "unusable": 0})
+        for counter in self.counters:
+            self.values["scaler/{0}/value".format(counter)] = 0.0
+        self.values["scaler/.all./count"] = 0
+        for name, value in (variables or {}).items():
+            self.values["var/" + name] = value
+        self.server = _Server(("localhost", port), _Client)
+        self.server.spec = self
+        self.__threads = []
+        self.__stop = threading.Event()
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    @property
+    def spec_name(self):
+        """SPEC name to be used by clients"""
+        return "localhost:{0}".format(self.port)
+
+    def start(self):
+        self.__start_thread(self.server.serve_forever)
+        if self.tty_rate > 0:
+            self.__start_thread(self.__tty_loop)
+        return self
+
+    def stop(self):
+        self.__stop.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def __start_thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        self.__threads.append(thread)
+
+    def add_client(self, client):
+        with self.lock:
+            self.clients.add(client)
+
+    def remove_client(self, client):
+        with self.lock:
+            self.clients.discard(client)
+
+    # ----------------------------------------------------------------
+    # channels
+    # ----------------------------------------------------------------
+
+    def get(self, channel):
+        with self.lock:
+            return self.values.get(channel, 0)
+
+    def update(self, channel, value):
+        """Sets a channel value and sends an event to the registered
+        clients"""
+        with self.lock:
+            self.values[channel] = value
+            clients = [client for client in self.clients
+                       if channel in client.channels]
+        for client in clients:
+            client.send_event(channel, value)
+
+    def output(self, line):
+        self.tty_lines += 1
+        self.update("output/tty", line)
+
+    def __tty_loop(self):
+        period = 1.0 / self.tty_rate
+        next_time = time.time()
+        while not self.__stop.is_set():
+            self.output("{0}.FAKE> line {1}\n".format(self.tty_lines,
+                                                       self.tty_lines))
+            next_time += period
+            delay = next_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    # ----------------------------------------------------------------
+    # messages
+    # ----------------------------------------------------------------
+
+    def handle_message(self, client, message):
+        cmd, name = message.cmd, message.name
+        if cmd == HELLO:
+            client.send(Message(message.version, HELLO_REPLY, self.name,
+                                self.name, sn=message.sn))
+        elif cmd == REGISTER:
+            client.channels.add(name)
+            client.send_event(name, self.get(name))
+        elif cmd == UNREGISTER:
+            client.channels.discard(name)
+        elif cmd == CHAN_READ:
+            client.send(Message(message.version, REPLY, name,
+                                self.get(name), sn=message.sn))
+        elif cmd == CHAN_SEND:
+            self.chan_send(name, message.value)
+        elif cmd in (CMD, CMD_WITH_RETURN, FUNC, FUNC_WITH_RETURN):
+            result = self.execute(message.value)
+            if cmd in (CMD_WITH_RETURN, FUNC_WITH_RETURN):
+                client.send(Message(message.version, REPLY, name, result,
+                                    sn=message.sn))
+        elif cmd == ABORT:
+            pass
+        else:
+            log.warning("Unsupported message %d (%s)", cmd, name)
+
+    def chan_send(self, channel, value):
+        parts = channel.split("/")
+        if parts[0] == "motor" and parts[-1] == "start_one":
+            self.__start_thread(self.move, parts[1], float(value))
+        elif channel == "scaler/.all./count":
+            if value:
+                self.__start_thread(self.count, float(value))
+        else:
+            self.update(channel, value)
+
+    def execute(self, command):
+        command = _to_str(command or "")
+        result = _FuncRE.match(command)
+        if result:
+            func, index = result.group(1), int(result.group(2))
+            if func in ("motor_mne", "motor_name"):
+                return self.motors[index]
+            if func in ("cnt_mne", "cnt_name"):
+                return self.counters[index]
+        for part in command.split(";"):
+            part = part.strip()
+            if part.startswith("count_em"):
+                self.count(float(part.split()[1]))
+        if "get_counts" in command:
+            return 0
+        self.output(command + "\n")
+        return ""
+
+    # ----------------------------------------------------------------
+    # simulation
+    # ----------------------------------------------------------------
+
+    def move(self, motor, target, period=0.01):
+        prefix = "motor/{0}/".format(motor)
+        start = self.get(prefix + "position")
+        duration = abs(target - start) / self.velocity
+        self.update(prefix + "move_done", 1)
+        start_time = time.time()
+        while True:
+            elapsed = time.time() - start_time
+            if elapsed >= duration:
+                break
+            position = start + (target - start) * elapsed / duration
+            self.update(prefix + "position", position)
+            self.update(prefix + "dial_position", position)
+            time.sleep(period)
+        self.update(prefix + "position", target)
+        self.update(prefix + "dial_position", target)
+        self.update(prefix + "move_done", 0)
+
+    def count(self, count_time, period=0.01):
+        self.update("scaler/.all./count", 1)
+        start_time = time.time()
+        while True:
+            elapsed = min(time.time() - start_time, count_time)
+            for index, counter in enumerate(self.counters):
+                self.update("scaler/{0}/value".format(counter),
+                            elapsed * 1000 * (index + 1))
+            if elapsed >= count_time:
+                break
+            time.sleep(period)
+        self.update("scaler/.all./count", 0)
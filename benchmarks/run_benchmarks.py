@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#------------------------------------------------------------------------------
+# This file is part of the Tango SPEC device server
+#
+# Copyright (c) 2014, European Synchrotron Radiation Facility.
+# Distributed under the GNU Lesser General Public License.
+# See LICENSE.txt for more info.
+#------------------------------------------------------------------------------
+
+"""TangoSpec benchmarks.
+
+Runs the TangoSpec devices (in a PyTango test context) against a fake SPEC
+server (see :mod:`fake_spec`) through standard scenarios and prints the
+results as JSON. Requires PyTango >= 9.3 (MultiDeviceTestContext).
+
+Scenarios which create devices (reconstruct) need a TANGO database: they
+run a TangoSpec server registered in the database of TANGO_HOST and are
+skipped unless ``--database`` is given. The results list the scenarios
+which were run and the skipped ones.
+
+Examples::
+
+    $ python benchmarks/run_benchmarks.py
+    $ python benchmarks/run_benchmarks.py -s startup -s execute_cmd \\
+          --elements 200 -o results.json
+    $ TANGO_HOST=dbhost:10000 python benchmarks/run_benchmarks.py \\
+          -s reconstruct --database
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import threading
+import subprocess
+
+from PyTango import DeviceProxy, DevState, EventType, GreenMode
+from PyTango.test_context import MultiDeviceTestContext
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import TangoSpec
+from TangoSpec.Spec import Spec
+from TangoSpec.SpecMotor import SpecMotor
+from TangoSpec.SpecCounter import SpecCounter
+
+from fake_spec import FakeSpec
+
+SPEC_DEV = "bench/spec/fake"
+
+#: TangoSpec server instance of the scenarios which need a database
+SERVER = "TangoSpec/bench"
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    """Returns dict<'p<n>': value> (plus min, max, mean) of the samples"""
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    n = len(samples)
+    result = dict(("p{0}".format(p), samples[min(n - 1, int(n * p / 100.0))])
+                  for p in points)
+    result.update(min=samples[0], max=samples[-1],
+                  mean=sum(samples) / float(n), n=n)
+    return result
+
+
+def wait_for(condition, timeout, period=0.05):
+    """Waits for condition() to be True. Returns the time it took or None
+    on timeout"""
+    start = time.time()
+    while time.time() - start < timeout:
+        if condition():
+            return time.time() - start
+        time.sleep(period)
+
+
+def devices_info(spec, motors=(), counters=(), **spec_properties):
+    properties = dict(Spec=spec.spec_name)
+    properties.update(spec_properties)
+    return (
+        {"class": Spec,
+         "devices": [dict(name=SPEC_DEV, properties=properties)]},
+        {"class": SpecMotor,
+         "devices": [dict(name="bench/spec_fake/" + motor,
+                          properties=dict(SpecMotor="{0}:{1}".format(
+                              spec.spec_name, motor)))
+                     for motor in motors]},
+        {"class": SpecCounter,
+         "devices": [dict(name="bench/spec_fake/" + counter,
+                          properties=dict(SpecCounter="{0}:{1}".format(
+                              spec.spec_name, counter)))
+                     for counter in counters]},
+    )
+
+
+def context(info):
+    return MultiDeviceTestContext(info, process=True)
+
+
+class database_server(object):
+    """Registers a Spec device in the TANGO database (TANGO_HOST) and runs
+    it in a TangoSpec server process, for the scenarios which create
+    devices (the test context has no database). The server, its devices
+    and their aliases are removed from the database at the end"""
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.db = None
+        self.process = None
+
+    def __enter__(self):
+        from PyTango import Database, DbDevInfo
+        self.db = Database()
+        if self.db.get_device_class_list(SERVER).value_string:
+            raise RuntimeError("{0} already exists in the database"
+                               .format(SERVER))
+        info = DbDevInfo()
+        info.name, info._class, info.server = SPEC_DEV, "Spec", SERVER
+        self.db.add_device(info)
+        self.db.put_device_property(SPEC_DEV, dict(Spec=self.spec.spec_name))
+        script = os.path.join(ROOT, "scripts", "TangoSpec")
+        self.process = subprocess.Popen([sys.executable, script,
+                                         SERVER.split("/")[1]])
+        return SPEC_DEV
+
+    def __exit__(self, *exc_info):
+        self.process.terminate()
+        self.process.wait()
+        devices = self.db.get_device_class_list(SERVER).value_string[::2]
+        for device in devices:
+            try:
+                self.db.delete_device_alias(
+                    self.db.get_alias_from_device(device))
+            except Exception:
+                pass
+        self.db.delete_server(SERVER)
+
+
+class EventCounter(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.errors = 0
+
+    def push_event(self, event):
+        with self.lock:
+            if event.err:
+                self.errors += 1
+            else:
+                self.count += 1
+
+
+# ----------------------------------------------------------------------------
+# scenarios
+# ----------------------------------------------------------------------------
+
+def startup(args):
+    """Time for N motors and N counters to be connected (ON)"""
+    motors = ["m{0}".format(i) for i in range(args.elements)]
+    counters = ["c{0}".format(i) for i in range(args.elements)]
+    with FakeSpec(motors=motors, counters=counters) as spec:
+        start = time.time()
+        with context(devices_info(spec, motors, counters)) as ctx:
+            started = time.time() - start
+            proxies = [DeviceProxy(ctx.get_device_access(
+                       "bench/spec_fake/" + name))
+                       for name in motors + counters]
+            def all_on():
+                return all(proxy.state() == DevState.ON for proxy in proxies)
+            connected = wait_for(all_on, args.timeout)
+    return dict(elements=len(motors) + len(counters), server_start=started,
+                connected=None if connected is None else started + connected)
+
+
+def output_throughput(args):
+    """Output events received by a client for a given tty line rate"""
+    with FakeSpec(tty_rate=args.rate) as spec:
+        with context(devices_info(spec)) as ctx:
+            proxy = DeviceProxy(ctx.get_device_access(SPEC_DEV))
+            counter = EventCounter()
+            event_id = proxy.subscribe_event("Output", EventType.CHANGE_EVENT,
+                                             counter)
+            lines = spec.tty_lines
+            counter.count = 0
+            time.sleep(args.duration)
+            lines, events = spec.tty_lines - lines, counter.count
+            proxy.unsubscribe_event(event_id)
+    return dict(rate=args.rate, duration=args.duration, lines=lines,
+                events=events, events_per_second=events / args.duration,
+                missed=max(0, lines - events))
+
+
+def execute_cmd(args):
+    """ExecuteCmd round trip latency"""
+    with FakeSpec() as spec:
+        with context(devices_info(spec)) as ctx:
+            proxy = DeviceProxy(ctx.get_device_access(SPEC_DEV))
+            wait_for(lambda: proxy.state() == DevState.ON, args.timeout)
+            latencies = []
+            for i in range(args.iterations):
+                start = time.time()
+                proxy.ExecuteCmd("p {0}".format(i))
+                latencies.append(time.time() - start)
+    return dict(latency=percentiles(latencies))
+
+
+def variable_fanout(args):
+    """Variable change events received by several clients"""
+    names = ["V{0}".format(i) for i in range(args.variables)]
+    variables = [json.dumps(dict(name=name, type="float")) for name in names]
+    with FakeSpec(variables=dict((name, 0.0) for name in names)) as spec:
+        with context(devices_info(spec, Variables=variables)) as ctx:
+            access = ctx.get_device_access(SPEC_DEV)
+            counter = EventCounter()
+            subscriptions = []
+            for _ in range(args.clients):
+                proxy = DeviceProxy(access)
+                for name in names:
+                    event_id = proxy.subscribe_event(
+                        name, EventType.CHANGE_EVENT, counter)
+                    subscriptions.append((proxy, event_id))
+            counter.count = 0
+            start = time.time()
+            for i in range(args.iterations):
+                for name in names:
+                    spec.update("var/" + name, float(i + 1))
+            sent = time.time() - start
+            expected = args.iterations * len(names) * args.clients
+            received = wait_for(lambda: counter.count >= expected,
+                                args.timeout)
+            events = counter.count
+            for proxy, event_id in subscriptions:
+                proxy.unsubscribe_event(event_id)
+    return dict(variables=len(names), clients=args.clients,
+                updates=args.iterations * len(names), send_time=sent,
+                expected_events=expected, events=events,
+                receive_time=received)
+
+
+def reconstruct(args):
+    """Time for Reconstruct to export N motors and N counters (creates
+    devices: needs a TANGO database)"""
+    motors = ["m{0}".format(i) for i in range(args.elements)]
+    counters = ["c{0}".format(i) for i in range(args.elements)]
+    with FakeSpec(motors=motors, counters=counters) as spec:
+        with database_server(spec) as device_name:
+            proxy = DeviceProxy(device_name)
+            wait_for(lambda: _is_on(proxy), args.timeout)
+            start = time.time()
+            proxy.Reconstruct()
+            returned = time.time() - start
+            def exported():
+                return len(proxy.MotorList or ()) + \
+                       len(proxy.CounterList or ())
+            total = len(motors) + len(counters)
+            done = wait_for(lambda: exported() >= total, args.timeout)
+            nb_exported = exported()
+    return dict(elements=total, exported=nb_exported,
+                command_time=returned,
+                reconstruct_time=None if done is None else returned + done)
+
+
+reconstruct.needs_database = True
+
+
+def _is_on(proxy):
+    # the server process may not be exported yet
+    try:
+        return proxy.state() == DevState.ON
+    except Exception:
+        return False
+
+
+SCENARIOS = dict(startup=startup, output_throughput=output_throughput,
+                 execute_cmd=execute_cmd, variable_fanout=variable_fanout,
+                 reconstruct=reconstruct)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("-s", "--scenario", action="append",
+                        choices=sorted(SCENARIOS),
+                        help="scenario to run (default: all)")
+    parser.add_argument("--elements", type=int, default=50,
+                        help="number of motors (and counters)")
+    parser.add_argument("--variables", type=int, default=10,
+                        help="number of variables")
+    parser.add_argument("--clients", type=int, default=4,
+                        help="number of event clients")
+    parser.add_argument("--iterations", type=int, default=200,
+                        help="number of commands/updates")
+    parser.add_argument("--rate", type=float, default=500,
+                        help="tty output lines per second")
+    parser.add_argument("--duration", type=float, default=5,
+                        help="duration (s) of the throughput scenarios")
+    parser.add_argument("--timeout", type=float, default=60,
+                        help="maximum time (s) to wait for a condition")
+    parser.add_argument("--database", action="store_true",
+                        help="run the scenarios which need a TANGO database "
+                             "(TANGO_HOST) to create devices")
+    parser.add_argument("-o", "--output", help="JSON output file "
+                        "(default: stdout)")
+    args = parser.parse_args()
+
+    # the TangoSpec devices run in a gevent hub
+    for klass in (Spec, SpecMotor, SpecCounter):
+        klass.green_mode = GreenMode.Gevent
+
+    results = dict(version=TangoSpec.__version__,
+                   python=platform.python_version(),
+                   platform=platform.platform(), time=time.time(),
+                   parameters=vars(args), scenarios={}, run=[], skipped={})
+    for name in args.scenario or sorted(SCENARIOS):
+        if getattr(SCENARIOS[name], "needs_database", False) and \
+           not args.database:
+            results["skipped"][name] = "needs a TANGO database (--database)"
+            continue
+        results["run"].append(name)
+        start = time.time()
+        try:
+            result = SCENARIOS[name](args)
+        except Exception as error:
+            result = dict(error="{0}: {1}".format(type(error).__name__,
+                                                  error))
+        result["wall_time"] = time.time() - start
+        results["scenarios"][name] = result
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()